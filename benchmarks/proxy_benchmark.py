@@ -0,0 +1,390 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load-testing benchmark of the proxy server against a simulated boiler on a pseudo-terminal (Linux only).
+
+The proxy is started as a separate process (``python -m froeling_proxy``) on the slave side of a pty, while
+a simulated boiler answers the frames arriving on the master side. A number of TCP clients then send
+requests to the proxy concurrently, each waiting for the response before sending the next request, and
+the throughput, the latency of requests and the CPU time used by the proxy process are reported. Options
+after ``--`` are passed on to the proxy, e.g.::
+
+    python benchmarks/proxy_benchmark.py --clients 1 4 16 --requests 200 --json results.json -- --asyncio
+
+With ``--replay``, the simulated boiler answers with the responses recorded by a proxy run with ``--trace``,
+at their recorded times (divided by ``--replay-speed``), and the clients send the recorded requests, so
+changes of the proxy can be measured against the traffic of a real boiler.
+
+With ``--baseline``, the results are compared with those saved earlier with ``--json``, and the exit status
+is 1 if the throughput or the 99th percentile of latency of any run is worse by more than the tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import froeling_lib  # noqa: E402
+from froeling_lib.trace import ReplayPort, read_trace  # noqa: E402
+
+# Response of the boiler to reading its state (0x51), as received from an S4 Turbo
+STATE_RESPONSE = bytes.fromhex("000557696e746572626574726965623b466575657220417573")
+
+
+class SimulatedBoiler:
+    """
+    A simulated boiler speaking the 0x02FD framing on the master side of a pseudo-terminal. Values (0x30)
+    are answered with 2 bytes per address, derived from the address; the state (0x51) with a fixed
+    state; other commands with their parameters.
+
+    :param latency: number of seconds to wait before answering each request
+    :param jitter: maximum number of seconds randomly added to the latency
+    :param bad_crc: probability of answering with the CRC byte 00, as the S4 Turbo sometimes does
+    :param drop: probability of not answering a request at all
+    :param garbage: probability of sending a few random bytes before the response
+    :param seed: seed of the random number generator, for repeatable runs
+    :param replay: a :py:class:`froeling_lib.trace.ReplayPort` to answer requests with the responses recorded
+        in its trace (at their recorded times, divided by its speed) instead, or None
+    """
+    def __init__(self, latency=0.02, jitter=0.0, bad_crc=0.0, drop=0.0, garbage=0.0, seed=None, replay=None):
+        self.replay = replay
+        self.latency = latency
+        self.jitter = jitter
+        self.bad_crc = bad_crc
+        self.drop = drop
+        self.garbage = garbage
+        self.counters = {"requests": 0, "dropped": 0, "bad_crc": 0, "garbage": 0}
+        self._random = random.Random(seed)
+        self._running = False
+        self._thread = None
+        self.master = self.slave = None
+        self.path = None
+
+    def open(self):
+        """
+        Open the pseudo-terminal and start answering requests in a separate thread.
+
+        :return: path of the slave device, to be opened as the boiler's serial port
+        """
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="simulated-boiler", daemon=True)
+        self._thread.start()
+        return self.path
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def respond(self, message):
+        """
+        :param message: command byte followed by parameters (bytes object)
+        :return: response payload (bytes object without the command byte)
+        """
+        command, parameters = message[0], message[1:]
+        if command == 0x30:
+            return b"".join((int.from_bytes(parameters[i:i + 2], "big") % 400 - 100).to_bytes(2, "big", signed=True)
+                            for i in range(0, len(parameters) - 1, 2))
+        if command == 0x51:
+            return STATE_RESPONSE
+        return parameters
+
+    def _run(self):
+        decoder = froeling_lib.FrameDecoder()
+        while self._running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                decoder.feed(os.read(self.master, 4096))
+            except OSError:
+                return
+            for message, _, _ in iter(decoder.next_frame, None):
+                if message:
+                    self._answer(message)
+
+    def _answer(self, message):
+        self.counters["requests"] += 1
+        if self.replay is not None:
+            self._replay(froeling_lib.encode_frame(message))
+            return
+        time.sleep(self.latency + self._random.uniform(0, self.jitter))
+        if self._random.random() < self.drop:
+            self.counters["dropped"] += 1
+            return
+        payload = message[:1] + self.respond(message)
+        frame = bytearray(froeling_lib.Froeling.BLOCK_START)
+        frame += len(payload).to_bytes(2, "big")
+        frame += payload
+        if self._random.random() < self.bad_crc:
+            self.counters["bad_crc"] += 1
+            frame.append(0x00)
+        else:
+            frame.append(froeling_lib._compute_crc(frame))
+        if self._random.random() < self.garbage:
+            self.counters["garbage"] += 1
+            frame[:0] = bytes(self._random.randrange(256) for _ in range(self._random.randint(1, 4)))
+        os.write(self.master, frame)
+
+    def _replay(self, request):
+        exchange = self.replay.next_exchange(request)
+        if exchange is None:
+            self.counters["dropped"] += 1
+            return
+        written = time.monotonic()
+        for returned, received in exchange.reads:
+            if received:
+                if self.replay.speed is not None:
+                    time.sleep(max(0.0, written + returned / self.replay.speed - time.monotonic()))
+                os.write(self.master, received)
+
+
+class ProxyProcess:
+    """
+    The proxy server running in a separate process on the given serial port.
+
+    :param tty: path of the serial port
+    :param port: TCP port for the proxy to listen on
+    :param proxy_args: additional command line arguments of the proxy
+    """
+    def __init__(self, tty, port, proxy_args=()):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+        self.port = port
+        self.process = subprocess.Popen([sys.executable, "-m", "froeling_proxy", tty, "-p", str(port)] +
+                                        list(proxy_args), env=env)
+
+    def wait_until_listening(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Proxy exited with status {}".format(self.process.returncode))
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("Proxy is not listening on port {}".format(self.port))
+
+    def cpu_time(self):
+        """
+        :return: CPU time (user and system) used by the process so far, in seconds
+        """
+        with open("/proc/{}/stat".format(self.process.pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def run_client(port, lines, count, latencies, errors):
+    """
+    Send count requests, cycling through the given lines, each after receiving the response to the previous
+    one, and record the latency of each response and the number of error responses.
+    """
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        buffer = bytearray()
+        for i in range(count):
+            started = time.perf_counter()
+            s.sendall(lines[i % len(lines)] + b"\n")
+            while b"\n" not in buffer:
+                data = s.recv(4096)
+                if not data:
+                    errors.append("connection closed")
+                    return
+                buffer += data
+            latencies.append(time.perf_counter() - started)
+            end = buffer.index(b"\n")
+            if buffer.startswith(b"!"):
+                errors.append(bytes(buffer[1:end]).decode("ascii", "replace"))
+            del buffer[:end + 1]
+
+
+def run_benchmark(port, clients, requests, lines, proxy, boiler):
+    """
+    :return: dictionary with the results of a run with the given number of concurrent clients
+    """
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=run_client, args=(port, lines, requests, latencies, errors))
+               for _ in range(clients)]
+    cpu_started = proxy.cpu_time()
+    boiler_requests = boiler.counters["requests"]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    cpu = proxy.cpu_time() - cpu_started
+    latencies.sort()
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "boiler_requests": boiler.counters["requests"] - boiler_requests,
+        "duration": duration,
+        "commands_per_second": len(latencies) / duration,
+        "latency": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+        "cpu_seconds": cpu,
+        "cpu_percent": 100 * cpu / duration,
+    }
+
+
+def percentile(sorted_values, fraction):
+    """
+    :return: the value at the given fraction of the sorted values (nearest rank), or None if there are none
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def format_milliseconds(seconds):
+    """
+    :return: the given number of seconds in milliseconds, padded to a fixed width, or `n/a` if it is None
+        (no request completed)
+    """
+    return "{:>10}".format("n/a") if seconds is None else "{:7.1f} ms".format(1000 * seconds)
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of descriptions of runs whose throughput or 99th percentile of latency is worse than
+        in the run of the baseline with the same number of clients by more than the tolerance (fraction)
+    """
+    regressions = []
+    baseline_runs = {run["clients"]: run for run in baseline["results"]}
+    for run in results:
+        previous = baseline_runs.get(run["clients"])
+        if previous is None:
+            continue
+        if run["commands_per_second"] < previous["commands_per_second"] * (1 - tolerance):
+            regressions.append("{} clients: {:.1f} commands/s, was {:.1f}".format(
+                run["clients"], run["commands_per_second"], previous["commands_per_second"]))
+        if run["latency"]["p99"] is None or previous["latency"]["p99"] is None:
+            if run["latency"]["p99"] is None and previous["latency"]["p99"] is not None:
+                regressions.append("{} clients: no request completed".format(run["clients"]))
+        elif run["latency"]["p99"] > previous["latency"]["p99"] * (1 + tolerance):
+            regressions.append("{} clients: p99 latency {:.1f} ms, was {:.1f} ms".format(
+                run["clients"], 1000 * run["latency"]["p99"], 1000 * previous["latency"]["p99"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the proxy server against a simulated boiler.")
+    parser.add_argument("--clients", help="numbers of concurrent TCP clients, one run each", type=int, nargs="+",
+                        default=[1, 4, 16])
+    parser.add_argument("--requests", help="number of requests sent by each client", type=int, default=100)
+    parser.add_argument("--line", help="request line to send (repeat for a mix); default is a mix of reading "
+                                       "values and state", action="append")
+    parser.add_argument("--port", help="TCP port for the proxy", type=int, default=18090)
+    parser.add_argument("--latency", help="response latency of the boiler in seconds", type=float, default=0.02)
+    parser.add_argument("--jitter", help="maximum random addition to the latency in seconds", type=float,
+                        default=0.0)
+    parser.add_argument("--bad-crc", help="probability of a response with a wrong CRC", type=float, default=0.0)
+    parser.add_argument("--drop", help="probability of a dropped response", type=float, default=0.0)
+    parser.add_argument("--garbage", help="probability of garbage bytes before a response", type=float,
+                        default=0.0)
+    parser.add_argument("--seed", help="seed of the random number generator of the boiler", type=int)
+    parser.add_argument("--replay", help="answer with the responses recorded in this trace file (written by the "
+                                         "proxy with --trace) instead; the default request lines are the "
+                                         "recorded requests")
+    parser.add_argument("--replay-speed", help="factor by which to speed up the recorded responses", type=float,
+                        default=1.0)
+    parser.add_argument("--json", help="write the results as JSON to this file ('-' for standard output)")
+    parser.add_argument("--baseline", help="compare the results with this JSON file written earlier")
+    parser.add_argument("--tolerance", help="allowed relative regression against the baseline", type=float,
+                        default=0.1)
+    parser.add_argument("proxy_args", help="arguments passed on to the proxy after '--'", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    proxy_args = args.proxy_args[1:] if args.proxy_args[:1] == ["--"] else args.proxy_args
+    replay = ReplayPort(args.replay, speed=args.replay_speed) if args.replay else None
+    if args.line:
+        lines = [line.encode("ascii") for line in args.line]
+    elif replay is not None:
+        # The recorded requests, in the order of their first occurrence, without the frame envelope
+        lines = list(dict.fromkeys(exchange.request[4:-1].hex().encode("ascii")
+                                   for exchange in read_trace(args.replay)))
+    else:
+        lines = [b"300000000100040076", b"51", b"30005d"]
+
+    boiler = SimulatedBoiler(latency=args.latency, jitter=args.jitter, bad_crc=args.bad_crc, drop=args.drop,
+                             garbage=args.garbage, seed=args.seed, replay=replay)
+    proxy = ProxyProcess(boiler.open(), args.port, proxy_args)
+    results = []
+    try:
+        proxy.wait_until_listening()
+        for clients in args.clients:
+            run = run_benchmark(args.port, clients, args.requests, lines, proxy, boiler)
+            results.append(run)
+            print("{clients:3d} clients: {commands_per_second:8.1f} commands/s, p50 {p50}, p99 {p99}, "
+                  "CPU {cpu_percent:5.1f}%, {boiler_requests} sent to boiler, {errors} errors".format(
+                      p50=format_milliseconds(run["latency"]["p50"]), p99=format_milliseconds(run["latency"]["p99"]),
+                      **run), file=sys.stderr)
+    finally:
+        proxy.stop()
+        boiler.close()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"requests": args.requests, "lines": [line.decode("ascii") for line in lines],
+                     "latency": args.latency, "jitter": args.jitter, "bad_crc": args.bad_crc, "drop": args.drop,
+                     "garbage": args.garbage, "seed": args.seed, "replay": args.replay,
+                     "replay_speed": args.replay_speed, "proxy_args": proxy_args},
+        "boiler": boiler.counters,
+        "results": results,
+    }
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Clients of the line protocol of the Fröling proxy server, with the interface of :py:class:`froeling_lib.Froeling`.
+"""
+
+import collections
+import importlib
+import socket
+import sys
+import threading
+from concurrent.futures import Future
+
+import froeling_lib
+from froeling_lib import SerialPortIOError, ResponseReadError
+
+# Commands
+CMD_AKTUELLE_WERTE_DES_KESSELS = 0x30
+CMD_KESSELZUSTAND_ABFRAGEN = 0x51
+
+# Exception classes of errors reported by the proxy, by name
+_ERRORS = {cls.__name__: cls for cls in [
+    froeling_lib.SerialPortIOError, froeling_lib.ResponseReadError, froeling_lib.NoResponseError,
+    froeling_lib.WrongResponseHeaderError, froeling_lib.WrongResponseCRCError, froeling_lib.WrongCommandInResponse,
+    froeling_lib.IncompleteResponseError,
+]}
+
+
+class ProxyError(ResponseReadError):
+    """
+    An error reported by the proxy that does not correspond to an exception of :py:mod:`froeling_lib`, e.g.
+    an invalid request.
+    """
+    pass
+
+
+def parse_response(line):
+    """
+    :param line: a response line of the line protocol, without the line terminator
+    :return: bytes of the response
+    :raise SerialPortIOError, ResponseReadError: the line reports an error
+    """
+    if line.startswith(b"!"):
+        name, _, message = line[1:].decode("UTF-8", "replace").partition(": ")
+        cls = _ERRORS.get(name)
+        if cls is None:
+            raise ProxyError("{}: {}".format(name, message))
+        # Bypass the constructors, which format their messages from other arguments
+        raise cls.__new__(cls, message)
+    return bytes.fromhex(line.decode())
+
+
+def _message(command, parameters):
+    return (bytes(command) if hasattr(command, "__iter__") else bytes([command])) + b"".join(map(bytes, parameters))
+
+
+def _encode(messages):
+    return b"".join(message.hex().encode() + b"\n" for message in messages)
+
+
+def __getattr__(name):
+    # The asyncio client is imported only when first used, so that synchronous clients start faster
+    if name == "AsyncFroelingClient":
+        return importlib.import_module("froeling_client.async_client").AsyncFroelingClient
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class FroelingClient:
+    """
+    A client of the proxy server's line protocol, which can be used instead of a
+    :py:class:`froeling_lib.Froeling` object talking to the boiler directly.
+
+    The client keeps a pool of persistent TCP connections to the proxy and pipelines requests: they are
+    written to the least busy connection without waiting for the responses to earlier ones, and each
+    connection has a thread reading the responses, which arrive in the order of requests. Connections are
+    opened when first needed and reopened after they are closed. Many requests are best sent at once with
+    :py:meth:`submit`, which costs a single round-trip.
+
+    Errors reported by the proxy (lines starting with an exclamation mark) are raised as the exceptions of
+    :py:mod:`froeling_lib` with the same names (or :py:class:`ProxyError`), and failures of the connection
+    itself as :py:class:`froeling_lib.SerialPortIOError`. Like a :py:class:`froeling_lib.Froeling` object,
+    the client counts the bytes it sends and receives in the attributes `bytes_sent` and `bytes_received`.
+
+    The client can be used as a context manager, which closes it on exit.
+
+    :param host: host name or address of the proxy
+    :param port: TCP port of the proxy
+    :param connections: maximum number of connections to open
+    :param priority: priority class to request for the connections (with the `#priority` proxy command), or
+        None to use the port's default
+    :param connect_timeout: number of seconds to wait for a connection to be established
+    """
+    def __init__(self, host, port, connections=2, priority=None, connect_timeout=5.0):
+        if connections < 1:
+            raise ValueError("connections must be positive")
+        self.host = host
+        self.port = port
+        self.priority = priority
+        self.connect_timeout = connect_timeout
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._connections = [None] * connections
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def connect(self):
+        """
+        Open a connection to the proxy now, rather than when the first request is sent, e.g. to check that
+        the proxy is running.
+
+        :raise SerialPortIOError: the connection could not be established
+        """
+        try:
+            self._connection()
+        except OSError as e:
+            raise SerialPortIOError("Error connecting to proxy: {}".format(e))
+
+    def submit(self, messages):
+        """
+        Send requests to the proxy without waiting for the responses.
+
+        :param messages: list of bytes objects, each with a command byte followed by its parameters
+        :return: list of :py:class:`concurrent.futures.Future` objects resolved with the responses (bytes objects)
+        """
+        futures = [Future() for _ in messages]
+        if not messages:
+            return futures
+        try:
+            connection = self._connection()
+            connection.send(_encode(messages), futures)
+        except OSError as e:
+            error = SerialPortIOError("Error communicating with proxy: {}".format(e))
+            for future in futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+        return futures
+
+    def send_command(self, command, *parameters):
+        """
+        Send a command to the proxy and wait for the response, like
+        :py:meth:`froeling_lib.Froeling.send_command`.
+        """
+        return self.submit([_message(command, parameters)])[0].result()
+
+    def read_state(self):
+        """
+        :return: response to the request for boiler status (bytes object)
+        """
+        return self.send_command(CMD_KESSELZUSTAND_ABFRAGEN)
+
+    def read_values(self, *values):
+        """
+        :param values: bytes object containing a concatenation of 2-byte addresses of the requested values
+        :return: response to the request for the values (bytes object)
+        """
+        return self.send_command(CMD_AKTUELLE_WERTE_DES_KESSELS, *values)
+
+    def close(self):
+        """
+        Close all connections; requests waiting for responses fail.
+        """
+        with self._condition:
+            connections, self._connections = self._connections, [None] * len(self._connections)
+            self._condition.notify_all()
+        for connection in connections:
+            if isinstance(connection, _Connection):
+                connection.close()
+
+    def _connection(self):
+        """
+        :return: the open connection with the fewest requests waiting for responses, opening a new one if
+            there are fewer than the maximum and all open ones are busy
+        """
+        # The slot of a new connection is reserved while it is being established, outside the lock, so that
+        # a slow or unreachable proxy does not hold up threads that can use the connections already open
+        reservation = object()
+        with self._condition:
+            while True:
+                for i, connection in enumerate(self._connections):
+                    if isinstance(connection, _Connection) and connection.closed:
+                        self._connections[i] = None
+                open_connections = [connection for connection in self._connections
+                                    if isinstance(connection, _Connection)]
+                least_busy = min(open_connections, key=lambda c: len(c.pending), default=None)
+                if least_busy is not None and (not least_busy.pending or None not in self._connections):
+                    return least_busy
+                if None in self._connections:
+                    index = self._connections.index(None)
+                    self._connections[index] = reservation
+                    break
+                # All slots are reserved by connections being established
+                self._condition.wait()
+        try:
+            connection = _Connection(self)
+        except BaseException:
+            with self._condition:
+                if self._connections[index] is reservation:
+                    self._connections[index] = None
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            reserved = self._connections[index] is reservation
+            if reserved:
+                self._connections[index] = connection
+            self._condition.notify_all()
+        if not reserved:
+            # The client was closed while the connection was being established
+            connection.close()
+            raise OSError("client closed")
+        return connection
+
+
+class _Connection:
+    def __init__(self, client):
+        self.client = client
+        self.sock = socket.create_connection((client.host, client.port), timeout=client.connect_timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pending = collections.deque()
+        self.closed = False
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        if client.priority is not None:
+            self.send("#priority {}\n".format(client.priority).encode(), [None])
+        threading.Thread(target=self._read, name="froeling-client", daemon=True).start()
+
+    def send(self, data, futures):
+        """
+        :param data: request lines
+        :param futures: futures to resolve with the responses to the lines, in order (None for lines whose
+            responses are to be ignored)
+        """
+        # The reader thread must be able to take responses from pending while a large request is being sent,
+        # or neither side makes progress once the proxy stops reading; so only the senders are serialised
+        # for the whole write, which keeps the order of pending the same as that of the requests
+        with self._send_lock:
+            with self._lock:
+                if self.closed:
+                    raise OSError("connection closed")
+                self.pending.extend(futures)
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                raise
+            self.client.bytes_sent += len(data)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _read(self):
+        try:
+            with self.sock.makefile("rb") as f:
+                for line in f:
+                    self.client.bytes_received += len(line)
+                    line = line.rstrip(b"\r\n")
+                    if line.startswith(b"*"):
+                        continue  # notification of a subscription; the client does not subscribe
+                    with self._lock:
+                        future = self.pending.popleft() if self.pending else None
+                    if future is None or not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        future.set_result(parse_response(line))
+                    except Exception as e:
+                        future.set_exception(e)
+        except Exception as e:
+            if not self.closed:
+                print("Error reading from proxy: {}".format(e), file=sys.stderr)
+        finally:
+            with self._lock:
+                self._close()
+                pending, self.pending = self.pending, collections.deque()
+            self.sock.close()
+            error = SerialPortIOError("Connection to proxy closed")
+            for future in pending:
+                if future is not None and future.set_running_or_notify_cancel():
+                    future.set_exception(error)
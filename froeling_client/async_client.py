@@ -0,0 +1,191 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import sys
+
+from froeling_lib import SerialPortIOError
+from froeling_client import CMD_AKTUELLE_WERTE_DES_KESSELS, CMD_KESSELZUSTAND_ABFRAGEN, parse_response, _encode, \
+    _message
+
+
+class AsyncFroelingClient:
+    """
+    Like :py:class:`froeling_client.FroelingClient`, but for asyncio: the methods are coroutines, and the responses are
+    read by a task per connection instead of a thread. The client must be used (and closed) in a single
+    event loop. It can be used as an asynchronous context manager, which closes it on exit.
+
+    :param host: host name or address of the proxy
+    :param port: TCP port of the proxy
+    :param connections: maximum number of connections to open
+    :param priority: priority class to request for the connections (with the `#priority` proxy command), or
+        None to use the port's default
+    :param connect_timeout: number of seconds to wait for a connection to be established
+    """
+    def __init__(self, host, port, connections=2, priority=None, connect_timeout=5.0):
+        if connections < 1:
+            raise ValueError("connections must be positive")
+        self.host = host
+        self.port = port
+        self.priority = priority
+        self.connect_timeout = connect_timeout
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._connections = [None] * connections
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def submit(self, messages):
+        """
+        Send requests to the proxy without waiting for the responses.
+
+        :param messages: list of bytes objects, each with a command byte followed by its parameters
+        :return: list of :py:class:`asyncio.Future` objects resolved with the responses (bytes objects)
+        """
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in messages]
+        if not messages:
+            return futures
+        try:
+            await self._connection().send(_encode(messages), futures)
+        except OSError as e:
+            error = SerialPortIOError("Error communicating with proxy: {}".format(e))
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+        return futures
+
+    async def send_command(self, command, *parameters):
+        """
+        Send a command to the proxy and wait for the response, like
+        :py:meth:`froeling_lib.Froeling.send_command`.
+        """
+        return await (await self.submit([_message(command, parameters)]))[0]
+
+    async def read_state(self):
+        """
+        :return: response to the request for boiler status (bytes object)
+        """
+        return await self.send_command(CMD_KESSELZUSTAND_ABFRAGEN)
+
+    async def read_values(self, *values):
+        """
+        :param values: bytes object containing a concatenation of 2-byte addresses of the requested values
+        :return: response to the request for the values (bytes object)
+        """
+        return await self.send_command(CMD_AKTUELLE_WERTE_DES_KESSELS, *values)
+
+    async def close(self):
+        """
+        Close all connections; requests waiting for responses fail.
+        """
+        connections, self._connections = self._connections, [None] * len(self._connections)
+        await asyncio.gather(*(connection.close() for connection in connections if connection is not None))
+
+    def _connection(self):
+        """
+        :return: the open connection with the fewest requests waiting for responses, opening a new one if
+            there are fewer than the maximum and all open ones are busy
+        """
+        self._connections = [None if connection is not None and connection.closed else connection
+                             for connection in self._connections]
+        open_connections = [connection for connection in self._connections if connection is not None]
+        least_busy = min(open_connections, key=lambda c: len(c.pending), default=None)
+        if least_busy is not None and (not least_busy.pending or len(open_connections) == len(self._connections)):
+            return least_busy
+        connection = _AsyncConnection(self)
+        self._connections[self._connections.index(None)] = connection
+        return connection
+
+
+class _AsyncConnection:
+    def __init__(self, client):
+        self.client = client
+        self.pending = collections.deque()
+        self.closed = False
+        self.writer = None
+        self._reader_task = None
+        # Opened in the background, so concurrent requests share the connection while it is being opened
+        self._opened = asyncio.ensure_future(self._open())
+
+    async def _open(self):
+        try:
+            reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.client.host, self.client.port), self.client.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.closed = True
+            raise OSError(e)
+        if self.client.priority is not None:
+            self._write("#priority {}\n".format(self.client.priority).encode(), [None])
+        self._reader_task = asyncio.ensure_future(self._read(reader))
+
+    async def send(self, data, futures):
+        """
+        :param data: request lines
+        :param futures: futures to resolve with the responses to the lines, in order
+        """
+        await asyncio.shield(self._opened)
+        if self.closed:
+            raise OSError("connection closed")
+        self._write(data, futures)
+        await self.writer.drain()
+
+    def _write(self, data, futures):
+        self.pending.extend(futures)
+        self.writer.write(data)
+        self.client.bytes_sent += len(data)
+
+    async def close(self):
+        self.closed = True
+        try:
+            await self._opened
+        except OSError:
+            return
+        self.writer.close()
+        self._reader_task.cancel()
+        await asyncio.gather(self._reader_task, return_exceptions=True)
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.client.bytes_received += len(line)
+                line = line.rstrip(b"\r\n")
+                if line.startswith(b"*"):
+                    continue  # notification of a subscription; the client does not subscribe
+                future = self.pending.popleft() if self.pending else None
+                if future is None or future.done():
+                    continue
+                try:
+                    future.set_result(parse_response(line))
+                except Exception as e:
+                    future.set_exception(e)
+        except Exception as e:
+            if not self.closed:
+                print("Error reading from proxy: {}".format(e), file=sys.stderr)
+        finally:
+            self.closed = True
+            self.writer.close()
+            pending, self.pending = self.pending, collections.deque()
+            error = SerialPortIOError("Connection to proxy closed")
+            for future in pending:
+                if future is not None and not future.done():
+                    future.set_exception(error)
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from serial import Serial, SerialException
+import collections
+import functools
+import operator
+import threading
+import time
 
 
 class ConnectionInitializationError(Exception):
@@ -54,6 +58,263 @@ class IncompleteResponseError(ResponseReadError):
         super(IncompleteResponseError, self).__init__("Expected {} bytes after frame header, received {}".format(declared_len, actual_len))
 
 
+class FrameDecoder:
+    """
+    An incremental decoder of frames received from the boiler. Received bytes are fed to the decoder as they
+    arrive, and complete frames are taken from it with :py:meth:`next_frame` as soon as their last byte has
+    been fed. Any bytes preceding the frame header (02fd) are discarded, so the decoder resynchronises with
+    the stream of frames after line noise or a partially received frame. A header declaring a length above
+    `max_message_length`, or a frame with a wrong CRC value containing another header, is taken to be such
+    noise or a truncated frame, and the search for a header is restarted at its second byte.
+
+    :param max_message_length: maximum length of the message (command and payload) of a frame; default is
+        :py:attr:`Froeling.MAX_MESSAGE_LENGTH`
+    """
+    def __init__(self, max_message_length=None):
+        self.max_message_length = Froeling.MAX_MESSAGE_LENGTH if max_message_length is None else max_message_length
+        self.buffer = bytearray()
+        self.discarded = 0
+
+    def feed(self, data):
+        """
+        :param data: received bytes (bytes-like object)
+        """
+        self.buffer += data
+
+    def next_frame(self):
+        """
+        Take the next complete frame from the buffer.
+
+        :return: tuple of the message (bytes object with the command byte followed by payload), the CRC value
+            computed from the frame, and the CRC value received; or None if there is no complete frame
+        """
+        buffer = self.buffer
+        while True:
+            start = buffer.find(Froeling.BLOCK_START)
+            if start < 0:
+                # Keep the last byte if it may be the first byte of a frame header
+                start = len(buffer) - 1 if buffer.endswith(Froeling.BLOCK_START[:1]) else len(buffer)
+            if start:
+                del buffer[:start]
+                self.discarded += start
+            if len(buffer) < 4:
+                return None
+            length = int.from_bytes(buffer[2:4], "big")
+            if length > self.max_message_length:
+                self._skip_header()
+                continue
+            end = 4 + length
+            if len(buffer) <= end:
+                return None
+            with memoryview(buffer) as view:
+                message = bytes(view[4:end])
+                expected_crc = _compute_crc(view[:end])
+            actual_crc = buffer[end]
+            if expected_crc != actual_crc and buffer.find(Froeling.BLOCK_START, 1, end + 1) >= 0:
+                # Most likely a truncated frame followed by another one, rather than a frame with a wrong CRC
+                self._skip_header()
+                continue
+            del buffer[:end + 1]
+            return message, expected_crc, actual_crc
+
+    def _skip_header(self):
+        del self.buffer[:1]
+        self.discarded += 1
+
+    def bytes_needed(self):
+        """
+        :return: the number of bytes that have to be fed to the decoder at least for it to possibly return
+            a complete frame (at least 1)
+        """
+        if len(self.buffer) < 4:
+            return 4 - len(self.buffer)
+        return max(1, 5 + int.from_bytes(self.buffer[2:4], "big") - len(self.buffer))
+
+    def incomplete_frame_lengths(self):
+        """
+        :return: a tuple of the number of bytes declared to follow the frame header (including CRC) and
+            the number of bytes received after the header, if the buffer holds a frame with a complete header;
+            None otherwise
+        """
+        if len(self.buffer) < 4 or not self.buffer.startswith(Froeling.BLOCK_START):
+            return None
+        return 1 + int.from_bytes(self.buffer[2:4], "big"), len(self.buffer) - 4
+
+
+class ResponseCache:
+    """
+    A size-bounded cache of responses to commands that only read data from the boiler, to be used with
+    :py:class:`Froeling`. Responses are keyed by the command byte and parameters, and expire after
+    a configurable time (TTL) that may differ per command. When the cache is full, the least recently
+    used response is evicted.
+
+    Hits and misses are counted in the attributes `hits` and `misses`; note that these count lookups,
+    so a single command may be counted more than once if it is looked up by several layers (e.g. by
+    a proxy before being queued and by :py:class:`Froeling` before being sent).
+
+    :param commands: command bytes whose responses may be cached (an allow-list); default are reading
+        values (0x30) and boiler state (0x51)
+    :param ttl: number of seconds for which a response is valid, unless specified for its command
+        in `ttls`
+    :param ttls: dict mapping command bytes (of those in `commands`) to number of seconds for which their
+        responses are valid
+    :param max_entries: maximum number of responses kept in the cache
+    :raise ValueError: max_entries is not positive, or ttls has commands that may not be cached
+    """
+    def __init__(self, commands=(0x30, 0x51), ttl=2.0, ttls=None, max_entries=1024):
+        if max_entries < 1:
+            raise ValueError("max_entries must be positive")
+        self.ttls = {command: ttl for command in commands}
+        not_cacheable = set(ttls or {}) - set(self.ttls)
+        if not_cacheable:
+            raise ValueError("Commands in ttls that may not be cached: " +
+                             ", ".join("{:02X}".format(command) for command in sorted(not_cacheable)))
+        self.ttls.update(ttls or {})
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, message):
+        """
+        :param message: command byte followed by parameters (bytes object)
+        :return: the cached response (bytes object), or None if there is no valid response cached
+        """
+        with self._lock:
+            entry = self._entries.get(message)
+            if entry is not None:
+                expires, response = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(message)
+                    self.hits += 1
+                    return response
+                del self._entries[message]
+            self.misses += 1
+            return None
+
+    def put(self, message, response):
+        """
+        Store the response to the given message, if its command may be cached.
+
+        :param message: command byte followed by parameters (bytes object)
+        :param response: response payload (bytes object)
+        """
+        ttl = self.ttls.get(message[0]) if message else None
+        if not ttl:
+            return
+        with self._lock:
+            self._entries[message] = (time.monotonic() + ttl, response)
+            self._entries.move_to_end(message)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all cached responses.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class LatencyTracker:
+    """
+    Measures how long the boiler takes to start responding to each command (the time from sending
+    a request to receiving the first byte of the response) and derives timeouts from these measurements,
+    so that a request the boiler has dropped is detected as soon as its response is overdue, instead of
+    after a fixed timeout that must accommodate the slowest command.
+
+    The timeout for the first byte of the response to a command is the given percentile of the latencies
+    of its last successful exchanges multiplied by the given factor, limited to the range between minimum
+    and maximum. Until enough latencies of a command have been measured, and for the next request after
+    a timeout (in case the boiler has become slower), the maximum is used. Once the first byte has been
+    received, the rest of the response must follow within the inter-byte timeout plus the time needed to
+    transmit it.
+
+    :param percentile: percentile of measured latencies to base the timeouts on (between 0 and 1)
+    :param factor: factor to multiply the percentile with
+    :param minimum: minimum timeout in seconds
+    :param maximum: maximum timeout in seconds
+    :param inter_byte_timeout: maximum number of seconds of silence within a response
+    :param window: number of latest latencies kept for each command
+    :param min_samples: number of latencies of a command needed before the timeout is adapted
+    """
+    # Time needed to transmit one byte at 57600 baud with a start and a stop bit
+    BYTE_TIME = 10 / 57600
+
+    def __init__(self, percentile=0.95, factor=3.0, minimum=0.05, maximum=1.0, inter_byte_timeout=0.05,
+                 window=100, min_samples=10):
+        if not 0 < percentile <= 1:
+            raise ValueError("percentile must be between 0 and 1")
+        self.percentile = percentile
+        self.factor = factor
+        self.minimum = minimum
+        self.maximum = maximum
+        self.inter_byte_timeout = inter_byte_timeout
+        self.window = window
+        self.min_samples = min_samples
+        self.timeouts = 0
+        self._latencies = {}
+        self._timed_out = set()
+        self._lock = threading.Lock()
+
+    def record(self, command, latency):
+        """
+        Record the latency of a successful exchange.
+
+        :param command: command byte (int)
+        :param latency: number of seconds between sending the request and receiving the first byte
+        """
+        with self._lock:
+            latencies = self._latencies.get(command)
+            if latencies is None:
+                latencies = self._latencies[command] = collections.deque(maxlen=self.window)
+            latencies.append(latency)
+            self._timed_out.discard(command)
+
+    def record_timeout(self, command):
+        """
+        Record that no response to the command was received in time.
+
+        :param command: command byte (int)
+        """
+        with self._lock:
+            self.timeouts += 1
+            self._timed_out.add(command)
+
+    def latency(self, command):
+        """
+        :param command: command byte (int)
+        :return: the configured percentile of the measured latencies of the command in seconds, or None if
+            none have been measured
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(command, ()))
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(self.percentile * len(latencies)))]
+
+    def timeout(self, command):
+        """
+        :param command: command byte (int)
+        :return: number of seconds to wait for the first byte of the response to the command
+        """
+        with self._lock:
+            if command in self._timed_out or len(self._latencies.get(command, ())) < self.min_samples:
+                return self.maximum
+        return min(self.maximum, max(self.minimum, self.factor * self.latency(command)))
+
+    def body_timeout(self, length):
+        """
+        :param length: number of bytes still expected
+        :return: number of seconds to wait for them once a response has started
+        """
+        return min(self.maximum, self.inter_byte_timeout + length * LatencyTracker.BYTE_TIME)
+
+
 class Froeling:
     """
     A connection to a Fröling boiler via a serial link.
@@ -66,82 +327,208 @@ class Froeling:
         :py:class:`froeling_lib.WrongResponseCRCError`; default is True because experiments have shown that S4 Turbo
         apparently sometimes computes the CRC wrongly as in the following example response
         that could be reproduced over and over again: `02fd000330fffe00` (should be `84` instead of `00`)
+    :param cache: a :py:class:`ResponseCache` to answer repeated commands from, instead of sending them
+        to the boiler; default is None (no caching)
+    :param latency: a :py:class:`LatencyTracker` to adapt read timeouts to the measured response latency
+        of each command; default is None (the timeout of the serial port, 1 second, is used for all reads).
+        Timeouts can only be changed on ports with a settable `timeout` attribute, like pyserial's Serial.
+    :param trace: a :py:class:`froeling_lib.trace.TraceWriter` to record every exchange with the boiler to,
+        e.g. to replay it later with :py:class:`froeling_lib.trace.ReplayPort`; default is None (no recording)
+    :param max_message_length: maximum length of the message (command and payload) of a received frame;
+        headers declaring longer ones are taken to be line noise (see :py:class:`FrameDecoder`). Default is
+        :py:attr:`MAX_MESSAGE_LENGTH`, enough for reading 256 values; raise it to relay other commands with
+        longer responses, up to 65535.
     :raise ConnectionInitializationError: problem setting up the serial port
+
+    The numbers of bytes written to and read from the serial port, and of bytes read but discarded because
+    they were not part of a frame, are counted in the attributes `bytes_sent`, `bytes_received` and
+    `bytes_discarded`.
     """
     BLOCK_START = bytes([0x02, 0xfd])
+    # Default maximum length of a message in a frame: the command byte followed by 256 values
+    MAX_MESSAGE_LENGTH = 1 + 256 * 2
 
-    def __init__(self, tty, ignore_crc=True):
+    def __init__(self, tty, ignore_crc=True, cache=None, latency=None, trace=None,
+                 max_message_length=MAX_MESSAGE_LENGTH):
+        if not 0 < max_message_length <= 0xffff:
+            raise ValueError("max_message_length must be between 1 and 65535")
         if hasattr(tty, "write") and hasattr(tty, "read") and hasattr(tty, "reset_input_buffer"):
             self.port = tty
         else:
+            # Imported only when needed, so that programs talking to the boiler through a proxy start faster
+            from serial import Serial, SerialException
             try:
                 self.port = Serial(tty, 57600, timeout=1, write_timeout=1)
             except SerialException as e:
                 raise ConnectionInitializationError(e)
         self.ignore_crc = ignore_crc
+        self.cache = cache
+        self.latency = latency
+        self.trace = trace
+        self.max_message_length = max_message_length
+        # Number of bytes received in an exchange without the response after which reading is given up, so
+        # that a line carrying nothing but noise or frames for other commands does not block it forever
+        self.max_received_bytes = 4 * (5 + max_message_length)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_discarded = 0
+        self._port_timeout = getattr(self.port, "timeout", None)
+        self._default_timeout = self._port_timeout
 
-    def send_command(self, command, *parameters):
+    def send_command(self, command, *parameters, deadline=None):
         """
         Send the given command (one byte) and parameters (a list of objects like bytes or lists of ints)
         via serial interface and return response (bytes object). Note that the frame header (02fd) and
         message length are prepended and a checksum is appended to the request. Likewise, the frame header,
         message length AND COMMAND are stripped from the beginning of the response, and the checksum is
-        likewise not returned.
+        likewise not returned. Any bytes received before the frame header and any frames with other commands
+        are skipped (see :py:class:`FrameDecoder`). If a :py:class:`ResponseCache` is used and holds a valid response to the same
+        command and parameters, that response is returned without communicating with the boiler.
 
         :param command: command (Befehl) to send via interface (int, list of ints of length 1, bytes
             object of length 1...)
         :param parameters: command parameters to send via interface (list of ints, bytes object...)
+        :param deadline: maximum number of seconds to wait for the response; default is no limit other
+            than the read timeouts
         :return: bytes object with response payload stripped of frame envelope and command byte
         :raise SerialPortIOError: I/O error on writing to or reading from the serial port
-        :raise NoResponseError: no response was received on serial port within 1 second
-        :raise WrongResponseHeaderError: received data did not begin with bytes 0x02FD or less than 4
-            bytes were received
-        :raise IncompleteResponseError: within 1 second, less than the number of bytes declared
+        :raise NoResponseError: no response was received on serial port within the timeout
+        :raise WrongResponseHeaderError: received data did not contain bytes 0x02FD followed by a frame
+            length
+        :raise IncompleteResponseError: within the timeout, less than the number of bytes declared
             in the header were received
-        :raise WrongResponseCRCError: the last received byte did not contain a correct CRC value
-        :raise WrongCommandInResponse: the command in received response did not match the one in
-            the request sent
+        :raise WrongResponseCRCError: the last byte of a received frame did not contain a correct CRC value
+        :raise WrongCommandInResponse: frames were received, but the command in none of them matched
+            the one in the request sent
         """
-        message = bytes(command) if hasattr(command, "__iter__") else bytes([command]) + \
-                                                                      bytes([value for parameter in parameters for value in parameter])
-        frame = Froeling.BLOCK_START + len(message).to_bytes(2, "big") + message
-        frame_and_crc = frame + bytes([_compute_crc(frame)])
+        if deadline is not None:
+            deadline += time.monotonic()
+        message = (bytes(command) if hasattr(command, "__iter__") else bytes([command])) + \
+            b"".join(map(bytes, parameters))
+        if self.cache is not None:
+            response = self.cache.get(message)
+            if response is not None:
+                return response
+
+        frame = encode_frame(message)
 
-        self.port.reset_input_buffer()
         try:
-            self.port.write(bytes(frame_and_crc))
-            response_header = self.port.read(4)
+            self.port.reset_input_buffer()
+            self.port.write(frame)
         except Exception as e:
             raise SerialPortIOError(e)
+        self.bytes_sent += len(frame)
+        written = time.monotonic()
+
+        decoder = FrameDecoder(self.max_message_length)
+        reads = [] if self.trace is not None else None
+        try:
+            response = self._read_response(message[0], deadline, decoder, reads)
+        finally:
+            self.bytes_discarded += decoder.discarded
+            if reads is not None:
+                self.trace.record(written, frame, reads)
+        if self.cache is not None:
+            self.cache.put(message, response)
+        return response
+
+    def _read_response(self, command, deadline, decoder, reads=None):
+        """
+        Read frames from the serial port until a frame with a response to the given command is received,
+        skipping any other bytes, or until nothing is received within the timeout, the deadline passes or
+        `max_received_bytes` have been received.
 
-        if len(response_header) == 0:
+        :param deadline: value of time.monotonic() by which the response must be received, or None
+        :param decoder: the :py:class:`FrameDecoder` to decode the received bytes with
+        :param reads: list to append a pair of the time (from time.monotonic()) and the bytes returned to for
+            each read, or None
+        :return: payload of the response (bytes object without the command and CRC)
+        """
+        received = bytearray()
+        other_command = None
+        sent = time.monotonic()
+        first_byte_latency = None
+        while True:
+            needed = decoder.bytes_needed()
+            if self.latency is None:
+                timeout = self._default_timeout
+            elif received:
+                timeout = self.latency.body_timeout(needed)
+            else:
+                timeout = self.latency.timeout(command)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                self._set_timeout(timeout)
+                data = self.port.read(needed)
+            except Exception as e:
+                raise SerialPortIOError(e)
+            if reads is not None:
+                reads.append((time.monotonic(), bytes(data)))
+            if not data:
+                break
+            if not received:
+                first_byte_latency = time.monotonic() - sent
+            self.bytes_received += len(data)
+            received += data
+            decoder.feed(data)
+            for message, expected_crc, actual_crc in iter(decoder.next_frame, None):
+                if expected_crc != actual_crc and not self.ignore_crc:
+                    raise WrongResponseCRCError(expected_crc, actual_crc)
+                if message and message[0] == command:
+                    if self.latency is not None:
+                        self.latency.record(command, first_byte_latency)
+                    return message[1:]  # Skip command ("Befehl")
+                if message:
+                    other_command = message[0]
+            if len(received) >= self.max_received_bytes:
+                break
+
+        if not received:
+            if self.latency is not None:
+                self.latency.record_timeout(command)
             raise NoResponseError()
+        if other_command is not None:
+            raise WrongCommandInResponse(command, other_command)
+        incomplete = decoder.incomplete_frame_lengths()
+        if incomplete is not None:
+            raise IncompleteResponseError(*incomplete)
+        raise WrongResponseHeaderError(bytes(received))
 
-        if len(response_header) < 4 or response_header[0:2] != bytes([0x02, 0xfd]):
-            raise WrongResponseHeaderError(response_header)
+    def _set_timeout(self, timeout):
+        """
+        Set the read timeout of the serial port, if it differs from the current one and the port allows it.
+        """
+        if timeout != self._port_timeout and hasattr(self.port, "timeout"):
+            self.port.timeout = timeout
+            self._port_timeout = timeout
 
-        try:
-            response_len = 1 + int.from_bytes(response_header[2:4], "big")
-            response = self.port.read(response_len)
-        except Exception as e:
-            raise SerialPortIOError(e)
 
-        if len(response) < response_len:
-            raise IncompleteResponseError(response_len, len(response))
-        expected_crc = _compute_crc(response_header + response[:-1])
-        if expected_crc != response[-1] and not self.ignore_crc:
-            raise WrongResponseCRCError(expected_crc, response[-1])
-        if response[0] != message[0]:
-            raise WrongCommandInResponse(message[0], response[0])
-        return response[1:-1]  # Skip command ("Befehl") and CRC
+# Contribution of each byte value to the CRC, which is the XOR of contributions of all bytes of the frame
+_CRC_TABLE = bytes([(byte ^ (byte * 2 & 0xff)) for byte in range(256)])
+
+
+def encode_frame(message):
+    """
+    Wrap a message in a frame as sent to the boiler: the frame header (02fd), the message length and the
+    message, followed by a checksum.
+
+    :param message: the command byte followed by the parameters (bytes-like object)
+    :return: bytes object with the frame
+    """
+    frame = bytearray(Froeling.BLOCK_START)
+    frame += len(message).to_bytes(2, "big")
+    frame += message
+    frame.append(_compute_crc(frame))
+    return bytes(frame)
 
 
 def _compute_crc(frame):
     """
-    :param frame: iterable of bytes from which to compute CRC
+    :param frame: bytes-like object (or iterable of ints) from which to compute CRC
     :return: CRC value (int between 0 and 255)
     """
-    crc = 0
-    for byte in frame:
-        crc = (crc ^ byte ^ (byte * 2 & 0xff)) & 0xff
-    return crc
+    return functools.reduce(operator.xor, bytes(frame).translate(_CRC_TABLE), 0)
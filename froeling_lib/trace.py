@@ -0,0 +1,213 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Recording of the exchanges with a boiler into trace files, and playing them back.
+
+A trace file starts with the 4 bytes `FRT` and 0x01 (the version of the format), followed by a record for
+each exchange: the time the request was written (seconds since the trace was started, a big-endian
+double), the length of the request frame and the number of reads (two unsigned 16-bit integers), the
+request frame, and for each read the time it returned (seconds since the request was written, a float)
+and the number of bytes it returned (an unsigned 16-bit integer), followed by the bytes. A read returning
+no bytes is a read that timed out.
+"""
+
+import collections
+import struct
+import threading
+import time
+
+MAGIC = b"FRT\x01"
+
+_RECORD = struct.Struct(">dHH")
+_READ = struct.Struct(">fH")
+
+Exchange = collections.namedtuple("Exchange", ["time", "request", "reads"])
+Exchange.__doc__ = """
+An exchange with the boiler read from a trace file.
+
+:param time: time the request was written, in seconds since the trace was started
+:param request: the request frame written to the serial port (bytes object)
+:param reads: list of pairs of the time a read returned (in seconds since the request was written) and the
+    bytes it returned (empty if it timed out)
+"""
+
+
+class TraceWriter:
+    """
+    Writes the exchanges of a :py:class:`froeling_lib.Froeling` object given this writer (with the `trace`
+    argument) to a trace file. Each exchange is written as soon as it is complete, so the trace is complete
+    up to the last exchange even if the program is killed. The number of exchanges written is counted in
+    the attribute `exchanges`.
+
+    The writer can be used as a context manager, which closes it on exit.
+
+    :param path: path of the trace file to create
+    """
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self.exchanges = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, written, request, reads):
+        """
+        :param written: value of time.monotonic() when the request was written
+        :param request: the request frame (bytes object)
+        :param reads: list of pairs of the value of time.monotonic() when a read returned and the bytes it
+            returned
+        """
+        data = bytearray(_RECORD.pack(written - self._started, len(request), len(reads)))
+        data += request
+        for returned, received in reads:
+            data += _READ.pack(returned - written, len(received))
+            data += received
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            self.exchanges += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_trace(path):
+    """
+    :param path: path of a trace file written by :py:class:`TraceWriter`
+    :return: generator of :py:class:`Exchange` objects, in the order of the exchanges
+    :raise ValueError: the file is not a trace file or a record is truncated
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a trace file: {}".format(path))
+        while True:
+            header = f.read(_RECORD.size)
+            if not header:
+                return
+            written, request_length, count = _RECORD.unpack(_read_exactly(f, header, _RECORD.size))
+            request = _read_exactly(f, f.read(request_length), request_length)
+            reads = []
+            for _ in range(count):
+                returned, length = _READ.unpack(_read_exactly(f, f.read(_READ.size), _READ.size))
+                reads.append((returned, _read_exactly(f, f.read(length), length)))
+            yield Exchange(written, request, reads)
+
+
+def _read_exactly(f, data, length):
+    if len(data) != length:
+        raise ValueError("Truncated trace file: {}".format(f.name))
+    return data
+
+
+class ReplayPort:
+    """
+    A serial port that answers requests with the responses recorded in a trace, to be given to
+    :py:class:`froeling_lib.Froeling` instead of a TTY device. A request is answered with the response to
+    the next recorded exchange with the same request frame (cycling through them when all have been
+    replayed), so clients may send the recorded requests in any order and any number of times; requests
+    not in the trace are not answered. The bytes of the response arrive at the times they were received
+    when recording, relative to the time the request is written, divided by `speed`; like with pyserial,
+    a read returns when the requested number of bytes has arrived or when the `timeout` (in the time of
+    the recording) has passed.
+
+    The numbers of replayed exchanges and of requests not found in the trace are counted in the attributes
+    `exchanges` and `unmatched`.
+
+    :param trace: path of a trace file, or an iterable of :py:class:`Exchange` objects
+    :param speed: factor by which to speed up the responses (e.g. 10 to answer ten times faster than
+        recorded), or None to answer without any delays
+    """
+    def __init__(self, trace, speed=1.0):
+        if speed is not None and speed <= 0:
+            raise ValueError("speed must be positive")
+        self.speed = speed
+        self.timeout = 1.0
+        self.exchanges = 0
+        self.unmatched = 0
+        self._recorded = collections.defaultdict(list)
+        for exchange in read_trace(trace) if isinstance(trace, str) else trace:
+            self._recorded[bytes(exchange.request)].append(exchange)
+        self._replayed = collections.Counter()
+        self._written = time.monotonic()
+        self._clock = 0.0
+        self._chunks = collections.deque()
+        self._buffer = bytearray()
+
+    def next_exchange(self, request):
+        """
+        :param request: request frame (bytes object)
+        :return: the next recorded :py:class:`Exchange` with the given request, or None if there is none
+        """
+        exchanges = self._recorded.get(request)
+        if not exchanges:
+            self.unmatched += 1
+            return None
+        exchange = exchanges[self._replayed[request] % len(exchanges)]
+        self._replayed[request] += 1
+        self.exchanges += 1
+        return exchange
+
+    def write(self, data):
+        exchange = self.next_exchange(bytes(data))
+        self._written = time.monotonic()
+        self._clock = 0.0
+        self._chunks = collections.deque((returned, received) for returned, received in exchange.reads
+                                         if received) if exchange is not None else collections.deque()
+        self._buffer = bytearray()
+        return len(data)
+
+    def read(self, n):
+        timeout_at = None if self.timeout is None else self._elapsed() + self.timeout
+        while len(self._buffer) < n:
+            arrival = self._chunks[0][0] if self._chunks else None
+            if arrival is None or timeout_at is not None and arrival > timeout_at:
+                # Nothing more arrives in time; without a timeout, return rather than block forever
+                if timeout_at is not None:
+                    self._wait_until(timeout_at)
+                break
+            self._wait_until(arrival)
+            self._buffer += self._chunks.popleft()[1]
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    def reset_input_buffer(self):
+        elapsed = self._elapsed()
+        while self._chunks and self._chunks[0][0] <= elapsed:
+            self._chunks.popleft()
+        self._buffer = bytearray()
+
+    def _elapsed(self):
+        """
+        :return: time since the last request was written, in the time of the recording
+        """
+        if self.speed is None:
+            return self._clock
+        return (time.monotonic() - self._written) * self.speed
+
+    def _wait_until(self, elapsed):
+        if self.speed is None:
+            self._clock = max(self._clock, elapsed)
+            return
+        delay = (elapsed - self._elapsed()) / self.speed
+        if delay > 0:
+            time.sleep(delay)
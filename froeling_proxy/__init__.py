@@ -12,20 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from froeling_lib.__init__ import Froeling, SerialPortIOError, ResponseReadError
+import importlib
+import sys
+
+from froeling_lib import Froeling, SerialPortIOError, ResponseReadError
+from froeling_proxy.framing import LineFramer
 try:
+    import collections
     import socket
     import selectors
+    import time
     import types
 except ImportError as ex:
-    import sys
 
     print("Error importing requirements for socket server; it will not work: " + str(ex), file=sys.stderr)
 
+# Classes of the package imported from their modules only when first used, so that one-shot queries (like
+# `python -m froeling_proxy --state`) do not pay for importing asyncio, http.server, the client library and
+# other modules only the servers need
+_LAZY_EXPORTS = {
+    "AsyncFroelingProxyServer": "froeling_proxy.async_server",
+    "Catalog": "froeling_proxy.catalog",
+    "CatalogEntry": "froeling_proxy.catalog",
+    "HttpApiServer": "froeling_proxy.http_api",
+    "Metrics": "froeling_proxy.metrics",
+    "MetricsHttpServer": "froeling_proxy.metrics",
+    "Poller": "froeling_proxy.poller",
+    "SerialWorker": "froeling_proxy.worker",
+    "SubscriptionManager": "froeling_proxy.subscriptions",
+    "TimeSeriesStore": "froeling_proxy.store",
+    "UpstreamPool": "froeling_proxy.upstream",
+    "UpstreamWorker": "froeling_proxy.upstream",
+}
+
 # Commands
 CMD_AKTUELLE_WERTE_DES_KESSELS = 0x30
 CMD_KESSELZUSTAND_ABFRAGEN = 0x51
 
+# Flag of code objects of functions taking *args (inspect.CO_VARARGS)
+_CO_VARARGS = 0x04
+
+
+class ProxyCommandError(Exception):
+    pass
+
 
 def read_state(froeling):
     """
@@ -71,74 +101,388 @@ class FroelingProxyServer:
     including length, and a CRC) and communication with a Fröling boiler over a serial connection.
 
     This proxy can handle multiple concurrent connections, however, only one command will be issued
-    and completed (i.e. its response read) at once.
+    and completed (i.e. its response read) at once. The commands are relayed to the boiler by a
+    :py:class:`froeling_proxy.worker.SerialWorker` thread, so the connections keep being served while
+    a command is in flight. A client may send several lines at once without waiting for the responses;
+    they are all queued for execution together and their responses are sent back in the same order.
 
-    If any invalid characters are received (i.e. anything except numbers, lowercase or uppercase
-    letters A-F or CR or LF), the connection is hung up immediately.
+    If any invalid characters are received (i.e. anything except numbers, lowercase letters, uppercase
+    letters A-F, CR, LF or characters used in proxy commands: #, space, period, underscore and minus),
+    the connection is hung up immediately.
 
     Responses from the boiler are also hexadecimal representations of the received bytes, terminated with
     a newline character. In case of a communication error on the serial connection, the error is reported
     back as a UTF-8 string, prepended by an exclamation sign (!).
+
+    Lines starting with a hash sign (#) are commands handled by the proxy itself rather than sent to the
+    boiler, consisting of a lowercase name and space-separated arguments. If a :py:class:`Poller` is given,
+    the following commands answer from the values it has read:
+
+    * `#value AAAA [BBBB ...]`: the latest values of the given addresses, as in a response to reading
+      the values from the boiler;
+    * `#state`: the latest response to reading the boiler state;
+    * `#history AAAA [SECONDS]`: the samples of the value of the given address taken in the last given
+      number of seconds (default: all samples kept), as comma-separated pairs of a timestamp (seconds
+      since the epoch) and the value, separated by a colon.
+
+    If a :py:class:`froeling_proxy.store.TimeSeriesStore` is given, the command
+    `#range START END RESOLUTION [AAAA ...]` returns the samples (if RESOLUTION is `raw`) or rollups (if it is
+    `minute` or `hour`) of the given addresses (default: all) recorded from START (inclusive) until END
+    (exclusive), given in seconds since the epoch or, if zero or negative, relative to the current time.
+    The response is a comma-separated list of samples, each consisting of a timestamp, an address and
+    a value as a decimal integer, or of rollups, each consisting of the start of the minute or hour,
+    an address, and the minimum, maximum, average and number of values, separated by colons.
+
+    A client can subscribe to changes of values with the command
+    `#subscribe INTERVAL DEADBAND AAAA [BBBB ...] [state]`, which returns the ID of the subscription. The
+    values (and the boiler state, if `state` is given) are then polled every INTERVAL seconds (see
+    :py:class:`froeling_proxy.subscriptions.SubscriptionManager`), and whenever some of them have changed,
+    by more than DEADBAND for values, the proxy sends the client a line with an asterisk (*), the ID of the
+    subscription and space-separated pairs of an address and its new value, separated by a colon (the
+    state as `state:` followed by the response to reading it), e.g. `*1 0000:0093 0076:0071`. These lines
+    may come between any two responses. The command `#unsubscribe ID` cancels a subscription; all
+    subscriptions of a connection are cancelled when it is closed.
+
+    Requests of each connection form a separate flow of the serial worker's fair queue (see
+    :py:class:`froeling_proxy.worker.SerialWorker`), in the priority class configured for the port it was
+    accepted on. A client can change the priority class of its connection with the command
+    `#priority CLASS` (`interactive`, `normal` or `background` by default), which applies to the requests
+    following it, and get the numbers of requests waiting in each priority class with `#queue`.
+
+    A proxy can relay commands to several boilers, each with its own serial worker, so exchanges with
+    different boilers run in parallel and a slow or unresponsive boiler only holds up its own clients.
+    Clients are connected to the boiler of the given Froeling object unless they connect to a port in
+    `boiler_ports`; a client can switch its connection to another boiler with the command `#boiler ID`
+    (`#boiler` alone returns the current one), which applies to the requests following it. The command
+    `#boilers` lists the IDs of all boilers with the numbers of requests waiting for each of them.
+    The poller, the store and the binary protocol only serve the boiler of the given Froeling object.
+
+    Instead of a Froeling object, the proxy can be given an :py:class:`froeling_proxy.upstream.UpstreamPool`
+    of connections to another proxy server, which then executes the commands. Such an edge proxy serves its
+    clients from its own cache and coalesces their identical requests, so clients can be spread over many
+    edge proxies while the proxy attached to the boiler only serves the edge proxies.
+
+    With `binary_port`, the proxy also listens on a port speaking the binary protocol described in
+    :py:mod:`froeling_proxy.binary`: requests are length-prefixed frames with a request ID chosen by the
+    client, and the response to each request is sent, with the same ID and a status code, as soon as it
+    is available, so responses from the cache are not held back by requests waiting for the boiler.
+
+    The numbers of connections accepted and of bytes received from and sent to clients are counted in
+    the attributes `connections_accepted`, `bytes_received` and `bytes_sent`. If a
+    :py:class:`froeling_proxy.metrics.Metrics` is given, these, the number of open connections, the depth of
+    the queue of the serial worker, the numbers of coalesced and merged requests, the hits and misses of
+    the response cache and the serial traffic are exposed as metrics as well.
     """
-    VALID_INPUT_BYTES = "\r\n0123456789abcdefABCDEF".encode()
+    VALID_INPUT_BYTES = "\r\n0123456789abcdefABCDEF# ._-abcdefghijklmnopqrstuvwxyz".encode()
+    MAX_PENDING_REQUESTS = 256
 
-    def __init__(self, port, froeling):
+    def __init__(self, port, froeling, max_connections=None, idle_timeout=None, max_buffer_size=65536,
+                 worker=None, poller=None, store=None, metrics=None, priority="normal", port_priorities=None,
+                 binary_port=None, boilers=None, boiler_id="1", boiler_ports=None):
         """
         Constructs a TCP proxy, but does not yet open the socket and start listening.
 
         :param port: TCP port number to listen on
-        :param froeling: the Froeling object used to relay commands to the boiler
+        :param froeling: the Froeling object used to relay commands to the boiler, or an
+            :py:class:`froeling_proxy.upstream.UpstreamPool` to relay them to another proxy server
+        :param max_connections: maximum number of client connections open at once; further clients wait
+            until a connection is closed (default: unlimited)
+        :param idle_timeout: number of seconds after which a connection that neither sent nor received
+            anything is closed (default: never)
+        :param max_buffer_size: maximum number of bytes buffered for a connection in each direction; a client
+            is not read from while more output than that is waiting to be sent to it, and is hung up on
+            if it sends a longer line
+        :param worker: the :py:class:`froeling_proxy.worker.SerialWorker` executing the commands; by default,
+            one with default settings is created for the given Froeling object (or an
+            :py:class:`froeling_proxy.upstream.UpstreamWorker` for an upstream pool)
+        :param poller: a :py:class:`Poller` whose snapshot of values and state is served by the proxy commands;
+            it is started and stopped together with the server
+        :param store: a :py:class:`froeling_proxy.store.TimeSeriesStore` to record the values received from
+            the boiler to, and to serve with the `#range` proxy command
+        :param metrics: a :py:class:`froeling_proxy.metrics.Metrics` to expose the proxy's metrics with; it is
+            also passed to the serial worker, if one is created by default
+        :param priority: name of the priority class of connections to the port (see
+            :py:class:`froeling_proxy.worker.SerialWorker`)
+        :param port_priorities: dictionary mapping additional TCP port numbers to listen on to the priority
+            classes of connections to them
+        :param binary_port: TCP port number to listen on for connections speaking the binary protocol (their
+            priority class is the one given by priority)
+        :param boilers: dictionary mapping IDs (str) of additional boilers to the
+            :py:class:`froeling_proxy.worker.SerialWorker` objects executing their commands
+        :param boiler_id: ID of the boiler of the given Froeling object, to which clients are connected by
+            default
+        :param boiler_ports: dictionary mapping additional TCP port numbers to listen on to the IDs of the
+            boilers that connections to them are connected to
         """
+        from froeling_proxy.subscriptions import SubscriptionManager
+        from froeling_proxy.upstream import UpstreamPool, UpstreamWorker
+        from froeling_proxy.worker import SerialWorker
+
         if not isinstance(port, int):
             raise ValueError("port must be an int")
-        if not isinstance(froeling, Froeling):
-            raise ValueError("froeling must be a Froeling")
+        if not isinstance(froeling, (Froeling, UpstreamPool)):
+            raise ValueError("froeling must be a Froeling or an UpstreamPool")
+        if max_connections is not None and max_connections < 1:
+            raise ValueError("max_connections must be positive")
+        if idle_timeout is not None and idle_timeout <= 0:
+            raise ValueError("idle_timeout must be positive")
+        if max_buffer_size < 1:
+            raise ValueError("max_buffer_size must be positive")
         self.port = port
         self.froeling = froeling
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_buffer_size = max_buffer_size
+        if worker is None:
+            worker = UpstreamWorker(froeling, metrics=metrics) if isinstance(froeling, UpstreamPool) else \
+                SerialWorker(froeling, metrics=metrics)
+        self.worker = worker
+        self.boiler_id = boiler_id
+        self.workers = dict(boilers or {})
+        self.workers[boiler_id] = self.worker
+        self.boiler_ports = dict(boiler_ports or {})
+        if any(boiler not in self.workers for boiler in self.boiler_ports.values()):
+            raise ValueError("Unknown boiler in boiler_ports")
+        self.subscriptions = SubscriptionManager(self.worker, priority)
+        self.poller = poller
+        self.store = store
+        self.metrics = metrics
+        self.priority = priority
+        self.port_priorities = dict(port_priorities or {})
+        self.binary_port = binary_port
+        if any(p not in w.priorities for p in [priority] + list(self.port_priorities.values())
+               for w in self.workers.values()):
+            raise ValueError("Unknown priority")
+        if store is not None and not store.readonly:
+            self.worker.add_listener(store.record_response)
+        self.connections = 0
+        self.connections_accepted = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        if metrics is not None:
+            self._register_metrics(metrics)
+
+    def _register_metrics(self, metrics):
+        metrics.register_function("froeling_proxy_connections", "gauge", "Open client connections",
+                                  lambda: self.connections)
+        metrics.register_function("froeling_proxy_connections_accepted_total", "counter",
+                                  "Client connections accepted", lambda: self.connections_accepted)
+        metrics.register_function("froeling_proxy_received_bytes_total", "counter", "Bytes received from clients",
+                                  lambda: self.bytes_received)
+        metrics.register_function("froeling_proxy_sent_bytes_total", "counter", "Bytes sent to clients",
+                                  lambda: self.bytes_sent)
+        metrics.register_function("froeling_queue_depth", "gauge",
+                                  "Requests waiting for the serial worker, by priority class",
+                                  lambda: {labels + (("priority", priority),): depth
+                                           for labels, worker in self._boiler_labels()
+                                           for priority, depth in worker.queue_depths.items()})
+        metrics.register_function("froeling_coalesced_requests_total", "counter",
+                                  "Requests coalesced with identical requests in flight",
+                                  self._per_boiler(lambda worker: worker.coalesced))
+        metrics.register_function("froeling_merged_requests_total", "counter",
+                                  "Requests for values answered from merged requests",
+                                  self._per_boiler(lambda worker: worker.merged))
+        metrics.register_function("froeling_serial_sent_bytes_total", "counter", "Bytes written to the serial port",
+                                  self._per_boiler(lambda worker: worker.froeling.bytes_sent))
+        metrics.register_function("froeling_serial_received_bytes_total", "counter",
+                                  "Bytes read from the serial port",
+                                  self._per_boiler(lambda worker: worker.froeling.bytes_received))
+        metrics.register_function("froeling_serial_discarded_bytes_total", "counter",
+                                  "Bytes read from the serial port outside of frames",
+                                  self._per_boiler(lambda worker: worker.froeling.bytes_discarded))
+        metrics.declare("froeling_queue_wait_seconds", "histogram",
+                        "Time requests waited for the serial worker, by command")
+        metrics.declare("froeling_serial_seconds", "histogram", "Time of serial exchanges, by command")
+        metrics.declare("froeling_upstream_seconds", "histogram", "Time of requests to the upstream proxy, by command")
+        metrics.declare("froeling_errors_total", "counter", "Failed serial exchanges, by command and error")
+        metrics.register_function("froeling_subscriptions", "gauge", "Active subscriptions to changes of values",
+                                  lambda: len(self.subscriptions))
+        metrics.register_function("froeling_subscription_deliveries_total", "counter",
+                                  "Changes of subscribed values delivered to clients",
+                                  lambda: self.subscriptions.deliveries)
+        metrics.register_function("froeling_subscription_errors_total", "counter", "Failed polls of subscribed values",
+                                  lambda: self.subscriptions.errors)
+        if self.froeling.cache is not None:
+            cache = self.froeling.cache
+            metrics.register_function("froeling_cache_hits_total", "counter", "Requests answered from the cache",
+                                      lambda: cache.hits)
+            metrics.register_function("froeling_cache_misses_total", "counter", "Requests not found in the cache",
+                                      lambda: cache.misses)
+        if self.poller is not None:
+            metrics.register_function("froeling_poll_errors_total", "counter", "Failed polls",
+                                      lambda: self.poller.errors)
+
+    def _boiler_labels(self):
+        """
+        :return: list of (labels, worker) pairs of all boilers, where labels is a tuple with the label
+            `boiler` if there is more than one boiler and empty otherwise
+        """
+        if len(self.workers) == 1:
+            return [((), self.worker)]
+        return [((("boiler", boiler),), worker) for boiler, worker in sorted(self.workers.items())]
+
+    def _per_boiler(self, function):
+        """
+        :param function: function computing the value of a metric from a worker
+        :return: function computing the values of the metric for all boilers, for
+            :py:meth:`froeling_proxy.metrics.Metrics.register_function`
+        """
+        return lambda: {labels: function(worker) for labels, worker in self._boiler_labels()}
 
     def start(self):
         """
         Starts listening to the TCP port and relaying the commands. It blocks the issuing thread.
-        :return: never returns
+        :return: does not return until :py:meth:`stop` is called
         """
         self.selector = selectors.DefaultSelector()
+        self.running = True
+        self.connections = 0
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_requested = False
+        self._ready = collections.deque()
+        for worker in self.workers.values():
+            worker.start()
+        self.subscriptions.start()
+        if self.poller is not None:
+            self.poller.start()
 
+        self.listening_sockets = {}
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            for port, priority, binary_protocol, boiler in self._listening_ports():
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.listening_sockets[s] = (priority, binary_protocol, boiler)
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.bind(("", self.port))
+                s.bind(("", port))
                 s.listen()
                 s.setblocking(False)
                 self.selector.register(s, selectors.EVENT_READ, data=None)
-                while True:
-                    events = self.selector.select(timeout=None)
-                    for key, mask in events:
-                        if key.data is None:
-                            self._accept_connection(key.fileobj)
-                        else:
-                            self._service_connection(key, mask)
+            self.accepting = True
+            self._wakeup_receiver.setblocking(False)
+            self.selector.register(self._wakeup_receiver, selectors.EVENT_READ, data=None)
+            sweep_interval = None if self.idle_timeout is None else min(1.0, self.idle_timeout / 2)
+            next_sweep = time.monotonic()
+            while self.running:
+                events = self.selector.select(timeout=sweep_interval)
+                for key, mask in events:
+                    if key.fileobj is self._wakeup_receiver:
+                        self._wakeup_receiver.recv(4096)
+                        self._wakeup_requested = False
+                    elif key.data is None:
+                        self._accept_connection(key.fileobj)
+                    else:
+                        self._service_connection(key, mask)
+                self._service_ready_connections()
+                if sweep_interval is not None and time.monotonic() >= next_sweep:
+                    self._close_idle_connections()
+                    next_sweep = time.monotonic() + sweep_interval
         except KeyboardInterrupt:
             pass
+        finally:
+            if self.poller is not None:
+                self.poller.stop()
+            self.subscriptions.stop()
+            for worker in self.workers.values():
+                worker.stop()
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None:
+                    key.fileobj.close()
+            for s in self.listening_sockets:
+                s.close()
+            self.selector.close()
+            self._wakeup_receiver.close()
+            self._wakeup_sender.close()
+
+    def stop(self):
+        """
+        Stops the server started with :py:meth:`start` and closes all connections. Can be called from
+        any thread.
+        """
+        self.running = False
+        self._wake_up()
+
+    def _listening_ports(self):
+        """
+        :return: list of (port number, priority class, whether the binary protocol is spoken, boiler ID) tuples
+        """
+        ports = [(self.port, self.priority, False, self.boiler_id)] + \
+            [(port, priority, False, self.boiler_id) for port, priority in sorted(self.port_priorities.items())] + \
+            [(port, self.priority, False, boiler) for port, boiler in sorted(self.boiler_ports.items())]
+        if self.binary_port is not None:
+            ports.append((self.binary_port, self.priority, True, self.boiler_id))
+        return ports
+
+    def _wake_up(self):
+        # noinspection PyBroadException
+        try:
+            self._wakeup_sender.send(b"\0")
+        except Exception:
+            pass
 
     def _accept_connection(self, s):
+        from froeling_proxy import binary
         try:
             conn, addr = s.accept()
+        except Exception as e:
+            print("Error accepting TCP socket connection: {}".format(e), file=sys.stderr)
+            return
+        try:
             conn.setblocking(False)
-            data = types.SimpleNamespace(addr=addr, inb=b'', outb=b'')
-            events = selectors.EVENT_READ | selectors.EVENT_WRITE
-            self.selector.register(conn, events, data=data)
+            priority, binary_protocol, boiler = self.listening_sockets[s]
+            framer = binary.FrameReader(self.max_buffer_size) if binary_protocol else LineFramer()
+            data = types.SimpleNamespace(sock=conn, addr=addr, framer=framer, pending=collections.deque(),
+                                         outb=bytearray(), last_activity=time.monotonic(),
+                                         priority=priority, flow=object(), binary=binary_protocol,
+                                         pushes=collections.deque(), subscriptions=set(), boiler=boiler,
+                                         worker=self.workers[boiler])
+            data.push = lambda line: self._push(data, line)
+            self.selector.register(conn, selectors.EVENT_READ, data=data)
         except Exception as e:
-            print("Error accepting TCP socket connection: {}".format(e), sys.stderr)
-            # noinspection PyBroadException
-            self._close_connection(s)
+            print("Error accepting TCP socket connection: {}".format(e), file=sys.stderr)
+            conn.close()
+            return
+        self.connections += 1
+        self.connections_accepted += 1
+        if self.max_connections is not None and self.connections >= self.max_connections:
+            for listening_socket in self.listening_sockets:
+                self.selector.unregister(listening_socket)
+            self.accepting = False
 
     def _close_connection(self, s):
         # noinspection PyBroadException
         try:
-            self.selector.unregister(s)
+            key = self.selector.unregister(s)
+        except Exception:
+            return
+        self._unsubscribe_all(key.data)
+        # noinspection PyBroadException
+        try:
             s.close()
         except Exception:
             pass
+        self.connections -= 1
+        if not self.accepting:
+            for listening_socket in self.listening_sockets:
+                self.selector.register(listening_socket, selectors.EVENT_READ, data=None)
+            self.accepting = True
+
+    def _close_idle_connections(self):
+        idle_since = time.monotonic() - self.idle_timeout
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None and not key.data.pending and key.data.last_activity < idle_since:
+                self._close_connection(key.fileobj)
+
+    def _update_interest(self, key):
+        """
+        Register for writability only while there is output to send, and for readability only while
+        the output buffer is not full and not too many requests are waiting for responses, so that
+        clients that do not read their responses are not fed any more requests.
+        """
+        data = key.data
+        readable = len(data.outb) < self.max_buffer_size and len(data.pending) < self.MAX_PENDING_REQUESTS
+        events = (selectors.EVENT_READ if readable else 0) | \
+                 (selectors.EVENT_WRITE if data.outb else 0)
+        if events != key.events:
+            self.selector.modify(key.fileobj, events, data=data)
 
     def _service_connection(self, key, mask):
         s = key.fileobj
@@ -148,58 +492,360 @@ class FroelingProxyServer:
             try:
                 recv_data = s.recv(1024)
             except Exception as e:
-                print("Error reading from TCP socket: {}".format(e), sys.stderr)
-                # noinspection PyBroadException
+                print("Error reading from TCP socket: {}".format(e), file=sys.stderr)
+                self._close_connection(s)
+                return
+            if not recv_data:
                 self._close_connection(s)
                 return
-            if recv_data:
-                invalid_bytes = [byte for byte in recv_data if byte not in FroelingProxyServer.VALID_INPUT_BYTES]
-                if invalid_bytes:
-                    print("Bad input bytes " + repr(invalid_bytes) + "; closing connection")
-                    self._close_connection(s)
+            self.bytes_received += len(recv_data)
+            data.last_activity = time.monotonic()
+            invalid_bytes = None if data.binary else self._find_invalid_bytes(recv_data)
+            if invalid_bytes:
+                print("Bad input bytes " + repr(invalid_bytes) + "; closing connection", file=sys.stderr)
+                self._close_connection(s)
+                return
+            try:
+                if data.binary:
+                    self._handle_binary_requests(data, recv_data)
                 else:
-                    data.inb += recv_data
-                    try:
-                        self._handle_requests(data)
-                    except Exception as e:
-                        print("Error handling request: {}".format(e), sys.stderr)
-                        # noinspection PyBroadException
-                        self._close_connection(s)
-                        return
-            else:
+                    self._handle_requests(data, recv_data)
+            except Exception as e:
+                print("Error handling request: {}".format(e), file=sys.stderr)
+                self._close_connection(s)
+                return
+            if len(data.framer) > self.max_buffer_size:
+                print("Request line longer than {} bytes; closing connection".format(self.max_buffer_size),
+                      file=sys.stderr)
                 self._close_connection(s)
+                return
 
-        if mask & selectors.EVENT_WRITE:
-            if data.outb:
-                try:
-                    sent = s.send(data.outb)
-                except Exception as e:
-                    print("Error writing to TCP socket: {}".format(e), sys.stderr)
-                    # noinspection PyBroadException
-                    self._close_connection(s)
-                    return
-                data.outb = data.outb[sent:]
+        if mask & selectors.EVENT_WRITE and data.outb:
+            try:
+                sent = s.send(data.outb)
+            except Exception as e:
+                print("Error writing to TCP socket: {}".format(e), file=sys.stderr)
+                self._close_connection(s)
+                return
+            del data.outb[:sent]
+            self.bytes_sent += sent
+            data.last_activity = time.monotonic()
+
+        self._update_interest(key)
 
-    def _handle_requests(self, data):
+    def _handle_requests(self, data, recv_data):
         """
-        Handle the requests that are received in their entirety from the TCP socket into the data object's
-        input buffer (inb). Responses to the issued commands are added to the data's output buffer (outb).
+        Handle the requests that are received in their entirety from the TCP socket. All complete lines are
+        queued for execution at once; responses to the issued commands are added to the data's output buffer
+        (outb) in order as they become available.
 
         :param data: the data object of the connection to the socket
+        :param recv_data: bytes just received from the socket
         :return: None
         """
-        newline_index = next((i for (i, byte) in enumerate(data.inb) if byte in b'\n\r'), None)
-        if newline_index is not None:
+        results = self._submit_lines(data.framer.feed(recv_data), data)
+        for result in results:
+            if not isinstance(result, bytes):
+                result.add_done_callback(lambda _: self._response_ready(data))
+        data.pending.extend(results)
+        self._collect_responses(data)
+
+    def _handle_binary_requests(self, data, recv_data):
+        """
+        Handle the requests of the binary protocol that are received in their entirety from the TCP socket.
+        All complete frames are queued for execution at once; responses are added to the data's output
+        buffer as soon as they are available, regardless of the order of requests.
+
+        :param data: the data object of the connection to the socket
+        :param recv_data: bytes just received from the socket
+        :raise ValueError: invalid frame received
+        """
+        frames = data.framer.feed(recv_data)
+        if not frames:
+            return
+        futures = data.worker.submit_batch([(command, parameters) for _, command, parameters in frames],
+                                           data.flow, data.priority)
+        for (request_id, _, _), future in zip(frames, futures):
+            if not future.done():
+                future.add_done_callback(lambda _: self._response_ready(data))
+            data.pending.append((request_id, future))
+        self._collect_responses(data)
+
+    def _response_ready(self, data):
+        """
+        Called (possibly by the serial worker thread) when a response for the given connection is available;
+        wakes up the selector loop unless it has already been woken up.
+        """
+        self._ready.append(data)
+        if not self._wakeup_requested:
+            self._wakeup_requested = True
+            self._wake_up()
+
+    def _push(self, data, line):
+        """
+        Called (by the serial worker thread) with a line to send to the client outside of the order of
+        responses, i.e. a notification of changed values.
+
+        :return: False if the output buffer of the connection is full and the line was not queued
+        """
+        if len(data.outb) >= self.max_buffer_size:
+            return False
+        data.pushes.append(line)
+        self._response_ready(data)
+        return True
+
+    def _service_ready_connections(self):
+        while self._ready:
+            data = self._ready.popleft()
             try:
-                request = bytes.fromhex(data.inb[:newline_index].decode())
-            except ValueError as e:
-                data.outb += b"!" + (e.__class__.__name__ + ": " + str(e)).encode("UTF-8") + b"\n"
-                request = None
-            data.inb = data.inb[newline_index + 1:]
-            if request:
+                key = self.selector.get_key(data.sock)
+            except (KeyError, ValueError):
+                continue  # connection has been closed in the meantime
+            try:
+                self._collect_responses(data)
+            except Exception as e:
+                print("Error handling request: {}".format(e), file=sys.stderr)
+                self._close_connection(data.sock)
+                continue
+            self._update_interest(key)
+
+    def _collect_responses(self, data):
+        """
+        Move the responses that are available, in the order of requests, from the pending queue
+        to the output buffer.
+        """
+        if data.binary:
+            waiting = collections.deque()
+            for request_id, future in data.pending:
+                if future.done():
+                    data.outb += self._format_binary_response(request_id, future)
+                else:
+                    waiting.append((request_id, future))
+            data.pending = waiting
+            return
+        while data.pushes:
+            data.outb += data.pushes.popleft()
+        pending = data.pending
+        while pending and (isinstance(pending[0], bytes) or pending[0].done()):
+            result = pending.popleft()
+            if isinstance(result, bytes):
+                data.outb += result
+            else:
                 try:
-                    response = self.froeling.send_command(request[0], request[1:])
-                    data.outb += response.hex().encode() + b"\n"
+                    data.outb += self._format_response(result.result())
                 except (SerialPortIOError, ResponseReadError) as e:
-                    data.outb += b"!" + (e.__class__.__name__ + ": " + str(e)).encode("UTF-8") + b"\n"
+                    data.outb += self._format_error(e)
+
+    def _submit_lines(self, lines, connection):
+        """
+        Parse the request lines and queue the valid requests to the serial worker as one batch (or one per
+        boiler and priority class, if the connection's boiler or priority class is changed by a proxy command
+        among the lines).
+
+        :param lines: list of request lines (bytes objects without line terminators)
+        :param connection: the data object of the connection, with the worker of its boiler (worker), its
+            priority class (priority) and the identifier of its flow of requests (flow)
+        :return: list with, for each line, either a Future of the response or bytes of the error
+            response line if the request could not be parsed
+        """
+        results = []
+        batches = []
+        for line in lines:
+            if line.startswith(b"#"):
+                results.append(self._run_proxy_command(line, connection))
+                continue
+            try:
+                request = self._parse_request(line)
+            except ValueError as e:
+                results.append(self._format_error(e))
+                continue
+            results.append(None)
+            if not batches or batches[-1][:2] != (connection.worker, connection.priority):
+                batches.append((connection.worker, connection.priority, []))
+            batches[-1][2].append((request[0], request[1:]))
+        futures = iter([future for worker, priority, requests in batches
+                        for future in worker.submit_batch(requests, connection.flow, priority)])
+        return [next(futures) if result is None else result for result in results]
+
+    def _run_proxy_command(self, line, connection):
+        """
+        :param line: a line with a proxy command, starting with '#'
+        :param connection: the data object of the connection the line was received from
+        :return: bytes of the response line
+        """
+        words = bytes(line[1:]).decode().split()
+        handler = getattr(self, "_proxy_command_" + words[0], None) if words else None
+        try:
+            if handler is None:
+                raise ProxyCommandError("Unknown proxy command: " + bytes(line).decode())
+            if not _accepts_arguments(handler, len(words)):
+                raise ProxyCommandError("Wrong number of arguments: " + bytes(line).decode())
+            return handler(connection, *words[1:]).encode() + b"\n"
+        except (ProxyCommandError, ValueError) as e:
+            return self._format_error(e)
+        except TypeError as e:
+            # A bug in the handler rather than a bad request; report it, but keep serving the connection
+            print("Error in proxy command {}: {!r}".format(bytes(line).decode(), e), file=sys.stderr)
+            return self._format_error(e)
+
+    def _require_poller(self):
+        if self.poller is None:
+            raise ProxyCommandError("Values are not being polled")
+        return self.poller
+
+    def _proxy_command_priority(self, connection, priority):
+        if priority not in connection.worker.priorities:
+            raise ProxyCommandError("Unknown priority: {}".format(priority))
+        connection.priority = priority
+        return priority
+
+    def _proxy_command_queue(self, connection):
+        return ",".join("{}:{}".format(*depth) for depth in connection.worker.queue_depths.items())
+
+    def _proxy_command_boiler(self, connection, boiler=None):
+        if boiler is not None:
+            if boiler not in self.workers:
+                raise ProxyCommandError("Unknown boiler: {}".format(boiler))
+            connection.boiler, connection.worker = boiler, self.workers[boiler]
+        return connection.boiler
+
+    def _proxy_command_boilers(self, connection):
+        return ",".join("{}:{}".format(boiler, worker.queue_depth) for boiler, worker in sorted(self.workers.items()))
+
+    def _proxy_command_subscribe(self, connection, interval, deadband, *addresses):
+        subscription = self.subscriptions.subscribe(
+            [_parse_address(address) for address in addresses if address != "state"], float(interval),
+            lambda s, changes, state: connection.push(self._format_changes(s.id, changes, state)),
+            deadband=int(deadband), state="state" in addresses, worker=connection.worker)
+        connection.subscriptions.add(subscription.id)
+        return str(subscription.id)
+
+    def _proxy_command_unsubscribe(self, connection, subscription_id):
+        if int(subscription_id) not in connection.subscriptions:
+            raise ProxyCommandError("No such subscription: {}".format(subscription_id))
+        connection.subscriptions.remove(int(subscription_id))
+        self.subscriptions.unsubscribe(int(subscription_id))
+        return subscription_id
+
+    def _unsubscribe_all(self, connection):
+        for subscription_id in connection.subscriptions:
+            self.subscriptions.unsubscribe(subscription_id)
+        connection.subscriptions.clear()
+
+    def _proxy_command_value(self, connection, *addresses):
+        try:
+            return self._require_poller().current_values([_parse_address(address) for address in addresses]).hex()
+        except KeyError:
+            raise ProxyCommandError("Not all of the values have been polled yet")
+
+    def _proxy_command_state(self, connection):
+        state = self._require_poller().state
+        if state is None:
+            raise ProxyCommandError("State has not been polled yet")
+        return state.hex()
+
+    def _proxy_command_history(self, connection, address, seconds=None):
+        since = time.time() - float(seconds) if seconds is not None else None
+        try:
+            samples = self._require_poller().history(_parse_address(address), since)
+        except KeyError:
+            raise ProxyCommandError("Value {} is not being polled".format(address))
+        return ",".join("{:.3f}:{}".format(timestamp, value.to_bytes(2, "big", signed=True).hex())
+                        for timestamp, value in samples)
+
+    def _proxy_command_range(self, connection, start, end, resolution, *addresses):
+        if self.store is None:
+            raise ProxyCommandError("Values are not being stored")
+        now = time.time()
+        start, end = [float(t) if float(t) > 0 else now + float(t) for t in (start, end)]
+        results = self.store.query([int.from_bytes(_parse_address(address), "big") for address in addresses] or None,
+                                   start, end, resolution)
+        if resolution == "raw":
+            return ",".join("{:.3f}:{:04x}:{}".format(*sample) for sample in results)
+        return ",".join("{}:{:04x}:{}:{}:{:.2f}:{}".format(*rollup) for rollup in results)
+
+    @staticmethod
+    def _find_invalid_bytes(data):
+        """
+        :param data: bytes received from the client
+        :return: bytes object with the bytes of data that are not in VALID_INPUT_BYTES (empty if all are valid)
+        """
+        return bytes(data).translate(None, FroelingProxyServer.VALID_INPUT_BYTES)
+
+    @staticmethod
+    def _parse_request(line):
+        """
+        :param line: a line received from the client, without the line terminator
+        :return: bytes object with the command byte followed by parameters (empty for an empty line)
+        :raise ValueError: the line is not a valid hexadecimal representation of bytes
+        """
+        return bytes.fromhex(bytes(line).decode())
+
+    @staticmethod
+    def _format_response(response):
+        return response.hex().encode() + b"\n"
+
+    @staticmethod
+    def _format_error(e):
+        return b"!" + (e.__class__.__name__ + ": " + str(e)).encode("UTF-8") + b"\n"
+
+    @staticmethod
+    def _format_changes(subscription_id, changes, state):
+        """
+        :param subscription_id: ID of the subscription
+        :param changes: list of (address, value) pairs of changed values
+        :param state: new boiler state, or None if it did not change
+        :return: bytes of the line notifying the client of the changes
+        """
+        words = ["{}:{}".format(address.hex(), value.to_bytes(2, "big", signed=True).hex())
+                 for address, value in changes]
+        if state is not None:
+            words.append("state:" + state.hex())
+        return "*{} {}\n".format(subscription_id, " ".join(words)).encode()
+
+    @staticmethod
+    def _format_binary_response(request_id, future):
+        """
+        :param request_id: ID of the request
+        :param future: the completed Future of the response
+        :return: bytes of the response frame of the binary protocol
+        """
+        from froeling_proxy import binary
+        try:
+            return binary.encode_response(request_id, binary.STATUS_OK, future.result())
+        except (SerialPortIOError, ResponseReadError) as e:
+            return binary.encode_error(request_id, e)
+
+
+def _parse_address(address):
+    """
+    :param address: string with a hexadecimal representation of a 2-byte address
+    :return: the address (bytes object)
+    :raise ValueError: not a valid address
+    """
+    parsed = bytes.fromhex(address)
+    if len(parsed) != 2:
+        raise ValueError("Address must be 2 bytes long: " + address)
+    return parsed
+
+
+def _accepts_arguments(function, count):
+    """
+    Check the number of positional arguments a function can be called with, without importing inspect (which
+    would slow down one-shot queries).
+
+    :param function: a function or bound method without keyword-only arguments
+    :param count: number of positional arguments
+    :return: whether the function can be called with the given number of positional arguments
+    """
+    code = function.__code__
+    maximum = code.co_argcount - (1 if hasattr(function, "__self__") else 0)
+    minimum = maximum - len(function.__defaults__ or ())
+    return minimum <= count and (count <= maximum or bool(code.co_flags & _CO_VARARGS))
+
 
+def __getattr__(name):
+    module = _LAZY_EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    return getattr(importlib.import_module(module), name)
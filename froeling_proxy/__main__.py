@@ -14,41 +14,176 @@
 
 import sys
 import argparse
+import signal
 
 import froeling_proxy
-from froeling_lib.__init__ import Froeling, ConnectionInitializationError
+from froeling_proxy.catalog import Catalog, DEFAULT_CATALOG
+from froeling_lib import Froeling, ConnectionInitializationError, ResponseCache, LatencyTracker, SerialPortIOError
+from froeling_lib.trace import TraceWriter
 
 parser = argparse.ArgumentParser(description="Proxy for serial communication with Fröling boilers.")
-parser.add_argument("tty", help="TTY device of serial port")
+parser.add_argument("tty", help="TTY device of serial port; with several, one boiler is driven on each, with IDs "
+                                "1, 2... in the given order", nargs="*")
+parser.add_argument("--upstream", help="relay commands to another proxy server, given as HOST:PORT, instead of "
+                                       "a serial port")
+parser.add_argument("--upstream-connections", help="maximum number of connections to the upstream proxy", type=int,
+                    default=2)
 parser.add_argument("--port", "-p", help="TCP port to open for inbound requests", type=int)
+parser.add_argument("--binary-port", help="TCP port to open for inbound requests in the binary protocol", type=int)
+parser.add_argument("--asyncio", "-a", help="serve TCP connections with asyncio while a worker thread talks to the boiler",
+                    action="store_true")
+parser.add_argument("--max-connections", help="maximum number of TCP connections open at once", type=int)
+parser.add_argument("--idle-timeout", help="close TCP connections idle for this many seconds", type=float)
+parser.add_argument("--max-buffer-size", help="maximum number of bytes buffered per TCP connection", type=int,
+                    default=65536)
+parser.add_argument("--cache-ttl", help="answer repeated requests for values and boiler state from a cache "
+                                        "for this many seconds", type=float)
+parser.add_argument("--adaptive-timeouts", help="adapt serial read timeouts to the measured response latency of each "
+                                               "command", action="store_true")
+parser.add_argument("--merge-reads", help="merge waiting requests for values into one request for up to this many "
+                                          "addresses", type=int, default=0)
+parser.add_argument("--merge-window", help="wait this many seconds for more requests for values to merge",
+                    type=float, default=0.0)
+parser.add_argument("--priority", help="priority class of connections to the TCP port (interactive, normal or "
+                                       "background)", default="normal")
+parser.add_argument("--priority-port", help="also listen on another TCP port with connections in the given priority "
+                                            "class, given as PORT:CLASS (may be repeated)", action="append", default=[])
+parser.add_argument("--boiler-port", help="also listen on another TCP port with connections to the boiler with "
+                                          "the given ID, given as PORT:ID (may be repeated)",
+                    action="append", default=[])
+parser.add_argument("--command-priority", help="execute a command in the given priority class regardless of "
+                                               "the connection's, given as hexadecimal COMMAND:CLASS (may be repeated)",
+                    action="append", default=[])
+parser.add_argument("--poll-interval", help="read the temperature values and boiler state every this many seconds "
+                                            "and serve them to proxy commands", type=float)
+parser.add_argument("--poll-history", help="number of polled samples of each value to keep", type=int, default=360)
+parser.add_argument("--store", help="record values read from the boiler to the time series store with this path "
+                                    "prefix")
+parser.add_argument("--metrics-port", help="serve metrics in the Prometheus format over HTTP on this TCP port, at "
+                                           "the path /metrics", type=int)
+parser.add_argument("--http-port", help="serve decoded values and boiler state as JSON over HTTP on this TCP port",
+                    type=int)
+parser.add_argument("--catalog", help="read and serve the values in this catalog file (e.g. written by "
+                                      "froeling_proxy.scanner) instead of the built-in temperatures")
+parser.add_argument("--max-message-length", help="maximum length of the messages in frames received from the boiler; "
+                                                "longer ones are taken to be line noise", type=int,
+                    default=Froeling.MAX_MESSAGE_LENGTH)
+parser.add_argument("--trace", help="record the exchanges with the boiler to this trace file (with several TTY "
+                                    "devices, the boiler ID is appended to the name)")
 parser.add_argument("--state", "-s", help="request and print current boiler state", action="store_true")
 parser.add_argument("--values", help="request and print temperature values", action="store_true")
+parser.add_argument("--proxy", help="send the requests of --state and --values to the proxy server at this TCP "
+                                    "port, given as [HOST:]PORT, if it is running; the TTY device is only opened "
+                                    "if it is not")
 args = parser.parse_args()
+if args.tty and args.upstream or not (args.tty or args.upstream or args.proxy):
+    parser.error("either TTY devices or --upstream must be given")
+if args.proxy and (args.port or args.upstream or not (args.state or args.values)):
+    parser.error("--proxy can only be used with --state or --values, and without --port and --upstream")
+if not 0 < args.max_message_length <= 0xffff:
+    parser.error("--max-message-length must be between 1 and 65535")
 
 try:
-    froeling = Froeling(args.tty)
-except ConnectionInitializationError as e:
-    sys.stderr.write("Error connecting to TTY device: {}\n".format(e))
+    catalog = Catalog.load(args.catalog) if args.catalog else DEFAULT_CATALOG
+except (OSError, ValueError) as e:
+    sys.stderr.write("Error reading catalog: {}\n".format(e))
     sys.exit(1)
 
-if args.state:
-    state = froeling_proxy.read_state(froeling)
-    print("STATE: " + state.hex())
-    print("\n".join(state[2:].decode("iso-8859-1").split(";")))
-
-if args.values:
-    value_catalog = [
-        ("Boiler temperature (Kesseltemperatur)", [0x00, 0x00], True),
-        ("Exhaust temperature (Abgastemperatur)", [0x00, 0x01], False),
-        ("External temperature (Außentemperatur)", [0x00, 0x04], True),
-        ("Buffer top temperature (Puffer 1 oben)", [0x00, 0x76], True),
-        ("Buffer bottom temperature (Puffer 1 unten)", [0x00, 0x78], True),
-        ("Hot water storage temperature (Boilertemperatur 1)", [0x00, 0x5d], True)
-    ]
-    values = froeling_proxy.read_values(froeling, [byte for entry in value_catalog for byte in entry[1]])
-    print("VALUES: " + values.hex())
-    for ((label, _, multiplied_by_2), b1, b2) in zip(value_catalog, values[::2], values[1::2]):
-        print(label + ": " + froeling_proxy.format_temperature([b1, b2], multiplied_by_2=multiplied_by_2))
+froelings = []
+if args.proxy:
+    from froeling_client import FroelingClient
+    host, _, proxy_port = args.proxy.rpartition(":")
+    client = FroelingClient(host or "localhost", int(proxy_port), connections=1)
+    try:
+        client.connect()
+        froelings = [client]
+    except SerialPortIOError as e:
+        if not args.tty:
+            sys.stderr.write("{}\n".format(e))
+            sys.exit(1)
+
+if froelings:
+    pass  # Queries are sent to the running proxy
+elif args.upstream:
+    host, _, upstream_port = args.upstream.rpartition(":")
+    froelings = [froeling_proxy.UpstreamPool(host, int(upstream_port), connections=args.upstream_connections,
+                                             cache=ResponseCache(ttl=args.cache_ttl) if args.cache_ttl else None,
+                                             priority=args.priority)]
+else:
+    try:
+        traces = [TraceWriter(args.trace if len(args.tty) == 1 else "{}.{}".format(args.trace, i + 1))
+                  for i in range(len(args.tty))] if args.trace else [None] * len(args.tty)
+    except OSError as e:
+        sys.stderr.write("Error creating trace file: {}\n".format(e))
+        sys.exit(1)
+    try:
+        froelings = [Froeling(tty, cache=ResponseCache(ttl=args.cache_ttl) if args.cache_ttl else None,
+                              latency=LatencyTracker() if args.adaptive_timeouts else None, trace=trace,
+                              max_message_length=args.max_message_length)
+                     for tty, trace in zip(args.tty, traces)]
+    except ConnectionInitializationError as e:
+        sys.stderr.write("Error connecting to TTY device: {}\n".format(e))
+        sys.exit(1)
+froeling = froelings[0]
+boiler_ids = [str(i + 1) for i in range(len(froelings))]
+
+for boiler_id, boiler in zip(boiler_ids, froelings):
+    if len(froelings) > 1 and (args.state or args.values):
+        print("BOILER: " + boiler_id)
+
+    if args.state:
+        state = froeling_proxy.read_state(boiler)
+        print("STATE: " + state.hex())
+        print("\n".join(state[2:].decode("iso-8859-1").split(";")))
+
+    if args.values:
+        values = froeling_proxy.read_values(boiler, catalog.parameters)
+        print("VALUES: " + values.hex())
+        for entry, text in zip(catalog, catalog.format(catalog.decode(values))):
+            print((entry.label or entry.name) + ": " + text)
 
 if args.port:
-    froeling_proxy.FroelingProxyServer(args.port, froeling).start()
\ No newline at end of file
+    server_class = froeling_proxy.AsyncFroelingProxyServer if args.asyncio else froeling_proxy.FroelingProxyServer
+    metrics = froeling_proxy.Metrics() if args.metrics_port else None
+    port_priorities = {int(port): priority for port, priority in (value.split(":") for value in args.priority_port)}
+    command_priorities = {int(command, 16): priority
+                          for command, priority in (value.split(":") for value in args.command_priority)}
+    boiler_ports = {int(port): boiler_id for port, boiler_id in (value.split(":") for value in args.boiler_port)}
+    if args.upstream:
+        workers = [froeling_proxy.UpstreamWorker(froeling, metrics=metrics)]
+    else:
+        workers = [froeling_proxy.SerialWorker(boiler, max_merged_addresses=args.merge_reads,
+                                               merge_window=args.merge_window, metrics=metrics,
+                                               command_priorities=command_priorities,
+                                               metric_labels={"boiler": boiler_id} if len(froelings) > 1 else None)
+                   for boiler_id, boiler in zip(boiler_ids, froelings)]
+    worker = workers[0]
+    poller = froeling_proxy.Poller(worker, [entry.address for entry in catalog], interval=args.poll_interval,
+                                   history_size=args.poll_history) if args.poll_interval else None
+    store = froeling_proxy.TimeSeriesStore(args.store) if args.store else None
+    server = server_class(args.port, froeling, max_connections=args.max_connections, idle_timeout=args.idle_timeout,
+                          max_buffer_size=args.max_buffer_size, worker=worker, poller=poller, store=store,
+                          metrics=metrics, priority=args.priority, port_priorities=port_priorities,
+                          binary_port=args.binary_port, boilers=dict(zip(boiler_ids[1:], workers[1:])),
+                          boiler_id=boiler_ids[0], boiler_ports=boiler_ports)
+    metrics_server = froeling_proxy.MetricsHttpServer(metrics, args.metrics_port) if metrics is not None else None
+    http_server = froeling_proxy.HttpApiServer(worker, args.http_port, catalog) if args.http_port else None
+
+    def terminate(signum, frame):
+        # Shut down like on Ctrl+C, so that the open rollups of the store are written before exiting
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        if metrics_server is not None:
+            metrics_server.start()
+        if http_server is not None:
+            http_server.start()
+        server.start()
+    finally:
+        if http_server is not None:
+            http_server.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if store is not None:
+            store.close()
\ No newline at end of file
@@ -0,0 +1,266 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import socket
+import sys
+import types
+
+from froeling_lib import SerialPortIOError, ResponseReadError
+from froeling_proxy import FroelingProxyServer, binary
+from froeling_proxy.framing import LineFramer
+
+
+class AsyncFroelingProxyServer(FroelingProxyServer):
+    """
+    A variant of :py:class:`froeling_proxy.FroelingProxyServer` built on asyncio. The TCP connections are
+    served by the event loop, while the commands are executed one at a time by a single
+    :py:class:`froeling_proxy.worker.SerialWorker` thread. Accepting new connections, reading requests and
+    writing responses thus never waits for the serial exchange with the boiler.
+
+    Each connection may have several requests outstanding; their responses are written back in
+    the order the requests were received.
+
+    Unlike with :py:class:`froeling_proxy.FroelingProxyServer`, clients connecting while `max_connections`
+    connections are already open are hung up on immediately.
+    """
+    def __init__(self, port, froeling, **kwargs):
+        super(AsyncFroelingProxyServer, self).__init__(port, froeling, **kwargs)
+        self.server = None
+        self.servers = []
+
+    def start(self):
+        """
+        Starts listening to the TCP port and relaying the commands. It blocks the issuing thread.
+        :return: never returns
+        """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        """
+        Coroutine that opens the TCP socket and serves the connections until cancelled.
+        """
+        server = await self.open()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+    async def open(self):
+        """
+        Coroutine that starts the serial worker and opens the TCP socket, but does not wait for
+        the server to finish.
+
+        :return: the :py:class:`asyncio.Server` accepting the connections to the main port (connections to
+            the ports in port_priorities are accepted by the servers in the attribute `servers`)
+        """
+        for worker in self.workers.values():
+            worker.start()
+        self.subscriptions.start()
+        if self.poller is not None:
+            self.poller.start()
+        for port, priority, binary_protocol, boiler in self._listening_ports():
+            self.servers.append(await asyncio.start_server(
+                lambda reader, writer, priority=priority, binary_protocol=binary_protocol, boiler=boiler:
+                    self._serve_connection(reader, writer, priority, binary_protocol, boiler),
+                port=port, family=socket.AF_INET, reuse_address=True))
+        self.server = self.servers[0]
+        return self.server
+
+    def close(self):
+        """
+        Stop accepting connections and stop the serial worker.
+        """
+        for server in self.servers:
+            server.close()
+        if self.poller is not None:
+            self.poller.stop()
+        self.subscriptions.stop()
+        for worker in self.workers.values():
+            worker.stop()
+
+    async def _serve_connection(self, reader, writer, priority, binary_protocol=False, boiler=None):
+        if self.max_connections is not None and self.connections >= self.max_connections:
+            writer.close()
+            return
+        self.connections += 1
+        self.connections_accepted += 1
+        writer.transport.set_write_buffer_limits(high=self.max_buffer_size)
+        loop = asyncio.get_running_loop()
+
+        def push(line):
+            if writer.transport.get_write_buffer_size() >= self.max_buffer_size:
+                return False
+            loop.call_soon_threadsafe(self._write_push, writer, connection, line)
+            return True
+
+        boiler = self.boiler_id if boiler is None else boiler
+        connection = types.SimpleNamespace(priority=priority, flow=object(), subscriptions=set(), push=push,
+                                           boiler=boiler, worker=self.workers[boiler], last_activity=loop.time())
+        if binary_protocol:
+            try:
+                await self._serve_binary_connection(reader, writer, connection)
+            finally:
+                self.connections -= 1
+                writer.close()
+            return
+        pending = asyncio.Queue(self.MAX_PENDING_REQUESTS)
+        writer_task = asyncio.ensure_future(self._write_responses(pending, writer, connection))
+        framer = LineFramer()
+        try:
+            while True:
+                if writer.transport.get_write_buffer_size() >= self.max_buffer_size:
+                    await writer.drain()
+                recv_data = await self._read(reader, connection)
+                if not recv_data:
+                    break
+                self.bytes_received += len(recv_data)
+                invalid_bytes = self._find_invalid_bytes(recv_data)
+                if invalid_bytes:
+                    print("Bad input bytes " + repr(invalid_bytes) + "; closing connection", file=sys.stderr)
+                    break
+                for result in self._submit_lines(framer.feed(recv_data), connection):
+                    await pending.put(result)
+                if len(framer) > self.max_buffer_size:
+                    print("Request line longer than {} bytes; closing connection".format(self.max_buffer_size),
+                          file=sys.stderr)
+                    break
+        except Exception as e:
+            print("Error reading from TCP socket: {}".format(e), file=sys.stderr)
+        finally:
+            self.connections -= 1
+            self._unsubscribe_all(connection)
+            try:
+                if not writer_task.done():
+                    await pending.put(None)
+                    await writer_task
+            finally:
+                writer.close()
+
+    async def _serve_binary_connection(self, reader, writer, connection):
+        """
+        Serve a connection speaking the binary protocol. Responses are written from callbacks scheduled on
+        the event loop as soon as they are available; at most MAX_PENDING_REQUESTS requests may be waiting
+        for responses before the client is not read from any more.
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.MAX_PENDING_REQUESTS)
+        framer = binary.FrameReader(self.max_buffer_size)
+
+        def write_response(request_id, future):
+            slots.release()
+            if writer.is_closing():
+                return
+            try:
+                response = self._format_binary_response(request_id, future)
+            except Exception as e:
+                print("Error handling request: {}".format(e), file=sys.stderr)
+                writer.close()
+                return
+            writer.write(response)
+            self.bytes_sent += len(response)
+            connection.last_activity = loop.time()
+
+        try:
+            while True:
+                if writer.transport.get_write_buffer_size() >= self.max_buffer_size:
+                    await writer.drain()
+                recv_data = await self._read(reader, connection)
+                if not recv_data:
+                    break
+                self.bytes_received += len(recv_data)
+                frames = framer.feed(recv_data)
+                for _ in frames:
+                    await slots.acquire()
+                futures = connection.worker.submit_batch([(command, parameters) for _, command, parameters in frames],
+                                                         connection.flow, connection.priority)
+                for (request_id, _, _), future in zip(frames, futures):
+                    future.add_done_callback(lambda f, request_id=request_id:
+                                             loop.call_soon_threadsafe(write_response, request_id, f))
+        except Exception as e:
+            print("Error reading from TCP socket: {}".format(e), file=sys.stderr)
+        # Wait for the responses to the requests received so far
+        for _ in range(self.MAX_PENDING_REQUESTS):
+            await slots.acquire()
+        if not writer.is_closing():
+            try:
+                await writer.drain()
+            except Exception as e:
+                print("Error writing to TCP socket: {}".format(e), file=sys.stderr)
+
+    async def _read(self, reader, connection):
+        """
+        Read from a connection, unless it stays idle for `idle_timeout` seconds. Like with
+        :py:class:`froeling_proxy.FroelingProxyServer`, a connection is idle if it is neither read from nor
+        written to, so connections receiving subscription notifications or responses are kept open.
+
+        :param connection: the data object of the connection, with the value of the event loop's time()
+            when it was last read from or written to (last_activity)
+        :return: bytes read, or an empty bytes object if the connection was closed or has been idle
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            timeout = None if self.idle_timeout is None else \
+                connection.last_activity + self.idle_timeout - loop.time()
+            try:
+                data = await asyncio.wait_for(reader.read(1024), timeout)
+            except asyncio.TimeoutError:
+                if loop.time() < connection.last_activity + self.idle_timeout:
+                    continue  # Written to in the meantime
+                return b""
+            connection.last_activity = loop.time()
+            return data
+
+    def _write_push(self, writer, connection, line):
+        if not writer.is_closing():
+            writer.write(line)
+            self.bytes_sent += len(line)
+            connection.last_activity = asyncio.get_running_loop().time()
+
+    async def _write_responses(self, pending, writer, connection):
+        """
+        Write the responses to the client in the order of requests until None is received from the pending
+        queue. After an error, the connection is closed and remaining responses are discarded, so that
+        the reading side is never blocked on a full queue.
+        """
+        closed = False
+        while True:
+            response = await pending.get()
+            if response is None:
+                return
+            if closed:
+                continue
+            if not isinstance(response, bytes):
+                try:
+                    response = self._format_response(await asyncio.wrap_future(response))
+                except (SerialPortIOError, ResponseReadError) as e:
+                    response = self._format_error(e)
+                except Exception as e:
+                    print("Error handling request: {}".format(e), file=sys.stderr)
+                    writer.close()
+                    closed = True
+                    continue
+            try:
+                writer.write(response)
+                self.bytes_sent += len(response)
+                connection.last_activity = asyncio.get_running_loop().time()
+                await writer.drain()
+            except Exception as e:
+                print("Error writing to TCP socket: {}".format(e), file=sys.stderr)
+                writer.close()
+                closed = True
@@ -0,0 +1,126 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The binary protocol of the proxy server. Every request and response is a frame consisting of a 2-byte
+length of the rest of the frame, followed by a 4-byte request ID chosen by the client, all big-endian.
+In a request, the ID is followed by the command byte and the parameters; in a response, by a status byte
+(see :py:data:`STATUS_CODES`) and the response payload or, if the status is not :py:data:`STATUS_OK`,
+a UTF-8 message describing the error. Responses carry the ID of their request and are sent as soon as they
+are available, so they may arrive in a different order than the requests.
+"""
+
+import struct
+
+import froeling_lib
+
+HEADER = struct.Struct(">HIB")
+STATUS_OK = 0
+STATUS_INVALID_REQUEST = 1
+STATUS_ERROR = 2
+# Status codes of errors, by exception class; errors of other classes are reported with STATUS_ERROR
+STATUS_CODES = {
+    froeling_lib.SerialPortIOError: 3,
+    froeling_lib.ResponseReadError: 4,
+    froeling_lib.NoResponseError: 5,
+    froeling_lib.WrongResponseHeaderError: 6,
+    froeling_lib.WrongResponseCRCError: 7,
+    froeling_lib.WrongCommandInResponse: 8,
+    froeling_lib.IncompleteResponseError: 9,
+}
+
+
+class FrameReader:
+    """
+    Splits a stream of bytes into length-prefixed frames of the binary protocol.
+
+    :param max_frame_size: maximum length of a frame; longer frames are rejected
+    """
+    def __init__(self, max_frame_size=65535):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def __len__(self):
+        """
+        :return: number of bytes of an incomplete frame waiting in the buffer
+        """
+        return len(self.buffer)
+
+    def feed(self, data):
+        """
+        Append received data to the buffer and return all complete frames.
+
+        :param data: bytes received (bytes-like object)
+        :return: list of tuples of a request ID (int), a command or status byte (int) and a bytes object with
+            the parameters or payload
+        :raise ValueError: a frame is too short to contain an ID and a command or status byte, or too long
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - start >= HEADER.size:
+                length, request_id, code = HEADER.unpack_from(view, start)
+                if length < HEADER.size - 2 or length > self.max_frame_size:
+                    raise ValueError("Invalid frame length: {}".format(length))
+                end = start + 2 + length
+                if end > len(buffer):
+                    break
+                frames.append((request_id, code, bytes(view[start + HEADER.size:end])))
+                start = end
+        del buffer[:start]
+        return frames
+
+
+def encode_request(request_id, command, parameters=b""):
+    """
+    :param request_id: ID of the request (int between 0 and 2^32 - 1)
+    :param command: command byte (int)
+    :param parameters: command parameters (bytes-like object)
+    :return: bytes of the request frame
+    """
+    return HEADER.pack(HEADER.size - 2 + len(parameters), request_id, command) + bytes(parameters)
+
+
+def encode_response(request_id, status, payload=b""):
+    """
+    :param request_id: ID of the request the response is for
+    :param status: status byte (int)
+    :param payload: response payload or error message (bytes-like object)
+    :return: bytes of the response frame
+    """
+    return HEADER.pack(HEADER.size - 2 + len(payload), request_id, status) + bytes(payload)
+
+
+def encode_error(request_id, e):
+    """
+    :param request_id: ID of the request the response is for
+    :param e: the exception raised executing the request
+    :return: bytes of the response frame reporting the error
+    """
+    status = STATUS_CODES.get(type(e), STATUS_INVALID_REQUEST if isinstance(e, ValueError) else STATUS_ERROR)
+    return encode_response(request_id, status, str(e).encode("UTF-8"))
+
+
+def status_name(status):
+    """
+    :param status: status byte (int)
+    :return: name of the status: "OK", the name of the exception class, "InvalidRequest" or "Error"
+    """
+    if status == STATUS_OK:
+        return "OK"
+    if status == STATUS_INVALID_REQUEST:
+        return "InvalidRequest"
+    return next((cls.__name__ for cls, code in STATUS_CODES.items() if code == status), "Error")
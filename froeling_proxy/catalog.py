@@ -0,0 +1,201 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import importlib.util
+import json
+import operator
+import struct
+
+# NumPy is optional, and imported only when first needed, because importing it takes longer than a query
+numpy_available = importlib.util.find_spec("numpy") is not None
+
+
+CatalogEntry = collections.namedtuple("CatalogEntry", ["name", "label", "address", "scale", "signed", "unit"],
+                                      defaults=[1, True, None])
+CatalogEntry.__doc__ = """
+A value that can be read from the boiler with the command 0x30.
+
+:param name: short name of the value, used to request it (e.g. in the HTTP API)
+:param label: human-readable description, or None
+:param address: 2-byte address of the value (bytes object)
+:param scale: factor converting the 16-bit integer read from the boiler to the value in the given unit
+:param signed: whether the integer read from the boiler is signed
+:param unit: unit of the value (str), or None
+"""
+
+
+class Catalog:
+    """
+    An ordered collection of values (:py:class:`CatalogEntry`) that are read from the boiler together,
+    with a single request (0x30). The request and the decoder of its response are compiled when the catalog
+    is created: the response is unpacked by one :py:class:`struct.Struct` and scaled with a single map, so
+    decoding the response for hundreds of addresses takes microseconds. If NumPy is installed, the values
+    can also be decoded into an array with :py:meth:`decode_array`. Values are converted to strings only
+    on request, with :py:meth:`format`.
+
+    :param entries: iterable of :py:class:`CatalogEntry` objects or tuples of their fields; addresses can be
+        given as anything convertible to bytes (e.g. lists of ints)
+    :raise ValueError: an address is not 2 bytes long, or two entries have the same name
+    """
+    def __init__(self, entries):
+        self.entries = [CatalogEntry(*entry)._replace(address=bytes(entry[2])) for entry in entries]
+        self._by_name = {entry.name: entry for entry in self.entries}
+        if len(self._by_name) != len(self.entries):
+            raise ValueError("Duplicate names in catalog")
+        if any(len(entry.address) != 2 for entry in self.entries):
+            raise ValueError("Addresses must be 2 bytes long")
+        self.parameters = b"".join(entry.address for entry in self.entries)
+        self._struct = struct.Struct(">" + "".join("h" if entry.signed else "H" for entry in self.entries))
+        self._scales = [entry.scale for entry in self.entries]
+        self._unscaled = all(scale == 1 and isinstance(scale, int) for scale in self._scales)
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, name):
+        """
+        :param name: name of an entry
+        :return: the entry with the given name
+        :raise KeyError: no entry has the given name
+        """
+        return self._by_name[name]
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    @property
+    def names(self):
+        """
+        :return: list of names of all entries, in order
+        """
+        return [entry.name for entry in self.entries]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a catalog saved with :py:meth:`save`.
+
+        :param path: path of the catalog file
+        :return: a new :py:class:`Catalog`
+        :raise OSError: the file could not be read
+        :raise ValueError: the file is not a valid catalog
+        """
+        with open(path, encoding="UTF-8") as f:
+            try:
+                return cls(CatalogEntry(item["name"], item.get("label"), bytes.fromhex(item["address"]),
+                                        item.get("scale", 1), item.get("signed", True), item.get("unit"))
+                           for item in json.load(f))
+            except (KeyError, TypeError, AttributeError) as e:
+                raise ValueError("Invalid catalog entry: {}".format(e))
+
+    def save(self, path):
+        """
+        Save the catalog as a JSON list of objects with the fields of its entries, the addresses in hexadecimal.
+
+        :param path: path of the catalog file
+        """
+        with open(path, "w", encoding="UTF-8") as f:
+            json.dump([dict(entry._asdict(), address=entry.address.hex()) for entry in self.entries], f,
+                      ensure_ascii=False, indent=1)
+            f.write("\n")
+
+    def select(self, names):
+        """
+        Make a catalog of the given values. Names not in this catalog can be 4-digit hexadecimal addresses;
+        these are read as signed integers without a unit. Names given more than once are selected once.
+
+        :param names: iterable of names of entries or hexadecimal addresses
+        :return: a new :py:class:`Catalog`
+        :raise KeyError: a name is neither the name of an entry nor an address
+        """
+        entries = []
+        for name in dict.fromkeys(names):
+            entry = self._by_name.get(name)
+            if entry is None:
+                try:
+                    address = bytes.fromhex(name)
+                except ValueError:
+                    address = b""
+                if len(address) != 2:
+                    raise KeyError(name)
+                entry = CatalogEntry(name, None, address)
+            entries.append(entry)
+        return Catalog(entries)
+
+    def decode_raw(self, response):
+        """
+        :param response: response of the boiler to the request for values in the catalog (:py:attr:`parameters`)
+        :return: tuple of the integers read for the values, in order
+        :raise ValueError: the length of the response does not match the catalog
+        """
+        if len(response) != self._struct.size:
+            raise ValueError("Expected {} bytes of values, received {}".format(self._struct.size, len(response)))
+        return self._struct.unpack(response)
+
+    def decode(self, response):
+        """
+        :param response: response of the boiler to the request for values in the catalog (:py:attr:`parameters`)
+        :return: list of the values in their units, in order
+        :raise ValueError: the length of the response does not match the catalog
+        """
+        raw = self.decode_raw(response)
+        if self._unscaled:
+            return list(raw)
+        return list(map(operator.mul, raw, self._scales))
+
+    def decode_array(self, response):
+        """
+        Like :py:meth:`decode`, but return a NumPy array of floats, which is faster for large catalogs.
+
+        :raise ImportError: NumPy is not installed
+        """
+        if not numpy_available:
+            raise ImportError("NumPy is required to decode values into an array")
+        import numpy
+        if len(response) != self._struct.size:
+            raise ValueError("Expected {} bytes of values, received {}".format(self._struct.size, len(response)))
+        if self._arrays is None:
+            self._arrays = (numpy.array([entry.signed for entry in self.entries], dtype=bool),
+                            numpy.array(self._scales, dtype=float))
+        signed, scales = self._arrays
+        raw = numpy.frombuffer(response, dtype=">u2").astype(numpy.int32)
+        raw[signed & (raw >= 0x8000)] -= 0x10000
+        return raw * scales
+
+    def format(self, values):
+        """
+        :param values: values as returned by :py:meth:`decode`
+        :return: list of strings with the values, formatted with one decimal place (none if the scale is an
+            integer) and the unit
+        """
+        return [("{:.1f}" if isinstance(entry.scale, float) else "{}").format(value) + (entry.unit or "")
+                for entry, value in zip(self.entries, values)]
+
+
+# Values shown with `--values` and polled by the proxy
+DEFAULT_CATALOG = Catalog([
+    CatalogEntry("boiler_temperature", "Boiler temperature (Kesseltemperatur)", b"\x00\x00", 0.5, True, "°C"),
+    CatalogEntry("exhaust_temperature", "Exhaust temperature (Abgastemperatur)", b"\x00\x01", 1.0, True, "°C"),
+    CatalogEntry("external_temperature", "External temperature (Außentemperatur)", b"\x00\x04", 0.5, True, "°C"),
+    CatalogEntry("buffer_top_temperature", "Buffer top temperature (Puffer 1 oben)", b"\x00\x76", 0.5, True, "°C"),
+    CatalogEntry("buffer_bottom_temperature", "Buffer bottom temperature (Puffer 1 unten)", b"\x00\x78", 0.5, True,
+                 "°C"),
+    CatalogEntry("hot_water_temperature", "Hot water storage temperature (Boilertemperatur 1)", b"\x00\x5d", 0.5,
+                 True, "°C"),
+])
@@ -0,0 +1,61 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class LineFramer:
+    """
+    Splits a stream of bytes received from a TCP connection into lines terminated by a newline and/or
+    a carriage return character. Data is accumulated in a single bytearray; each call to :py:meth:`feed`
+    scans only the newly received bytes for line terminators and removes all complete lines from
+    the buffer at once, so the cost is linear in the amount of data received no matter how many lines
+    arrive in one chunk.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __len__(self):
+        """
+        :return: number of bytes of an incomplete line waiting in the buffer
+        """
+        return len(self.buffer)
+
+    def feed(self, data):
+        """
+        Append received data to the buffer and return all complete lines.
+
+        :param data: bytes received (bytes-like object)
+        :return: list of bytes objects with non-empty lines, without line terminators
+        """
+        buffer = self.buffer
+        scan_from = len(buffer)
+        buffer += data
+        lf = buffer.find(b"\n", scan_from)
+        cr = buffer.find(b"\r", scan_from)
+        if lf < 0 and cr < 0:
+            return []
+
+        lines = []
+        start = 0
+        with memoryview(buffer) as view:
+            while lf >= 0 or cr >= 0:
+                end = lf if cr < 0 or 0 <= lf < cr else cr
+                if end > start:
+                    lines.append(bytes(view[start:end]))
+                start = end + 1
+                if lf == end:
+                    lf = buffer.find(b"\n", start)
+                else:
+                    cr = buffer.find(b"\r", start)
+        del buffer[:start]
+        return lines
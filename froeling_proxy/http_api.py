@@ -0,0 +1,233 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import hashlib
+import json
+import sys
+import threading
+import urllib.parse
+
+from froeling_lib import SerialPortIOError, ResponseReadError
+from froeling_proxy.catalog import DEFAULT_CATALOG
+
+_CMD_READ_VALUES = 0x30
+_CMD_READ_STATE = 0x51
+_REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 502: "Bad Gateway"}
+
+
+class HttpApiError(Exception):
+    def __init__(self, status, message):
+        super(HttpApiError, self).__init__(message)
+        self.status = status
+
+
+class HttpApiServer:
+    """
+    An HTTP server answering requests for boiler values and state with decoded JSON, built on asyncio.
+
+    * `GET /values?names=NAME,AAAA,...` or `POST /values` with a JSON list of names and addresses (or an
+      object with the list under the key `values`): the values with the given names in the catalog
+      or the given 2-byte hexadecimal addresses; default is all values in the catalog. All values are read
+      from the boiler with a single request (0x30). The response is an object with the list `values` of
+      objects with the name, address, label, raw value (a 16-bit integer), decoded value and unit of each
+      value. Values not in the catalog are read as signed integers without a unit.
+    * `GET /state`: the boiler state (0x51) as an object with the raw response (`raw`, hexadecimal), the state
+      code (`code`, the first two bytes as an integer) and the lines of the state text (`text`).
+
+    Responses carry an ETag computed from their content; requests with a matching `If-None-Match` header
+    are answered with status 304 without a body. Errors are reported as objects with the key `error`, with
+    status 400 for invalid requests and 502 if the boiler could not be read.
+
+    :param worker: the :py:class:`froeling_proxy.worker.SerialWorker` to send the commands with
+    :param port: TCP port number to listen on (0 for any free port, which is then set in the attribute `port`)
+    :param catalog: :py:class:`froeling_proxy.catalog.Catalog` of known values; default is
+        :py:data:`froeling_proxy.catalog.DEFAULT_CATALOG`
+    :param address: address to listen on; default is all addresses (with port 0, all IPv4 addresses only, as
+        the free port chosen for IPv4 might not be free for IPv6)
+    :param priority: priority class of the requests sent to the worker
+    """
+    MAX_REQUEST_SIZE = 65536
+
+    def __init__(self, worker, port, catalog=None, address="", priority="interactive"):
+        self.worker = worker
+        self.port = port
+        self.address = address
+        self.priority = priority
+        self.catalog = DEFAULT_CATALOG if catalog is None else catalog
+        self.server = None
+        self._loop = None
+        self._thread = None
+
+    async def open(self):
+        """
+        Coroutine that opens the TCP socket and starts serving requests.
+
+        :return: the :py:class:`asyncio.Server` accepting the connections
+        """
+        # With port 0, listening on all addresses would bind a socket per address family, each to a different
+        # free port, and only one of them could be reported
+        host = self.address or (None if self.port else "0.0.0.0")
+        self.server = await asyncio.start_server(self._serve_connection, host=host, port=self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    def close(self):
+        """
+        Stop accepting connections.
+        """
+        if self.server is not None:
+            self.server.close()
+
+    def start(self):
+        """
+        Start serving requests with an event loop in a separate thread.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="froeling-http-api", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.open(), self._loop).result()
+
+    def stop(self):
+        """
+        Stop the server started with :py:meth:`start`.
+        """
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    async def _shutdown(self):
+        self.close()
+        await self.server.wait_closed()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._write_response(writer, 413, {"error": "Request header too large"}, {}, False)
+                    break
+                try:
+                    method, target, headers = _parse_head(head)
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    await self._write_response(writer, 400, {"error": "Invalid request"}, {}, False)
+                    break
+                if length > self.MAX_REQUEST_SIZE:
+                    await self._write_response(writer, 413, {"error": "Request body too large"}, headers, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    status, result = 200, await self._handle(method, target, body)
+                except HttpApiError as e:
+                    status, result = e.status, {"error": str(e)}
+                except (SerialPortIOError, ResponseReadError) as e:
+                    status, result = 502, {"error": "{}: {}".format(e.__class__.__name__, e)}
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, status, result, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except Exception as e:
+            print("Error serving HTTP request: {}".format(e), file=sys.stderr)
+        finally:
+            writer.close()
+
+    async def _handle(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        if url.path == "/values":
+            if method == "GET":
+                names = [name for value in urllib.parse.parse_qs(url.query).get("names", [])
+                         for name in value.split(",") if name]
+            elif method == "POST":
+                try:
+                    names = json.loads(body.decode("UTF-8") or "[]")
+                except ValueError:
+                    raise HttpApiError(400, "Invalid JSON")
+                if isinstance(names, dict):
+                    names = names.get("values", [])
+                if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+                    raise HttpApiError(400, "Expected a list of names or addresses")
+            else:
+                raise HttpApiError(405, "Method not allowed")
+            return {"values": await self._read_values(names or self.catalog.names)}
+        if url.path == "/state":
+            if method != "GET":
+                raise HttpApiError(405, "Method not allowed")
+            state = await asyncio.wrap_future(self.worker.submit(_CMD_READ_STATE, b"", priority=self.priority))
+            return {"raw": state.hex(), "code": int.from_bytes(state[:2], "big") if len(state) >= 2 else None,
+                    "text": state[2:].decode("iso-8859-1").split(";")}
+        raise HttpApiError(404, "Not found")
+
+    async def _read_values(self, names):
+        """
+        Read the values with the given names or addresses with a single request.
+
+        :return: list of dictionaries describing the values
+        """
+        try:
+            catalog = self.catalog.select(names)
+        except KeyError as e:
+            raise HttpApiError(400, "Unknown value: {}".format(e.args[0]))
+        response = await asyncio.wrap_future(self.worker.submit(_CMD_READ_VALUES, catalog.parameters,
+                                                                priority=self.priority))
+        try:
+            raw_values = catalog.decode_raw(response)
+        except ValueError as e:
+            raise HttpApiError(502, str(e))
+        return [{"name": entry.name, "address": entry.address.hex(), "label": entry.label, "raw": raw,
+                 "value": raw * entry.scale, "unit": entry.unit} for entry, raw in zip(catalog, raw_values)]
+
+    @staticmethod
+    async def _write_response(writer, status, result, headers, keep_alive):
+        body = json.dumps(result, ensure_ascii=False).encode("UTF-8")
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if status == 200 and etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+            status, body = 304, b""
+        lines = ["HTTP/1.1 {} {}".format(status, _REASONS.get(status, "")),
+                 "Content-Type: application/json; charset=utf-8",
+                 "Content-Length: {}".format(len(body)),
+                 "Cache-Control: no-cache",
+                 "Connection: " + ("keep-alive" if keep_alive else "close")]
+        if status in (200, 304):
+            lines.append("ETag: " + etag)
+        writer.write("\r\n".join(lines).encode() + b"\r\n\r\n" + body)
+        await writer.drain()
+
+
+def _parse_head(head):
+    """
+    :param head: bytes of the request line and headers
+    :return: tuple of the method, the request target and a dictionary of headers with lowercase names
+    :raise ValueError: invalid request line
+    """
+    lines = head.decode("iso-8859-1").split("\r\n")
+    method, target, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return method, target, headers
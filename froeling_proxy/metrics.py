@@ -0,0 +1,229 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    """
+    A registry of counters and histograms, rendered in the Prometheus text exposition format by
+    :py:meth:`render`. Updating a metric takes a lock and a couple of dictionary lookups, so the proxy can
+    be instrumented on its hot paths without noticeable overhead.
+
+    Metrics are identified by their name and a set of labels given as keyword arguments, e.g.
+    `metrics.inc("froeling_errors_total", command="30", error="NoResponseError")`. They are created when
+    first updated; their type and help text can be given in advance with :py:meth:`declare`. Values that
+    are already counted elsewhere (e.g. the hits of a :py:class:`froeling_lib.ResponseCache`) can be
+    exposed with :py:meth:`register_function`, which reads them only when the metrics are rendered.
+
+    Hooks registered with :py:meth:`add_hook` are called with every update, so the metrics can be consumed
+    in-process as well, e.g. forwarded to another monitoring system.
+
+    :param buckets: upper bounds of histogram buckets, in increasing order
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._descriptions = {}
+        self._counters = {}
+        self._histograms = {}
+        self._functions = []
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def declare(self, name, kind, help_text):
+        """
+        :param name: name of the metric
+        :param kind: "counter", "gauge" or "histogram"
+        :param help_text: description of the metric
+        """
+        self._descriptions[name] = (kind, help_text)
+
+    def add_hook(self, hook):
+        """
+        Register a function to be called with the name of the metric, the value added (to a counter)
+        or observed (by a histogram) and a dictionary of labels every time a metric is updated. Hooks are
+        called in the thread updating the metric; exceptions raised by them are printed to standard error
+        and otherwise ignored.
+
+        :param hook: the function to call
+        """
+        self._hooks.append(hook)
+
+    def register_function(self, name, kind, help_text, function):
+        """
+        Expose a value computed when the metrics are rendered.
+
+        :param name: name of the metric
+        :param kind: "counter" or "gauge"
+        :param help_text: description of the metric
+        :param function: function without arguments returning the value, or a dictionary mapping tuples
+            of (label name, label value) pairs to values
+        """
+        self.declare(name, kind, help_text)
+        self._functions.append((name, function))
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Add the given amount to a counter.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counters = self._counters.get(name)
+            if counters is None:
+                counters = self._counters[name] = {}
+            counters[key] = counters.get(key, 0) + amount
+        if self._hooks:
+            self._call_hooks(name, amount, labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram.
+        """
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histograms = self._histograms.get(name)
+            if histograms is None:
+                histograms = self._histograms[name] = {}
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += value
+        if self._hooks:
+            self._call_hooks(name, value, labels)
+
+    def snapshot(self):
+        """
+        :return: dictionary mapping names of metrics to dictionaries mapping label tuples to values; the value
+            of a histogram is a tuple of a list of cumulative counts of values in its buckets (the last one
+            being the count of all values), and the sum of values
+        """
+        with self._lock:
+            result = {name: dict(counters) for name, counters in self._counters.items()}
+            for name, histograms in self._histograms.items():
+                result[name] = {key: (_cumulative(counts), total) for key, (counts, total) in histograms.items()}
+        for name, function in self._functions:
+            try:
+                value = function()
+            except Exception as e:
+                print("Error computing metric {}: {}".format(name, e), file=sys.stderr)
+                continue
+            result[name] = value if isinstance(value, dict) else {(): value}
+        return result
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text exposition format (str)
+        """
+        lines = []
+        for name, values in sorted(self.snapshot().items()):
+            kind, help_text = self._descriptions.get(name, ("histogram" if name in self._histograms else
+                                                            "counter", None))
+            if help_text:
+                lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for key, value in sorted(values.items()):
+                if isinstance(value, tuple):
+                    counts, total = value
+                    for bound, count in zip(self.buckets + ("+Inf",), counts):
+                        lines.append("{}_bucket{} {}".format(name, _format_labels(key + (("le", str(bound)),)),
+                                                             count))
+                    lines.append("{}_sum{} {}".format(name, _format_labels(key), total))
+                    lines.append("{}_count{} {}".format(name, _format_labels(key), counts[-1]))
+                else:
+                    lines.append("{}{} {}".format(name, _format_labels(key), value))
+        return "\n".join(lines) + "\n"
+
+    def _call_hooks(self, name, value, labels):
+        for hook in self._hooks:
+            try:
+                hook(name, value, labels)
+            except Exception as e:
+                print("Error in metrics hook: {}".format(e), file=sys.stderr)
+
+
+class MetricsHttpServer:
+    """
+    An HTTP server serving the metrics, rendered by :py:meth:`Metrics.render`, at the path `/metrics`, in
+    a separate thread.
+
+    :param metrics: the :py:class:`Metrics` to serve
+    :param port: TCP port number to listen on (0 for any free port)
+    :param address: address to listen on; default is all addresses
+    """
+    def __init__(self, metrics, port, address=""):
+        self.metrics = metrics
+        self.address = address
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Open the socket and start serving requests in a separate thread.
+        """
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.address, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="froeling-metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving requests and close the socket.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+        self._server = None
+
+
+def _cumulative(counts):
+    result = []
+    total = 0
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in key) + "}"
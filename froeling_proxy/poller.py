@@ -0,0 +1,187 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import time
+from array import array
+
+import froeling_proxy
+
+
+class ValueHistory:
+    """
+    A ring buffer of the last samples of one value, i.e. pairs of a timestamp (seconds since the epoch)
+    and a signed 16-bit integer as read from the boiler. The samples are stored in two preallocated
+    arrays, so the memory used does not depend on the number of samples added.
+
+    :param capacity: maximum number of samples kept; when full, the oldest sample is overwritten
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.values = array("h", bytes(2 * capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        """
+        Add a sample. Timestamps are expected to be non-decreasing.
+
+        :param timestamp: time of the sample in seconds since the epoch (float)
+        :param value: the value as a signed 16-bit integer
+        """
+        self.timestamps[self._next] = timestamp
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def latest(self):
+        """
+        :return: the last (timestamp, value) pair added, or None if there are no samples
+        """
+        if not self._count:
+            return None
+        index = (self._next - 1) % self.capacity
+        return self.timestamps[index], self.values[index]
+
+    def samples(self, since=None):
+        """
+        :param since: only return samples taken at this time (seconds since the epoch) or later; default is
+            to return all samples
+        :return: list of (timestamp, value) pairs, oldest first
+        """
+        first = (self._next - self._count) % self.capacity
+        low, high = 0, self._count
+        if since is not None:
+            while low < high:
+                middle = (low + high) // 2
+                if self.timestamps[(first + middle) % self.capacity] < since:
+                    low = middle + 1
+                else:
+                    high = middle
+        indexes = [(first + i) % self.capacity for i in range(low, self._count)]
+        return [(self.timestamps[i], self.values[i]) for i in indexes]
+
+
+class Poller:
+    """
+    Periodically reads a set of values and the boiler state, and keeps the latest snapshot and a bounded
+    history of every value in memory, so they can be served to clients without any serial communication.
+
+    The values are read with :py:func:`froeling_proxy.read_values` and the state with
+    :py:func:`froeling_proxy.read_state`, using the given object to send the commands. Within a proxy,
+    that should be its :py:class:`froeling_proxy.worker.SerialWorker`, so that polling takes turns with
+    the clients' commands.
+
+    :param froeling: object used to send the commands, i.e. a Froeling or a SerialWorker
+    :param addresses: iterable of 2-byte addresses (bytes objects or lists of ints) of values to read
+    :param interval: number of seconds between polls
+    :param history_size: number of samples kept for each value
+    :param poll_state: whether to read the boiler state as well
+    """
+    def __init__(self, froeling, addresses, interval=10.0, history_size=360, poll_state=True):
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.froeling = froeling
+        self.addresses = [bytes(address) for address in addresses]
+        if any(len(address) != 2 for address in self.addresses):
+            raise ValueError("addresses must be 2 bytes long")
+        self.interval = interval
+        self.poll_state = poll_state
+        self.histories = {address: ValueHistory(history_size) for address in self.addresses}
+        self.state = None
+        self.state_timestamp = None
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start polling in a separate thread. The first poll is done immediately.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="froeling-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop polling and wait for the poll in progress (if any) to complete.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def poll(self):
+        """
+        Read the values and the state once and record them.
+
+        :raise SerialPortIOError: I/O error on the serial port (see :py:meth:`froeling_lib.Froeling.send_command`)
+        :raise ResponseReadError: invalid or no response from the boiler
+        """
+        if self.addresses:
+            values = froeling_proxy.read_values(self.froeling, b"".join(self.addresses))
+            timestamp = time.time()
+            if len(values) != 2 * len(self.addresses):
+                raise froeling_proxy.ProxyCommandError(
+                    "Expected {} bytes of values, received {}".format(2 * len(self.addresses), len(values)))
+            with self._lock:
+                for i, address in enumerate(self.addresses):
+                    self.histories[address].append(
+                        timestamp, int.from_bytes(values[2 * i:2 * i + 2], "big", signed=True))
+        if self.poll_state:
+            state = froeling_proxy.read_state(self.froeling)
+            with self._lock:
+                self.state, self.state_timestamp = state, time.time()
+
+    def current_values(self, addresses):
+        """
+        :param addresses: iterable of 2-byte addresses (bytes objects)
+        :return: bytes object with the latest 2-byte values of the given addresses, as in a response to
+            :py:func:`froeling_proxy.read_values`
+        :raise KeyError: an address is not polled or has not been read yet
+        """
+        with self._lock:
+            latest = [self.histories[address].latest() for address in addresses]
+        if None in latest:
+            raise KeyError("not read yet")
+        return b"".join(value.to_bytes(2, "big", signed=True) for _, value in latest)
+
+    def history(self, address, since=None):
+        """
+        :param address: 2-byte address (bytes object)
+        :param since: only return samples taken at this time (seconds since the epoch) or later
+        :return: list of (timestamp, value) pairs, oldest first, where values are signed 16-bit integers
+        :raise KeyError: the address is not polled
+        """
+        with self._lock:
+            return self.histories[address].samples(since)
+
+    def _run(self):
+        next_poll = time.monotonic()
+        while not self._stopped.wait(max(0.0, next_poll - time.monotonic())):
+            next_poll += self.interval
+            try:
+                self.poll()
+            except Exception as e:
+                self.errors += 1
+                print("Error polling boiler: {}".format(e), file=sys.stderr)
+            next_poll = max(next_poll, time.monotonic())
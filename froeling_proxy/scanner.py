@@ -0,0 +1,207 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A scanner discovering which addresses of values (command 0x30) a boiler supports. Run it with
+`python -m froeling_proxy.scanner TTY OUTPUT`; see `--help` for options.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import froeling_proxy
+from froeling_lib import Froeling, ConnectionInitializationError, SerialPortIOError, ResponseReadError
+from froeling_proxy.catalog import Catalog, CatalogEntry
+
+
+class AddressScanner:
+    """
+    Finds the readable addresses in a range by requesting many addresses at once. If the boiler answers
+    a batch with an error or with fewer values than requested, the batch is split in two halves, which are
+    probed separately, until the unreadable addresses are isolated; a range of readable addresses thus
+    takes a single round-trip. The size of new batches adapts to the observed latency: it is doubled after
+    a batch answered faster than `target_latency` and halved after a slower one.
+
+    Progress is saved to the checkpoint file (if given) after every batch, and a scan started with an
+    existing checkpoint file continues where the previous one stopped; the checkpoint must be of a scan of
+    the same range.
+
+    :param froeling: the :py:class:`froeling_lib.Froeling` (or :py:class:`froeling_proxy.worker.SerialWorker`)
+        to read the values with
+    :param start: first address to scan (int)
+    :param end: last address to scan (int)
+    :param batch_size: initial number of addresses per request
+    :param max_batch_size: maximum number of addresses per request; at most as many as the values a response
+        can hold (see `max_message_length` of :py:class:`froeling_lib.Froeling`), 256 by default
+    :param target_latency: latency of a batch (in seconds) above which the batch size is reduced
+    :param checkpoint: path of the checkpoint file, or None
+    :raise ValueError: invalid address range, or the checkpoint is of a scan of another range
+    """
+    def __init__(self, froeling, start=0x0000, end=0xffff, batch_size=32, max_batch_size=256, target_latency=0.5,
+                 checkpoint=None):
+        if not 0 <= start <= end <= 0xffff:
+            raise ValueError("Invalid address range")
+        self.froeling = froeling
+        max_message_length = getattr(froeling, "max_message_length", Froeling.MAX_MESSAGE_LENGTH)
+        self.max_batch_size = min(max_batch_size, (max_message_length - 1) // 2)
+        self.target_latency = target_latency
+        self.checkpoint = checkpoint
+        self.batch_size = min(batch_size, self.max_batch_size)
+        self.start = start
+        self.next_address = start
+        self.end = end
+        self.readable = {}
+        self.requests = 0
+        # Ranges (start, count) split off failed batches, to be probed before continuing at next_address
+        self._pending = []
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self._load_checkpoint()
+
+    @property
+    def done(self):
+        return not self._pending and self.next_address > self.end
+
+    def scan(self, progress=None):
+        """
+        Scan all remaining addresses.
+
+        :param progress: function called after every request with the scanner, or None
+        :return: dictionary mapping readable addresses (int) to the values read from them (signed int)
+        """
+        while not self.done:
+            self.step()
+            if progress is not None:
+                progress(self)
+        return self.readable
+
+    def step(self):
+        """
+        Probe the next batch of addresses.
+        """
+        if self._pending:
+            start, count = self._pending.pop()
+            fresh = False
+        else:
+            start, count = self.next_address, min(self.batch_size, self.end + 1 - self.next_address)
+            self.next_address += count
+            fresh = True
+        parameters = b"".join(address.to_bytes(2, "big") for address in range(start, start + count))
+        began = time.monotonic()
+        self.requests += 1
+        try:
+            response = froeling_proxy.read_values(self.froeling, parameters)
+        except ResponseReadError:
+            response = None
+        latency = time.monotonic() - began
+        if response is not None and len(response) == 2 * count:
+            for i in range(count):
+                self.readable[start + i] = int.from_bytes(response[2 * i:2 * i + 2], "big", signed=True)
+            if fresh:
+                if latency < self.target_latency:
+                    self.batch_size = min(2 * self.batch_size, self.max_batch_size)
+                else:
+                    self.batch_size = max(self.batch_size // 2, 1)
+        elif count > 1:
+            half = count // 2
+            # Probed last-in, first-out, so the lower half goes on top
+            self._pending.append((start + half, count - half))
+            self._pending.append((start, half))
+            if fresh:
+                self.batch_size = max(self.batch_size // 2, 1)
+        if self.checkpoint is not None:
+            self._save_checkpoint()
+
+    def catalog(self):
+        """
+        :return: :py:class:`froeling_proxy.catalog.Catalog` of the readable addresses found so far, named
+            `value_AAAA` after their addresses and read as signed integers without a unit
+        """
+        return Catalog(CatalogEntry("value_{:04x}".format(address), None, address.to_bytes(2, "big"))
+                       for address in sorted(self.readable))
+
+    def _save_checkpoint(self):
+        state = {
+            "start": self.start,
+            "next_address": self.next_address,
+            "end": self.end,
+            "batch_size": self.batch_size,
+            "pending": self._pending,
+            "readable": {"{:04x}".format(address): value for address, value in self.readable.items()},
+        }
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(state, f)
+        os.replace(temporary, self.checkpoint)
+
+    def _load_checkpoint(self):
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        # Checkpoints written before the start was saved are taken to be of the same start
+        if state.get("start", self.start) != self.start or state["end"] != self.end:
+            raise ValueError("Checkpoint {} is of a scan of {:04x}-{:04x}, not {:04x}-{:04x}".format(
+                self.checkpoint, state.get("start", self.start), state["end"], self.start, self.end))
+        self.next_address = state["next_address"]
+        self.batch_size = min(state["batch_size"], self.max_batch_size)
+        self._pending = [tuple(entry) for entry in state["pending"]]
+        self.readable = {int(address, 16): value for address, value in state["readable"].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Discover the addresses of values a Fröling boiler supports.")
+    parser.add_argument("tty", help="TTY device of serial port")
+    parser.add_argument("output", help="path of the catalog file to write the readable addresses to")
+    parser.add_argument("--start", help="first address to scan (hexadecimal)", default="0000")
+    parser.add_argument("--end", help="last address to scan (hexadecimal)", default="ffff")
+    parser.add_argument("--batch-size", help="initial number of addresses per request", type=int, default=32)
+    parser.add_argument("--max-batch-size", help="maximum number of addresses per request", type=int, default=256)
+    parser.add_argument("--target-latency", help="reduce the batch size when a request takes longer than this "
+                                                 "many seconds", type=float, default=0.5)
+    parser.add_argument("--checkpoint", help="save progress to this file and resume from it if it exists")
+    args = parser.parse_args()
+
+    try:
+        froeling = Froeling(args.tty)
+    except ConnectionInitializationError as e:
+        sys.stderr.write("Error connecting to TTY device: {}\n".format(e))
+        sys.exit(1)
+    try:
+        scanner = AddressScanner(froeling, int(args.start, 16), int(args.end, 16), batch_size=args.batch_size,
+                                 max_batch_size=args.max_batch_size, target_latency=args.target_latency,
+                                 checkpoint=args.checkpoint)
+    except ValueError as e:
+        sys.stderr.write("{}\n".format(e))
+        sys.exit(1)
+
+    def progress(s):
+        print("\r{:04x}: {} readable, {} requests, batch size {}  ".format(
+            min(s.next_address, s.end), len(s.readable), s.requests, s.batch_size), end="", file=sys.stderr)
+
+    try:
+        scanner.scan(progress)
+    except SerialPortIOError as e:
+        sys.stderr.write("\nError communicating with the boiler: {}\n".format(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.stderr.write("\nInterrupted\n")
+        sys.exit(1)
+    finally:
+        scanner.catalog().save(args.output)
+    print(file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import itertools
+
+# Weights of the priority classes; a flow of a class with twice the weight gets twice the share of the serial
+# line when both are busy
+PRIORITY_WEIGHTS = {"interactive": 16.0, "normal": 4.0, "background": 1.0}
+DEFAULT_PRIORITY = "normal"
+
+
+class FairQueue:
+    """
+    A queue of items from several flows (e.g. client connections) served by weighted fair queueing. Items of
+    each flow are served in the order they were added, while the flows share the server in proportion to
+    the weights of their priority classes: a flow that has been served less than its share gets its next
+    item served first. The same flow can add items in different priority classes; these are then treated as
+    separate flows.
+
+    Every item is tagged with a virtual start time (the later of the virtual time when it is added and
+    the finish tag of the previous item of its flow) and a finish tag (start plus the inverse of the weight).
+    Items are served in the order of their finish tags, as in weighted fair queueing, but the virtual time is
+    kept as in start-time fair queueing rather than by simulating a fluid server: serving an item advances it
+    to the item's start tag. Selecting by finish tags lets the weight decide which of two items with the same
+    start is served first, so an item added to an idle flow of a heavily weighted class is served right after
+    the item in service, no matter how many items other flows have queued.
+
+    :param weights: dictionary mapping names of priority classes to their weights; default is
+        :py:data:`PRIORITY_WEIGHTS`
+    """
+    def __init__(self, weights=None):
+        self.weights = dict(PRIORITY_WEIGHTS if weights is None else weights)
+        if any(weight <= 0 for weight in self.weights.values()):
+            raise ValueError("weights must be positive")
+        self.virtual_time = 0.0
+        self._flows = {}
+        self._finish_tags = {}
+        self._sequence = itertools.count()
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def push(self, item, flow=None, priority=DEFAULT_PRIORITY):
+        """
+        :param item: the item to add
+        :param flow: hashable identifier of the flow; None for the flow of all items without one
+        :param priority: name of the priority class
+        :raise ValueError: unknown priority class
+        """
+        weight = self.weights.get(priority)
+        if weight is None:
+            raise ValueError("Unknown priority: {}".format(priority))
+        key = (flow, priority)
+        start = max(self.virtual_time, self._finish_tags.get(key, 0.0))
+        finish = start + 1.0 / weight
+        self._finish_tags[key] = finish
+        entries = self._flows.get(key)
+        if entries is None:
+            entries = self._flows[key] = collections.deque()
+        entries.append((finish, next(self._sequence), start, item))
+        self._length += 1
+
+    def pop(self):
+        """
+        :return: the item to serve next
+        :raise IndexError: the queue is empty
+        """
+        if not self._flows:
+            raise IndexError("pop from an empty queue")
+        key = min(self._flows, key=lambda k: self._flows[k][0][:2])
+        entries = self._flows[key]
+        _, _, start, item = entries.popleft()
+        self.virtual_time = max(self.virtual_time, start)
+        self._length -= 1
+        if not entries:
+            del self._flows[key]
+            if len(self._finish_tags) > 1024:
+                # Flows whose items have all started are not behind anyone any more and can be forgotten
+                self._finish_tags = {k: tag for k, tag in self._finish_tags.items()
+                                     if k in self._flows or tag > self.virtual_time}
+        return item
+
+    def items(self):
+        """
+        :return: list of all queued items in the order they would be served if no more items were added
+        """
+        return [entry[3] for entry in sorted(entry for entries in self._flows.values() for entry in entries)]
+
+    def remove(self, items):
+        """
+        Remove the given items (compared by identity) from the queue.
+        """
+        removed = set(map(id, items))
+        for key in list(self._flows):
+            entries = collections.deque(entry for entry in self._flows[key] if id(entry[3]) not in removed)
+            self._length -= len(self._flows[key]) - len(entries)
+            if entries:
+                self._flows[key] = entries
+            else:
+                del self._flows[key]
+
+    def clear(self):
+        """
+        Remove all items from the queue.
+
+        :return: list of the removed items
+        """
+        items = [entry[3] for entries in self._flows.values() for entry in entries]
+        self._flows = {}
+        self._length = 0
+        return items
+
+    def depths(self):
+        """
+        :return: dictionary mapping the names of all priority classes to the numbers of their queued items
+        """
+        result = dict.fromkeys(self.weights, 0)
+        for (_, priority), entries in self._flows.items():
+            result[priority] += len(entries)
+        return result
@@ -0,0 +1,273 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Commands whose responses are recorded (CMD_AKTUELLE_WERTE_DES_KESSELS, CMD_KESSELZUSTAND_ABFRAGEN)
+_CMD_READ_VALUES = 0x30
+_CMD_READ_STATE = 0x51
+
+
+class TimeSeriesStore:
+    """
+    A persistent, append-only store of samples of boiler values. Each sample is a fixed-size binary record
+    of a timestamp (seconds since the epoch), a 2-byte address and a signed 16-bit value, appended to
+    the file `<path>.raw`. Rollups with minimum, maximum, sum and count of the samples of each address per
+    minute and per hour are maintained incrementally and appended to `<path>.minute` and `<path>.hour`
+    whenever a minute or an hour has passed.
+
+    All files are sorted by time, so :py:meth:`query` finds the requested range by binary search in
+    memory-mapped files and reads only the records within it. Timestamps of samples must therefore not
+    decrease; samples older than the last one recorded are recorded with the timestamp of the last one.
+
+    The state of the boiler (the first two bytes of the response to reading it) is recorded as a value
+    with address :py:attr:`STATE_ADDRESS`.
+
+    A record left incomplete by a process killed while writing it is removed when the store is opened for
+    writing, so that the records appended after it stay aligned.
+
+    Rollups of the current minute and hour are kept in memory until they are complete or the store is
+    closed; they are included in the results of :py:meth:`query` of the store that recorded them, but not of
+    other stores opened on the same files.
+
+    :param path: path and file name prefix of the files of the store
+    :param readonly: open the store only for querying
+    """
+    RAW_RECORD = struct.Struct("<dHh")
+    ROLLUP_RECORD = struct.Struct("<IHhhIq")
+    RESOLUTIONS = {"minute": 60, "hour": 3600}
+    STATE_ADDRESS = 0xffff
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        mode = "rb" if readonly else "a+b"
+        self._files = {"raw": open(path + ".raw", mode)}
+        for resolution in TimeSeriesStore.RESOLUTIONS:
+            self._files[resolution] = open(path + "." + resolution, mode)
+        if not readonly:
+            for name, f in self._files.items():
+                record = TimeSeriesStore.RAW_RECORD if name == "raw" else TimeSeriesStore.ROLLUP_RECORD
+                size = os.fstat(f.fileno()).st_size
+                if size % record.size:
+                    f.truncate(size - size % record.size)
+        self._maps = {name: (0, memoryview(b"")) for name in self._files}
+        self._open_buckets = {resolution: (None, {}) for resolution in TimeSeriesStore.RESOLUTIONS}
+        self._lock = threading.Lock()
+        last = self._last_raw_record()
+        self._last_timestamp = last[0] if last else float("-inf")
+
+    def close(self):
+        """
+        Write the rollups of the current minute and hour and close the files.
+        """
+        with self._lock:
+            if not self.readonly:
+                for resolution in TimeSeriesStore.RESOLUTIONS:
+                    self._close_bucket(resolution)
+            for f in self._files.values():
+                f.close()
+            self._maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, timestamp, samples):
+        """
+        Record samples taken at the same time.
+
+        :param timestamp: time the samples were taken, in seconds since the epoch
+        :param samples: iterable of (address, value) pairs, where address is an int between 0 and 65535 and
+            value is a signed 16-bit integer
+        """
+        with self._lock:
+            timestamp = max(timestamp, self._last_timestamp)
+            self._last_timestamp = timestamp
+            samples = list(samples)
+            self._files["raw"].write(b"".join(TimeSeriesStore.RAW_RECORD.pack(timestamp, address, value)
+                                              for address, value in samples))
+            for resolution, seconds in TimeSeriesStore.RESOLUTIONS.items():
+                bucket_start = int(timestamp // seconds) * seconds
+                if bucket_start != self._open_buckets[resolution][0]:
+                    self._close_bucket(resolution)
+                    self._open_buckets[resolution] = (bucket_start, {})
+                buckets = self._open_buckets[resolution][1]
+                for address, value in samples:
+                    bucket = buckets.get(address)
+                    if bucket is None:
+                        buckets[address] = [value, value, 1, value]
+                    else:
+                        bucket[0] = min(bucket[0], value)
+                        bucket[1] = max(bucket[1], value)
+                        bucket[2] += 1
+                        bucket[3] += value
+            for f in self._files.values():
+                f.flush()
+
+    def record_response(self, command, parameters, response, timestamp=None):
+        """
+        Record the values contained in a response from the boiler, if the command is reading values (0x30)
+        or the boiler state (0x51); other commands are ignored. This can be used as a listener of
+        a :py:class:`froeling_proxy.worker.SerialWorker`.
+
+        :param command: command byte (int)
+        :param parameters: parameters of the command (bytes object)
+        :param response: response payload (bytes object)
+        :param timestamp: time of the response in seconds since the epoch; default is now
+        """
+        if command == _CMD_READ_VALUES and len(response) == len(parameters) and len(parameters) % 2 == 0:
+            samples = [(int.from_bytes(parameters[i:i + 2], "big"),
+                        int.from_bytes(response[i:i + 2], "big", signed=True))
+                       for i in range(0, len(parameters), 2)]
+        elif command == _CMD_READ_STATE and len(response) >= 2:
+            samples = [(TimeSeriesStore.STATE_ADDRESS, int.from_bytes(response[:2], "big", signed=True))]
+        else:
+            return
+        self.append(time.time() if timestamp is None else timestamp, samples)
+
+    def query(self, addresses=None, start=None, end=None, resolution="raw"):
+        """
+        Read the samples or rollups of the given addresses in the given time range. The results are produced
+        lazily, directly from the memory-mapped files, so memory use does not depend on the size of the range.
+
+        :param addresses: iterable of addresses (ints) to return; default is all
+        :param start: start of the range in seconds since the epoch (inclusive); default is the beginning
+        :param end: end of the range in seconds since the epoch (exclusive); default is the end
+        :param resolution: "raw" for samples or one of the keys of :py:attr:`RESOLUTIONS` for rollups
+        :return: iterator of (timestamp, address, value) tuples for raw samples, or of
+            (start of minute or hour, address, minimum, maximum, average, count) tuples for rollups; sorted
+            by time
+        :raise ValueError: unknown resolution
+        """
+        addresses = None if addresses is None else frozenset(addresses)
+        if resolution == "raw":
+            return self._query_raw(addresses, start, end)
+        if resolution not in TimeSeriesStore.RESOLUTIONS:
+            raise ValueError("Unknown resolution: " + resolution)
+        return self._query_rollups(resolution, addresses, start, end)
+
+    def _query_raw(self, addresses, start, end):
+        view, count = self._map("raw", TimeSeriesStore.RAW_RECORD)
+        record = TimeSeriesStore.RAW_RECORD
+        low = 0 if start is None else _bisect(view, record, count, start)
+        high = count if end is None else _bisect(view, record, count, end)
+        for timestamp, address, value in record.iter_unpack(view[low * record.size:high * record.size]):
+            if addresses is None or address in addresses:
+                yield timestamp, address, value
+
+    def _query_rollups(self, resolution, addresses, start, end):
+        seconds = TimeSeriesStore.RESOLUTIONS[resolution]
+        view, count = self._map(resolution, TimeSeriesStore.ROLLUP_RECORD)
+        record = TimeSeriesStore.ROLLUP_RECORD
+        low = 0 if start is None else _bisect(view, record, count, int(start // seconds) * seconds)
+        high = count if end is None else _bisect(view, record, count, end)
+        with self._lock:
+            open_start, open_buckets = self._open_buckets.get(resolution, (None, {}))
+            open_records = [(open_start, address, bucket[0], bucket[1], bucket[2], bucket[3])
+                            for address, bucket in sorted(open_buckets.items())]
+        if open_start is not None and ((end is not None and open_start >= end) or
+                                       (start is not None and open_start + seconds <= start)):
+            open_records = []
+
+        # Rollups of the same period and address may be split over several records (e.g. if the store was
+        # closed and reopened within an hour), so records of each period are combined before being returned
+        group_start = None
+        group = {}
+        for bucket_start, address, minimum, maximum, n, total in \
+                itertools.chain(record.iter_unpack(view[low * record.size:high * record.size]), open_records):
+            if addresses is not None and address not in addresses:
+                continue
+            if bucket_start != group_start:
+                yield from _rollup_results(group_start, group)
+                group_start = bucket_start
+                group = {}
+            combined = group.get(address)
+            if combined is None:
+                group[address] = [minimum, maximum, n, total]
+            else:
+                combined[0] = min(combined[0], minimum)
+                combined[1] = max(combined[1], maximum)
+                combined[2] += n
+                combined[3] += total
+        yield from _rollup_results(group_start, group)
+
+    def _close_bucket(self, resolution):
+        bucket_start, buckets = self._open_buckets[resolution]
+        if bucket_start is not None and buckets:
+            self._files[resolution].write(b"".join(
+                TimeSeriesStore.ROLLUP_RECORD.pack(bucket_start, address, *bucket)
+                for address, bucket in sorted(buckets.items())))
+            self._files[resolution].flush()
+        self._open_buckets[resolution] = (None, {})
+
+    def _map(self, name, record):
+        """
+        :return: a memoryview of the file with the given name, mapped to memory, and the number of complete
+            records in it; the file is mapped again if it has grown since it was last mapped
+        """
+        with self._lock:
+            size = os.fstat(self._files[name].fileno()).st_size
+            mapped_size, view = self._maps[name]
+            if size != mapped_size:
+                # Views returned earlier keep their mapping alive until they are no longer used
+                view = memoryview(mmap.mmap(self._files[name].fileno(), 0, access=mmap.ACCESS_READ)) \
+                    if size else memoryview(b"")
+                self._maps[name] = (size, view)
+        return view, len(view) // record.size
+
+    def _last_raw_record(self):
+        view, count = self._map("raw", TimeSeriesStore.RAW_RECORD)
+        return TimeSeriesStore.RAW_RECORD.unpack_from(view, (count - 1) * TimeSeriesStore.RAW_RECORD.size) \
+            if count else None
+
+
+def read_range(path, addresses=None, start=None, end=None, resolution="raw"):
+    """
+    Open the store with the given path for reading, and read the samples or rollups of the given addresses
+    in the given time range. See :py:meth:`TimeSeriesStore.query` for details; the store is closed when all
+    results have been read.
+
+    :param path: path and file name prefix of the files of the store
+    :return: iterator of tuples as returned by :py:meth:`TimeSeriesStore.query`
+    """
+    with TimeSeriesStore(path, readonly=True) as store:
+        yield from store.query(addresses, start, end, resolution)
+
+
+def _bisect(view, record, count, value):
+    """
+    :return: index of the first of count records in view whose first field is not less than value
+    """
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if record.unpack_from(view, middle * record.size)[0] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _rollup_results(bucket_start, group):
+    for address in sorted(group):
+        minimum, maximum, n, total = group[address]
+        yield bucket_start, address, minimum, maximum, total / n, n
@@ -0,0 +1,248 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import sys
+import threading
+import time
+
+from froeling_proxy.scheduling import DEFAULT_PRIORITY
+
+_CMD_READ_VALUES = 0x30
+_CMD_READ_STATE = 0x51
+
+
+class Subscription:
+    """
+    A client's subscription to changes of a set of values and, optionally, the boiler state. Created by
+    :py:meth:`SubscriptionManager.subscribe`.
+
+    The attributes `values` and `state` hold the values (signed 16-bit integers, by address) and the state
+    last delivered to the subscriber.
+    """
+    def __init__(self, subscription_id, addresses, state, interval, deadband, callback):
+        self.id = subscription_id
+        self.addresses = addresses
+        self.subscribes_state = state
+        self.interval = interval
+        self.deadband = deadband
+        self.callback = callback
+        self.values = {}
+        self.state = None
+        self.last_delivery = None
+
+
+class _PollGroup:
+    """
+    The subscriptions to the same set of values, served by one shared poll.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.subscriptions = {}
+        self.next_poll = time.monotonic()
+        self.futures = None
+
+    @property
+    def interval(self):
+        return min(subscription.interval for subscription in self.subscriptions.values())
+
+
+class SubscriptionManager:
+    """
+    Polls the values (and the boiler state) that clients have subscribed to and delivers only the changes.
+
+    Subscriptions to the same set of addresses (and the state, or not) of the same boiler share one poll,
+    sent to the boiler's :py:class:`froeling_proxy.worker.SerialWorker` every interval of the most demanding subscriber; a poll
+    is not repeated before the previous one has completed. After each poll, every subscription whose own
+    interval has elapsed since its last delivery receives the values that differ from the ones last
+    delivered to it by more than its deadband, and the state if it changed. Nothing is delivered while
+    nothing changes.
+
+    Changes are delivered by calling the subscription's callback, in the worker thread, with the
+    :py:class:`Subscription`, a list of (address, value) pairs of changed values and the new state (or None
+    if it did not change). If the callback returns False (e.g. because the client is not reading), the
+    changes are considered not delivered and are offered again after the next poll.
+
+    The numbers of failed polls and of deliveries are counted in the attributes `errors` and `deliveries`.
+
+    :param worker: the :py:class:`froeling_proxy.worker.SerialWorker` to send the polls with, unless another
+        one is given for a subscription
+    :param priority: priority class of the polls
+    :param min_interval: the shortest interval a subscription may request, in seconds
+    """
+    def __init__(self, worker, priority=DEFAULT_PRIORITY, min_interval=0.5):
+        self.worker = worker
+        self.priority = priority
+        self.min_interval = min_interval
+        self.errors = 0
+        self.deliveries = 0
+        self._groups = {}
+        self._subscriptions = {}
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def start(self):
+        """
+        Start polling in a separate thread.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="froeling-subscriptions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop polling. Polls already sent to the worker may still deliver changes.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def subscribe(self, addresses, interval, callback, deadband=0, state=False, worker=None):
+        """
+        :param addresses: iterable of 2-byte addresses (bytes objects or lists of ints) of values
+        :param interval: minimum number of seconds between deliveries
+        :param callback: function called with the changes (see above)
+        :param deadband: changes of a value by at most this much (in the units of the integer read from the
+            boiler) since its last delivery are not delivered
+        :param state: whether to subscribe to the boiler state as well
+        :param worker: the :py:class:`froeling_proxy.worker.SerialWorker` of the boiler to read the values from;
+            default is the manager's worker
+        :return: the new :py:class:`Subscription`
+        :raise ValueError: no addresses and no state, an address not 2 bytes long, an interval shorter than
+            min_interval or a negative deadband
+        """
+        addresses = tuple(bytes(address) for address in addresses)
+        if not addresses and not state:
+            raise ValueError("Nothing to subscribe to")
+        if any(len(address) != 2 for address in addresses):
+            raise ValueError("addresses must be 2 bytes long")
+        if interval < self.min_interval:
+            raise ValueError("interval must be at least {} seconds".format(self.min_interval))
+        if deadband < 0:
+            raise ValueError("deadband must not be negative")
+        key = (self.worker if worker is None else worker, addresses, bool(state))
+        with self._condition:
+            subscription = Subscription(next(self._ids), addresses, bool(state), interval, deadband, callback)
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _PollGroup(key)
+            group.subscriptions[subscription.id] = subscription
+            # Poll right away, so the new subscriber gets the current values
+            group.next_poll = min(group.next_poll, time.monotonic())
+            self._subscriptions[subscription.id] = group
+            self._condition.notify()
+        return subscription
+
+    def unsubscribe(self, subscription_id):
+        """
+        :param subscription_id: ID of a subscription
+        :return: whether the subscription existed
+        """
+        with self._condition:
+            group = self._subscriptions.pop(subscription_id, None)
+            if group is None:
+                return False
+            del group.subscriptions[subscription_id]
+            if not group.subscriptions:
+                del self._groups[group.key]
+            return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                due = [group for group in self._groups.values() if group.futures is None and group.next_poll <= now]
+                for group in due:
+                    group.futures = ()
+                    group.next_poll = now + group.interval
+                waiting = [group.next_poll for group in self._groups.values() if group.futures is None]
+                if not due:
+                    self._condition.wait(min(waiting) - now if waiting else None)
+                    continue
+            for group in due:
+                self._poll(group)
+
+    def _poll(self, group):
+        worker, addresses, state = group.key
+        requests = ([(_CMD_READ_VALUES, b"".join(addresses))] if addresses else []) + \
+            ([(_CMD_READ_STATE, b"")] if state else [])
+        try:
+            futures = worker.submit_batch(requests, group, self.priority)
+        except Exception as e:
+            self.errors += 1
+            print("Error polling subscribed values: {}".format(e), file=sys.stderr)
+            with self._condition:
+                group.futures = None
+            return
+        with self._condition:
+            group.futures = futures
+        for future in futures:
+            future.add_done_callback(lambda _: self._poll_done(group, futures))
+
+    def _poll_done(self, group, futures):
+        with self._condition:
+            if group.futures is not futures or not all(future.done() for future in futures):
+                return
+            group.futures = None
+            group.next_poll = max(group.next_poll, time.monotonic())
+            subscriptions = list(group.subscriptions.values())
+            self._condition.notify()
+        _, addresses, state = group.key
+        try:
+            responses = [future.result() for future in futures]
+            values = {}
+            if addresses:
+                response = responses.pop(0)
+                if len(response) != 2 * len(addresses):
+                    raise ValueError("Expected {} bytes of values, received {}".format(2 * len(addresses),
+                                                                                      len(response)))
+                values = {address: int.from_bytes(response[2 * i:2 * i + 2], "big", signed=True)
+                          for i, address in enumerate(addresses)}
+            new_state = responses.pop(0) if state else None
+        except Exception as e:
+            self.errors += 1
+            print("Error polling subscribed values: {}".format(e), file=sys.stderr)
+            return
+        now = time.monotonic()
+        for subscription in subscriptions:
+            if subscription.last_delivery is not None and now - subscription.last_delivery < subscription.interval:
+                continue
+            changes = [(address, value) for address, value in values.items()
+                       if address not in subscription.values
+                       or abs(value - subscription.values[address]) > subscription.deadband]
+            changed_state = new_state if state and new_state != subscription.state else None
+            if not changes and changed_state is None:
+                continue
+            try:
+                delivered = subscription.callback(subscription, changes, changed_state)
+            except Exception as e:
+                print("Error delivering subscribed values: {}".format(e), file=sys.stderr)
+                continue
+            if delivered is False:
+                continue
+            subscription.values.update(changes)
+            if changed_state is not None:
+                subscription.state = changed_state
+            subscription.last_delivery = now
+            self.deliveries += 1
@@ -0,0 +1,220 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from froeling_client import FroelingClient
+from froeling_proxy.scheduling import PRIORITY_WEIGHTS, DEFAULT_PRIORITY
+from froeling_proxy.worker import READ_ONLY_COMMANDS
+
+
+class UpstreamPool(FroelingClient):
+    """
+    A :py:class:`froeling_client.FroelingClient` of another proxy server, used as the backend of a proxy
+    server instead of a serial connection (see :py:class:`UpstreamWorker`). Errors reported by the upstream
+    proxy are raised as the exceptions of :py:mod:`froeling_lib` with the same names, so the pool can stand
+    in for a :py:class:`froeling_lib.Froeling` object; like it, it can have a
+    :py:class:`froeling_lib.ResponseCache`.
+
+    :param host: host name or address of the upstream proxy
+    :param port: TCP port of the upstream proxy
+    :param connections: maximum number of connections to open
+    :param cache: a :py:class:`froeling_lib.ResponseCache` for the responses, or None
+    :param priority: priority class to request for the connections (with the `#priority` proxy command), or
+        None to use the upstream port's default
+    :param connect_timeout: number of seconds to wait for a connection to be established
+    """
+    def __init__(self, host, port, connections=2, cache=None, priority=None, connect_timeout=5.0):
+        super(UpstreamPool, self).__init__(host, port, connections=connections, priority=priority,
+                                           connect_timeout=connect_timeout)
+        self.cache = cache
+        # Line noise is discarded by the upstream proxy
+        self.bytes_discarded = 0
+
+
+class UpstreamWorker:
+    """
+    Executes commands through an :py:class:`UpstreamPool` instead of a serial connection, with the interface
+    of :py:class:`froeling_proxy.worker.SerialWorker`, so a proxy server can use another proxy server as its
+    backend. Requests are handed to a sender thread, which sends them upstream right away, so that
+    submitting never blocks the caller (e.g. the event loop of the proxy server) while a connection to the
+    upstream proxy is being opened or the upstream proxy is not reading; the upstream proxy takes care of
+    scheduling them on the serial line. Responses are cached in the pool's
+    :py:class:`froeling_lib.ResponseCache` (if it has one), and identical requests for reading data waiting
+    for the same response are coalesced (commands that might change the boiler's state are always sent), so
+    clients of the local proxy asking for the same values cause a single request
+    upstream. The number of coalesced requests is counted in the attribute `coalesced`.
+
+    Priority classes are accepted for compatibility, but all requests are sent upstream in the order they
+    are submitted, and the queue depths are always zero; give the pool a priority class to have the upstream
+    proxy schedule the requests accordingly.
+
+    If a :py:class:`froeling_proxy.metrics.Metrics` is given, the time until the upstream proxy responds is
+    recorded in the histogram `froeling_upstream_seconds` and failed requests are counted in
+    `froeling_errors_total`, labelled with the command byte (and the errors with the class of the exception).
+
+    :param pool: the :py:class:`UpstreamPool` to send the requests with
+    :param coalesce: whether to coalesce identical requests (default is True)
+    :param metrics: a :py:class:`froeling_proxy.metrics.Metrics` to record the metrics of requests to
+    """
+    def __init__(self, pool, coalesce=True, metrics=None):
+        self.froeling = pool
+        self.coalesce = coalesce
+        self.metrics = metrics
+        self.coalesced = 0
+        self.merged = 0
+        self._listeners = []
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._outbox = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the sender thread. Does nothing if it is already running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="froeling-upstream-sender", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the sender thread and close the upstream connections. Requests not sent yet are cancelled, and
+        requests waiting for responses fail.
+        """
+        self._outbox.put(None)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        while True:
+            try:
+                batch = self._outbox.get_nowait()
+            except queue.Empty:
+                break
+            for message, future in batch[1] if batch is not None else []:
+                with self._lock:
+                    if self._in_flight.get(message) is future:
+                        del self._in_flight[message]
+                future.cancel()
+        self.froeling.close()
+
+    @property
+    def queue_depth(self):
+        return 0
+
+    @property
+    def queue_depths(self):
+        return dict.fromkeys(PRIORITY_WEIGHTS, 0)
+
+    @property
+    def priorities(self):
+        return list(PRIORITY_WEIGHTS)
+
+    def add_listener(self, listener):
+        """
+        Register a function to be called with the command byte, the parameters and the response payload
+        every time a response is received from the upstream proxy (but not from the cache).
+        """
+        self._listeners.append(listener)
+
+    def send_command(self, command, *parameters):
+        """
+        Send a command and wait for its response, like :py:meth:`froeling_lib.Froeling.send_command`.
+        """
+        return self.submit(command, b"".join(map(bytes, parameters))).result()
+
+    def submit(self, command, parameters=b"", flow=None, priority=None):
+        """
+        Send a command upstream, like :py:meth:`froeling_proxy.worker.SerialWorker.submit`.
+
+        :return: :py:class:`concurrent.futures.Future` of the response
+        """
+        return self.submit_batch([(command, parameters)], flow, priority)[0]
+
+    def submit_batch(self, requests, flow=None, priority=None):
+        """
+        Send several commands upstream at once, like :py:meth:`froeling_proxy.worker.SerialWorker.submit_batch`.
+
+        :return: list of :py:class:`concurrent.futures.Future` objects, one per request, in the same order
+        :raise ValueError: unknown priority class
+        """
+        if (DEFAULT_PRIORITY if priority is None else priority) not in PRIORITY_WEIGHTS:
+            raise ValueError("Unknown priority: {}".format(priority))
+        cache = self.froeling.cache
+        futures = []
+        to_send = []
+        with self._lock:
+            for command, parameters in requests:
+                message = bytes([command]) + bytes(parameters)
+                coalesce = self.coalesce and command in READ_ONLY_COMMANDS
+                future = self._in_flight.get(message) if coalesce else None
+                if future is not None:
+                    self.coalesced += 1
+                    futures.append(future)
+                    continue
+                response = cache.get(message) if cache is not None else None
+                future = Future()
+                futures.append(future)
+                if response is not None:
+                    future.set_running_or_notify_cancel()
+                    future.set_result(response)
+                    continue
+                if coalesce:
+                    self._in_flight[message] = future
+                to_send.append((message, future))
+        if to_send:
+            self._outbox.put((time.monotonic(), to_send))
+        return futures
+
+    def _run(self):
+        while True:
+            batch = self._outbox.get()
+            if batch is None:
+                return
+            started, to_send = batch
+            upstream_futures = self.froeling.submit([message for message, _ in to_send])
+            for (message, future), upstream_future in zip(to_send, upstream_futures):
+                upstream_future.add_done_callback(
+                    lambda f, message=message, future=future: self._done(message, future, f, started))
+
+    def _done(self, message, future, upstream_future, started):
+        command = "{:02x}".format(message[0])
+        error = upstream_future.exception()
+        if self.metrics is not None:
+            self.metrics.observe("froeling_upstream_seconds", time.monotonic() - started, command=command)
+            if error is not None:
+                self.metrics.inc("froeling_errors_total", command=command, error=error.__class__.__name__)
+        if error is None:
+            response = upstream_future.result()
+            if self.froeling.cache is not None:
+                self.froeling.cache.put(message, response)
+            for listener in self._listeners:
+                try:
+                    listener(message[0], message[1:], response)
+                except Exception as e:
+                    print("Error in upstream worker listener: {}".format(e), file=sys.stderr)
+        with self._lock:
+            if self._in_flight.get(message) is future:
+                del self._in_flight[message]
+        if future.set_running_or_notify_cancel():
+            if error is None:
+                future.set_result(upstream_future.result())
+            else:
+                future.set_exception(error)
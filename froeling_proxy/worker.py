@@ -0,0 +1,378 @@
+# Copyright 2021 Matija Polajnar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from froeling_proxy.scheduling import FairQueue, DEFAULT_PRIORITY
+
+# Command for reading values (CMD_AKTUELLE_WERTE_DES_KESSELS), whose requests can be merged into one frame
+MERGEABLE_COMMAND = 0x30
+# Commands that only read data from the boiler, so their order relative to each other does not matter
+READ_ONLY_COMMANDS = frozenset([0x30, 0x51])
+
+
+class SerialWorker:
+    """
+    A thread that owns the serial connection to the boiler and executes commands submitted by any number
+    of clients one at a time. Callers are never blocked by the serial
+    exchange; they receive a :py:class:`concurrent.futures.Future` that is resolved with the boiler's
+    response (or the exception raised by :py:meth:`froeling_lib.Froeling.send_command`) once the command
+    has been executed. If the Froeling object has a :py:class:`froeling_lib.ResponseCache`, commands with
+    a cached response are answered immediately, without being queued.
+
+    Commands are submitted in flows (e.g. one per client connection) and priority classes, and are queued
+    in a :py:class:`froeling_proxy.scheduling.FairQueue`: the commands of each flow are executed in the order
+    they were submitted, while the flows share the serial line in proportion to the weights of their priority
+    classes, so a client sending many requests does not hold up the others, and a request of
+    an `interactive` client is executed right after the command in flight. Commands submitted without a flow
+    all belong to the same flow, so they are executed in the order they were submitted. The priority class
+    of particular commands can be set regardless of the flow with `command_priorities`.
+
+    Identical requests for reading data (the same read-only command with the same parameters) are
+    coalesced: while a request is waiting in the queue or being executed, submitting an identical one does
+    not queue it again, but returns the same future, so all submitters receive the same response or error
+    (unless the waiting request is of a priority class with a lower weight, which would delay the new one, or
+    the flow of the new request has a command that might change the boiler's state waiting or being
+    executed, which the waiting request might be executed before, so reads are never moved ahead of writes).
+    Commands that might change the boiler's state are never coalesced. The number of requests coalesced
+    this way is counted in the attribute `coalesced`.
+
+    Optionally, requests for reading values (0x30) waiting in the queue can be merged into a single
+    request for the (deduplicated) union of their 2-byte addresses, and the response is split back into
+    responses for each of the merged requests, in the order of their own addresses. Only requests that would
+    be executed before any command that might change the boiler's state are merged, so reads are never
+    moved ahead of writes. If the merged request fails or its response is not of the expected length,
+    the requests are executed one by one instead. The number of requests answered from merged requests
+    is counted in the attribute `merged`.
+
+    Listeners can be registered with :py:meth:`add_listener` to observe all responses received from
+    the boiler.
+
+    If a :py:class:`froeling_proxy.metrics.Metrics` is given, the time requests wait in the queue and
+    the time of serial exchanges are recorded in the histograms `froeling_queue_wait_seconds` and
+    `froeling_serial_seconds`, and failed exchanges are counted in `froeling_errors_total`, all labelled
+    with the command byte (and the errors with the class of the exception) and any labels given with
+    `metric_labels` (e.g. to tell apart the workers of several boilers).
+
+    :param froeling: the Froeling object used to relay commands to the boiler
+    :param coalesce: whether to coalesce identical requests (default is True)
+    :param max_merged_addresses: maximum number of addresses in a merged request for reading values;
+        default is 0 (no merging)
+    :param merge_window: number of seconds to wait for more requests to merge with a request for reading
+        values before executing it; default is 0 (merge only requests that are already waiting)
+    :param metrics: a :py:class:`froeling_proxy.metrics.Metrics` to record the metrics of requests to
+    :param weights: dictionary mapping names of priority classes to their weights; default is
+        :py:data:`froeling_proxy.scheduling.PRIORITY_WEIGHTS`
+    :param command_priorities: dictionary mapping command bytes (ints) to names of priority classes used for
+        them instead of the class they are submitted with
+    :param metric_labels: dictionary of labels added to all metrics recorded by the worker
+    """
+    def __init__(self, froeling, coalesce=True, max_merged_addresses=0, merge_window=0.0, metrics=None,
+                 weights=None, command_priorities=None, metric_labels=None):
+        self.froeling = froeling
+        self.coalesce = coalesce
+        self.max_merged_addresses = max_merged_addresses
+        self.merge_window = merge_window
+        self.metrics = metrics
+        self.metric_labels = dict(metric_labels or {})
+        self.command_priorities = dict(command_priorities or {})
+        self.coalesced = 0
+        self.merged = 0
+        self._listeners = []
+        self._in_flight = {}
+        # Numbers of commands that are not read-only waiting or being executed, by flow
+        self._writes = {}
+        self._queue = FairQueue(weights)
+        if any(priority not in self._queue.weights for priority in self.command_priorities.values()):
+            raise ValueError("Unknown priority in command_priorities")
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """
+        Start the worker thread. Does nothing if it is already running.
+        """
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="froeling-serial-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the worker thread after the command currently in flight (if any) completes. Commands still
+        waiting in the queue are cancelled.
+        """
+        with self._condition:
+            self._running = False
+            pending = self._queue.clear()
+            self._in_flight.clear()
+            self._condition.notify_all()
+        for _, _, future, _ in pending:
+            future.cancel()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    @property
+    def queue_depth(self):
+        """
+        Number of commands waiting to be executed (not including the one in flight).
+        """
+        return len(self._queue)
+
+    @property
+    def queue_depths(self):
+        """
+        Dictionary mapping the names of all priority classes to the numbers of their commands waiting to be
+        executed.
+        """
+        with self._condition:
+            return self._queue.depths()
+
+    @property
+    def priorities(self):
+        """
+        Names of the priority classes.
+        """
+        return list(self._queue.weights)
+
+    def add_listener(self, listener):
+        """
+        Register a function to be called, in the worker thread, with the command byte, the parameters and
+        the response payload (bytes objects) every time a response is received from the boiler, before
+        the response is passed on to the submitters of the request. Merged
+        requests are reported once, as a single request for all their addresses. Exceptions raised by
+        listeners are printed to standard error and otherwise ignored.
+
+        :param listener: the function to call
+        """
+        self._listeners.append(listener)
+
+    def send_command(self, command, *parameters):
+        """
+        Queue a command and wait for its response. This mirrors :py:meth:`froeling_lib.Froeling.send_command`,
+        so a worker can be used in place of a Froeling object, e.g. with :py:func:`froeling_proxy.read_values`.
+
+        :param command: command byte (int)
+        :param parameters: command parameters (list of ints, bytes object...)
+        :return: bytes object with response payload
+        :raise SerialPortIOError: I/O error on writing to or reading from the serial port
+        :raise ResponseReadError: invalid or no response was received from the boiler
+        """
+        return self.submit(command, bytes([value for parameter in parameters for value in parameter])).result()
+
+    def submit(self, command, parameters=b"", flow=None, priority=None):
+        """
+        Queue a command for execution on the serial connection.
+
+        :param command: command byte (int)
+        :param parameters: command parameters (bytes object or iterable of ints)
+        :param flow: hashable identifier of the flow (e.g. client connection) the command belongs to
+        :param priority: name of the priority class of the flow; default is `normal`
+        :return: a :py:class:`concurrent.futures.Future` resolving to the response payload (bytes object)
+        :raise ValueError: unknown priority class
+        """
+        return self.submit_batch([(command, parameters)], flow, priority)[0]
+
+    def submit_batch(self, requests, flow=None, priority=None):
+        """
+        Queue several commands for execution on the serial connection at once. Commands of the same
+        priority class are executed in the given order.
+
+        :param requests: iterable of (command, parameters) tuples, as accepted by :py:meth:`submit`
+        :param flow: hashable identifier of the flow (e.g. client connection) the commands belong to
+        :param priority: name of the priority class of the flow; default is `normal`
+        :return: list of :py:class:`concurrent.futures.Future` objects, one per request, in the same order
+        :raise ValueError: unknown priority class
+        """
+        priority = DEFAULT_PRIORITY if priority is None else priority
+        if priority not in self._queue.weights:
+            raise ValueError("Unknown priority: {}".format(priority))
+        cache = getattr(self.froeling, "cache", None)
+        futures = []
+        with self._condition:
+            for command, parameters in requests:
+                parameters = bytes(parameters)
+                command_priority = self.command_priorities.get(command, priority)
+                weight = self._queue.weights[command_priority]
+                read_only = command in READ_ONLY_COMMANDS
+                if self.coalesce and read_only and not self._writes.get(flow):
+                    future, queued_weight = self._in_flight.get((command, parameters), (None, None))
+                    if future is not None and (queued_weight >= weight or future.running()):
+                        self.coalesced += 1
+                        futures.append(future)
+                        continue
+                future = Future()
+                futures.append(future)
+                response = cache.get(bytes([command]) + parameters) if cache is not None else None
+                if response is not None:
+                    future.set_result(response)
+                    continue
+                self._queue.push((command, parameters, future, time.monotonic()), flow, command_priority)
+                if self.coalesce and read_only:
+                    self._in_flight[(command, parameters)] = (future, weight)
+                elif self.coalesce:
+                    self._writes[flow] = self._writes.get(flow, 0) + 1
+                    future.add_done_callback(lambda _, flow=flow: self._write_done(flow))
+            self._condition.notify()
+        return futures
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                jobs = [self._queue.pop()]
+                if self._mergeable(jobs[0]):
+                    if self.merge_window > 0:
+                        self._wait_for(self.merge_window)
+                        if not self._running:
+                            jobs[0][2].cancel()
+                            return
+                    jobs += self._take_mergeable_jobs(_split_addresses(jobs[0][1]))
+
+            running_jobs = []
+            started = time.monotonic()
+            for command, parameters, future, submitted in jobs:
+                if future.set_running_or_notify_cancel():
+                    running_jobs.append((command, parameters, future))
+                    if self.metrics is not None:
+                        self.metrics.observe("froeling_queue_wait_seconds", started - submitted,
+                                             command="{:02x}".format(command), **self.metric_labels)
+                else:
+                    self._finish(command, parameters, future)
+            if len(running_jobs) > 1:
+                self._execute_merged(running_jobs)
+            elif running_jobs:
+                self._execute(*running_jobs[0])
+
+    def _execute(self, command, parameters, future):
+        try:
+            response = self._send_command(command, parameters)
+        except Exception as e:
+            self._finish(command, parameters, future)
+            future.set_exception(e)
+        else:
+            self._notify_listeners(command, parameters, response)
+            self._finish(command, parameters, future)
+            future.set_result(response)
+
+    def _execute_merged(self, jobs):
+        addresses = list(dict.fromkeys(address for _, parameters, _ in jobs
+                                       for address in _split_addresses(parameters)))
+        try:
+            response = self._send_command(MERGEABLE_COMMAND, b"".join(addresses))
+        except Exception:
+            response = None
+        if response is None or len(response) != 2 * len(addresses):
+            for job in jobs:
+                self._execute(*job)
+            return
+
+        self._notify_listeners(MERGEABLE_COMMAND, b"".join(addresses), response)
+        values = {address: response[2 * i:2 * i + 2] for i, address in enumerate(addresses)}
+        cache = getattr(self.froeling, "cache", None)
+        for command, parameters, future in jobs:
+            job_response = b"".join(values[address] for address in _split_addresses(parameters))
+            if cache is not None:
+                cache.put(bytes([command]) + parameters, job_response)
+            self._finish(command, parameters, future)
+            future.set_result(job_response)
+        self.merged += len(jobs)
+
+    def _send_command(self, command, parameters):
+        if self.metrics is None:
+            return self.froeling.send_command(command, parameters)
+        started = time.monotonic()
+        try:
+            return self.froeling.send_command(command, parameters)
+        except Exception as e:
+            self.metrics.inc("froeling_errors_total", command="{:02x}".format(command), error=e.__class__.__name__,
+                             **self.metric_labels)
+            raise
+        finally:
+            self.metrics.observe("froeling_serial_seconds", time.monotonic() - started,
+                                 command="{:02x}".format(command), **self.metric_labels)
+
+    def _notify_listeners(self, command, parameters, response):
+        for listener in self._listeners:
+            try:
+                listener(command, parameters, response)
+            except Exception as e:
+                print("Error in serial worker listener: {}".format(e), file=sys.stderr)
+
+    def _mergeable(self, job):
+        command, parameters = job[:2]
+        return self.max_merged_addresses > 0 and command == MERGEABLE_COMMAND and \
+            parameters and len(parameters) % 2 == 0
+
+    def _wait_for(self, seconds):
+        """
+        Wait (with the condition held) for the given number of seconds, or until the worker is stopped,
+        letting other threads submit requests in the meantime.
+        """
+        deadline = time.monotonic() + seconds
+        remaining = seconds
+        while self._running and remaining > 0:
+            self._condition.wait(remaining)
+            remaining = deadline - time.monotonic()
+
+    def _take_mergeable_jobs(self, addresses):
+        """
+        Remove from the queue (with the condition held) and return the requests for reading values that
+        can be merged with a request for the given addresses.
+        """
+        addresses = set(addresses)
+        taken = []
+        for job in self._queue.items():
+            if self._mergeable(job):
+                new_addresses = set(_split_addresses(job[1])) - addresses
+                if len(addresses) + len(new_addresses) > self.max_merged_addresses:
+                    break
+                addresses |= new_addresses
+                taken.append(job)
+            elif job[0] not in READ_ONLY_COMMANDS:
+                break
+        self._queue.remove(taken)
+        return taken
+
+    def _write_done(self, flow):
+        with self._condition:
+            self._writes[flow] -= 1
+            if not self._writes[flow]:
+                del self._writes[flow]
+
+    def _finish(self, command, parameters, future):
+        """
+        Stop coalescing new requests with the given one, which has been executed.
+        """
+        with self._condition:
+            if self._in_flight.get((command, parameters), (None,))[0] is future:
+                del self._in_flight[(command, parameters)]
+
+
+def _split_addresses(parameters):
+    """
+    :param parameters: concatenation of 2-byte addresses (bytes object)
+    :return: list of 2-byte bytes objects
+    """
+    return [parameters[i:i + 2] for i in range(0, len(parameters), 2)]
@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import tempfile
+import time
 import unittest
 import pytest
 import froeling_lib
+from froeling_lib.trace import Exchange, ReplayPort, TraceWriter, read_trace
 
 
 class MockedTty:
@@ -38,6 +42,31 @@ class MockedTty:
         pass
 
 
+class ExhaustibleTty(MockedTty):
+    def read(self, n):
+        if not self.answer_from_boiler:
+            raise AssertionError("Waited for more bytes than the boiler answered")
+        return super(ExhaustibleTty, self).read(n)
+
+
+class EndlessTty(MockedTty):
+    """
+    A mocked TTY that answers every read with the requested number of bytes, repeating the given ones.
+    """
+    def __init__(self, answer):
+        super(EndlessTty, self).__init__()
+        self.answer = answer
+        self.received = 0
+
+    def write(self, data):
+        pass
+
+    def read(self, n):
+        offset = self.received % len(self.answer)
+        self.received += n
+        return (self.answer * (n // len(self.answer) + 2))[offset:offset + n]
+
+
 class FroelingTest(unittest.TestCase):
     def setUp(self):
         self.mocked_tty = MockedTty()
@@ -110,3 +139,271 @@ class FroelingTest(unittest.TestCase):
             self._test(
                 [0x02, 0xfd, 0x00, 0x01, 0x52, 0xf4],
                 [])
+
+    def test_send_command_skips_garbage_and_other_frames(self):
+        self.mocked_tty.expect_exchange(
+            [0x02, 0xfd, 0x00, 0x01, 0x51, 0xf1],
+            [0x00, 0x02, 0x02, 0xfd, 0x00, 0x02, 0x52, 0x07, 0x00, 0x02, 0xfd, 0x00, 0x03, 0x51, 0x01, 0x02,
+             0x03])
+        self.assertEqual(b"\x01\x02", self.froeling.send_command(0x51))
+
+    def test_send_command_skips_truncated_frame(self):
+        for froeling in [self.froeling, self.froeling_crc]:
+            self.mocked_tty.expect_exchange(
+                [0x02, 0xfd, 0x00, 0x01, 0x51, 0xf1],
+                [0x02, 0xfd, 0x00, 0x05, 0x51, 0x02, 0xfd, 0x00, 0x03, 0x51, 0x01, 0x02, 0xf2])
+            self.assertEqual(b"\x01\x02", froeling.send_command(0x51))
+
+    def test_send_command_does_not_wait_for_frame_of_stray_header(self):
+        tty = ExhaustibleTty()
+        tty.expect_exchange(
+            [0x02, 0xfd, 0x00, 0x01, 0x51, 0xf1],
+            [0x00, 0x02, 0xfd, 0x02, 0xfd, 0x00, 0x03, 0x51, 0x01, 0x02, 0xf2])
+        self.assertEqual(b"\x01\x02", froeling_lib.Froeling(tty).send_command(0x51))
+
+
+    def test_send_command_gives_up_on_endless_noise_and_other_frames(self):
+        for answer, error in [(b"\x00", froeling_lib.WrongResponseHeaderError),
+                              (b"\x02\xfd\x00\x01\x52\xf4", froeling_lib.WrongCommandInResponse)]:
+            tty = EndlessTty(answer)
+            froeling = froeling_lib.Froeling(tty)
+            with pytest.raises(error):
+                froeling.send_command(0x51)
+            self.assertLessEqual(tty.received, froeling.max_received_bytes + len(answer))
+
+    def test_longer_frames_with_raised_max_message_length(self):
+        answer = froeling_lib.encode_frame(b"\x52" + bytes(1000))
+        with pytest.raises(froeling_lib.WrongResponseHeaderError):
+            self._test([0x02, 0xfd, 0x00, 0x01, 0x52, 0xf4], answer)
+        self._test([0x02, 0xfd, 0x00, 0x01, 0x52, 0xf4], answer,
+                   froeling_lib.Froeling(self.mocked_tty, max_message_length=1001))
+
+class FrameDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = froeling_lib.FrameDecoder()
+
+    def test_frame_is_returned_once_complete(self):
+        frame = bytes([0x02, 0xfd, 0x00, 0x03, 0x51, 0x01, 0x02, 0xf2])
+        for i, byte in enumerate(frame[:-1]):
+            self.decoder.feed(bytes([byte]))
+            self.assertIsNone(self.decoder.next_frame())
+            self.assertEqual(max(1, 4 - i - 1) if i < 3 else len(frame) - i - 1, self.decoder.bytes_needed())
+        self.decoder.feed(frame[-1:])
+        self.assertEqual((b"\x51\x01\x02", 0xf2, 0xf2), self.decoder.next_frame())
+        self.assertIsNone(self.decoder.next_frame())
+
+    def test_garbage_before_frame_is_discarded(self):
+        self.decoder.feed(b"\xff\x00\xfd\x02")
+        self.assertIsNone(self.decoder.next_frame())
+        self.assertEqual(3, self.decoder.discarded)
+        self.decoder.feed(b"\xfd\x00\x01\x51\x03\x02\xfd\x00\x01\x52\x00")
+        self.assertEqual([(b"\x51", 0xf1, 0x03), (b"\x52", 0xf4, 0x00)], list(iter(self.decoder.next_frame, None)))
+        self.assertEqual(0, len(self.decoder.buffer))
+
+    def test_incomplete_frame_lengths(self):
+        self.decoder.feed(b"\x02\xfd\x00\x05\x51\x01")
+        self.assertEqual((6, 2), self.decoder.incomplete_frame_lengths())
+
+    def test_header_search_restarts_after_truncated_frame(self):
+        self.decoder.feed(b"\x02\xfd\x00\x05\x51\x02\xfd\x00\x03\x51\x01\x02\xf2")
+        self.assertEqual((b"\x51\x01\x02", 0xf2, 0xf2), self.decoder.next_frame())
+        self.assertEqual(5, self.decoder.discarded)
+
+    def test_header_with_too_long_length_is_skipped(self):
+        self.decoder.feed(b"\x00\x02\xfd\x02\xfd\x00\x03\x51\x01\x02\xf2")
+        self.assertEqual((b"\x51\x01\x02", 0xf2, 0xf2), self.decoder.next_frame())
+        self.assertEqual(3, self.decoder.discarded)
+
+    def test_table_driven_crc_matches_definition(self):
+        for frame in [b"", b"\x02\xfd\x00\x01\x51", bytes(range(256))]:
+            crc = 0
+            for byte in frame:
+                crc = (crc ^ byte ^ (byte * 2 & 0xff)) & 0xff
+            self.assertEqual(crc, froeling_lib._compute_crc(frame))
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.mocked_tty = MockedTty()
+        self.cache = froeling_lib.ResponseCache(ttl=60, ttls={0x51: 0.05}, max_entries=2)
+        self.froeling = froeling_lib.Froeling(self.mocked_tty, cache=self.cache)
+
+    def _exchange(self, command, parameters, answer):
+        message = bytes([command]) + bytes(parameters)
+        frame = froeling_lib.Froeling.BLOCK_START + len(message).to_bytes(2, "big") + message
+        self.mocked_tty.expect_exchange(frame + bytes([froeling_lib._compute_crc(frame)]), answer)
+        return self.froeling.send_command(command, parameters)
+
+    def test_repeated_command_is_answered_from_cache(self):
+        self.assertEqual(b"\x00\x0b", self._exchange(0x30, [0x00, 0x04], [0x02, 0xfd, 0x00, 0x03, 0x30, 0x00, 0x0b, 0x00]))
+        self.assertEqual(b"\x00\x0b", self.froeling.send_command(0x30, [0x00, 0x04]))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(b"\x00\x0c", self._exchange(0x30, [0x00, 0x05], [0x02, 0xfd, 0x00, 0x03, 0x30, 0x00, 0x0c, 0x00]))
+
+    def test_only_allowed_commands_are_cached(self):
+        self._exchange(0x52, [], [0x02, 0xfd, 0x00, 0x01, 0x52, 0x00])
+        with pytest.raises(froeling_lib.NoResponseError):
+            self.froeling.send_command(0x52)
+
+    def test_ttls_of_commands_not_allowed_are_rejected(self):
+        with pytest.raises(ValueError):
+            froeling_lib.ResponseCache(ttls={0x52: 60})
+        with pytest.raises(ValueError):
+            froeling_lib.ResponseCache(commands=[0x30], ttls={0x51: 60})
+
+    def test_cached_response_expires(self):
+        self._exchange(0x51, [], [0x02, 0xfd, 0x00, 0x02, 0x51, 0x01, 0x00])
+        self.assertEqual(b"\x01", self.froeling.send_command(0x51))
+        time.sleep(0.1)
+        with pytest.raises(froeling_lib.NoResponseError):
+            self.froeling.send_command(0x51)
+
+    def test_least_recently_used_response_is_evicted(self):
+        self.cache.put(b"\x30\x00\x01", b"\x00\x01")
+        self.cache.put(b"\x30\x00\x02", b"\x00\x02")
+        self.assertIsNotNone(self.cache.get(b"\x30\x00\x01"))
+        self.cache.put(b"\x30\x00\x03", b"\x00\x03")
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get(b"\x30\x00\x02"))
+        self.assertIsNotNone(self.cache.get(b"\x30\x00\x01"))
+
+
+class TimedTty(MockedTty):
+    """
+    A mocked TTY with a settable read timeout that records the timeout of every read and answers only
+    after the given delay.
+    """
+    def __init__(self, delay=0.0):
+        super(TimedTty, self).__init__()
+        self.timeout = 1
+        self.delay = delay
+        self.read_timeouts = []
+
+    def read(self, n):
+        self.read_timeouts.append(self.timeout)
+        if self.delay > self.timeout:
+            time.sleep(self.timeout)
+            return b""
+        time.sleep(self.delay)
+        self.delay = 0.0
+        return super(TimedTty, self).read(n)
+
+
+class LatencyTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = froeling_lib.LatencyTracker(percentile=0.5, factor=2.0, minimum=0.05, maximum=1.0,
+                                                   min_samples=3)
+
+    def test_maximum_is_used_until_enough_latencies_are_measured(self):
+        self.tracker.record(0x30, 0.1)
+        self.tracker.record(0x30, 0.1)
+        self.assertEqual(1.0, self.tracker.timeout(0x30))
+        self.tracker.record(0x30, 0.2)
+        self.assertAlmostEqual(0.2, self.tracker.timeout(0x30))
+        self.assertEqual(1.0, self.tracker.timeout(0x51))
+
+    def test_timeout_is_limited(self):
+        for _ in range(3):
+            self.tracker.record(0x30, 0.001)
+            self.tracker.record(0x51, 0.9)
+        self.assertEqual(0.05, self.tracker.timeout(0x30))
+        self.assertEqual(1.0, self.tracker.timeout(0x51))
+
+    def test_maximum_is_used_after_timeout(self):
+        for _ in range(3):
+            self.tracker.record(0x30, 0.1)
+        self.tracker.record_timeout(0x30)
+        self.assertEqual(1.0, self.tracker.timeout(0x30))
+        self.tracker.record(0x30, 0.1)
+        self.assertAlmostEqual(0.2, self.tracker.timeout(0x30))
+
+
+class FroelingTimeoutTest(unittest.TestCase):
+    REQUEST = [0x02, 0xfd, 0x00, 0x01, 0x51, 0xf1]
+    RESPONSE = [0x02, 0xfd, 0x00, 0x03, 0x51, 0x01, 0x02, 0x03]
+
+    def setUp(self):
+        self.tracker = froeling_lib.LatencyTracker(min_samples=1, minimum=0.02, inter_byte_timeout=0.01)
+        self.mocked_tty = TimedTty()
+        self.froeling = froeling_lib.Froeling(self.mocked_tty, latency=self.tracker)
+
+    def test_timeouts_adapt_to_measured_latency(self):
+        self.mocked_tty.expect_exchange(self.REQUEST, self.RESPONSE)
+        self.assertEqual(b"\x01\x02", self.froeling.send_command(0x51))
+        self.assertEqual(1.0, self.mocked_tty.read_timeouts[0])
+        self.assertAlmostEqual(0.01 + 4 * froeling_lib.LatencyTracker.BYTE_TIME, self.mocked_tty.read_timeouts[1])
+
+        self.mocked_tty.expect_exchange(self.REQUEST, [])
+        started = time.monotonic()
+        with pytest.raises(froeling_lib.NoResponseError):
+            self.froeling.send_command(0x51)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(1, self.tracker.timeouts)
+
+    def test_deadline_limits_waiting(self):
+        self.froeling.latency = None
+        self.mocked_tty.delay = 0.5
+        self.mocked_tty.expect_exchange(self.REQUEST, self.RESPONSE)
+        started = time.monotonic()
+        with pytest.raises(froeling_lib.NoResponseError):
+            self.froeling.send_command(0x51, deadline=0.1)
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertLessEqual(self.mocked_tty.read_timeouts[0], 0.1)
+
+
+class TraceTest(unittest.TestCase):
+    REQUEST = [0x02, 0xfd, 0x00, 0x01, 0x51, 0xf1]
+    RESPONSE = [0x02, 0xfd, 0x00, 0x03, 0x51, 0x01, 0x02, 0x03]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "trace")
+
+    def _record(self):
+        mocked_tty = MockedTty()
+        with TraceWriter(self.path) as trace:
+            froeling = froeling_lib.Froeling(mocked_tty, trace=trace)
+            mocked_tty.expect_exchange(self.REQUEST, self.RESPONSE)
+            self.assertEqual(b"\x01\x02", froeling.send_command(0x51))
+            mocked_tty.expect_exchange(self.REQUEST, [])
+            with pytest.raises(froeling_lib.NoResponseError):
+                froeling.send_command(0x51)
+            self.assertEqual(2, trace.exchanges)
+
+    def test_exchanges_are_recorded(self):
+        self._record()
+        exchanges = list(read_trace(self.path))
+        self.assertEqual([bytes(self.REQUEST)] * 2, [exchange.request for exchange in exchanges])
+        self.assertEqual([bytes(self.RESPONSE[:4]), bytes(self.RESPONSE[4:])],
+                         [data for _, data in exchanges[0].reads])
+        self.assertEqual([b""], [data for _, data in exchanges[1].reads])
+        self.assertLessEqual(exchanges[0].time, exchanges[1].time)
+
+    def test_truncated_trace_is_rejected(self):
+        self._record()
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        with pytest.raises(ValueError):
+            list(read_trace(self.path))
+
+    def test_replay(self):
+        self._record()
+        port = ReplayPort(self.path, speed=None)
+        froeling = froeling_lib.Froeling(port)
+        self.assertEqual(b"\x01\x02", froeling.send_command(0x51))
+        with pytest.raises(froeling_lib.NoResponseError):
+            froeling.send_command(0x51)
+        self.assertEqual(b"\x01\x02", froeling.send_command(0x51))
+        with pytest.raises(froeling_lib.NoResponseError):
+            froeling.send_command(0x30, [0x00, 0x00])
+        self.assertEqual((3, 1), (port.exchanges, port.unmatched))
+
+    def test_replay_speed(self):
+        reads = [(0.4, bytes(self.RESPONSE[:4])), (0.8, bytes(self.RESPONSE[4:]))]
+        exchanges = [Exchange(0.0, bytes(self.REQUEST), reads)]
+        froeling = froeling_lib.Froeling(ReplayPort(exchanges, speed=4.0))
+        started = time.monotonic()
+        self.assertEqual(b"\x01\x02", froeling.send_command(0x51))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertLess(time.monotonic() - started, 0.5)
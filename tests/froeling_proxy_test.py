@@ -12,4 +12,1195 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-#TODO
\ No newline at end of file
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+import froeling_client
+import froeling_lib
+import froeling_proxy
+from froeling_client import AsyncFroelingClient, FroelingClient, ProxyError, parse_response
+from froeling_proxy import binary
+from froeling_proxy.catalog import Catalog, CatalogEntry, DEFAULT_CATALOG
+from froeling_proxy.framing import LineFramer
+from froeling_proxy.http_api import HttpApiServer
+from froeling_proxy.metrics import Metrics, MetricsHttpServer
+from froeling_proxy.poller import Poller, ValueHistory
+from froeling_proxy.scanner import AddressScanner
+from froeling_proxy.scheduling import FairQueue
+from froeling_proxy.store import TimeSeriesStore, read_range
+from froeling_proxy.subscriptions import SubscriptionManager
+from froeling_proxy.upstream import UpstreamPool, UpstreamWorker
+from froeling_proxy.worker import SerialWorker
+
+
+class FakeBoilerTty:
+    """
+    A Serial-like object that answers every command with a well-formed frame echoing the command byte
+    and its parameters (or the payload returned by handler, if set), optionally after a delay.
+    """
+    def __init__(self, delay=0.0, handler=None):
+        self.delay = delay
+        self.handler = handler
+        self.respond = True
+        self.requests = []
+        self.answer_from_boiler = bytes()
+
+    def write(self, data):
+        data = bytes(data)
+        self.requests.append(data[4:-1])
+        message = data[4:-1]
+        if self.handler is not None:
+            message = message[:1] + self.handler(message)
+        frame = bytes([0x02, 0xfd]) + len(message).to_bytes(2, "big") + message
+        self.answer_from_boiler = frame + bytes([froeling_lib._compute_crc(frame)]) if self.respond else b""
+
+    def read(self, n):
+        if self.delay:
+            time.sleep(self.delay)
+        answer, self.answer_from_boiler = self.answer_from_boiler[:n], self.answer_from_boiler[n:]
+        return answer
+
+    def reset_input_buffer(self):
+        pass
+
+
+class LineFramerTest(unittest.TestCase):
+    def test_all_complete_lines_are_returned(self):
+        framer = LineFramer()
+        self.assertEqual([b"51", b"300001", b"30"], framer.feed(b"51\r\n300001\n\n30\r"))
+        self.assertEqual(0, len(framer))
+
+    def test_incomplete_line_is_kept(self):
+        framer = LineFramer()
+        self.assertEqual([], framer.feed(b"3000"))
+        self.assertEqual([b"300001"], framer.feed(b"01\n51"))
+        self.assertEqual(2, len(framer))
+        self.assertEqual([b"51"], framer.feed(b"\r"))
+
+
+def _read_frames(s, count):
+    reader = binary.FrameReader()
+    frames = []
+    while len(frames) < count:
+        data = s.recv(4096)
+        if not data:
+            break
+        frames += reader.feed(data)
+    return frames
+
+
+class BinaryProtocolTest(unittest.TestCase):
+    def test_frames_are_split(self):
+        data = binary.encode_request(1, 0x30, b"\x00\x01") + binary.encode_request(0xffffffff, 0x51)
+        reader = binary.FrameReader()
+        self.assertEqual([(1, 0x30, b"\x00\x01")], reader.feed(data[:10]))
+        self.assertEqual(1, len(reader))
+        self.assertEqual([(0xffffffff, 0x51, b"")], reader.feed(data[10:]))
+
+    def test_invalid_frame_length_is_rejected(self):
+        with self.assertRaises(ValueError):
+            binary.FrameReader().feed(b"\x00\x04\x00\x00\x00\x01\x30")
+        with self.assertRaises(ValueError):
+            binary.FrameReader(max_frame_size=10).feed(binary.encode_request(1, 0x30, bytes(10)))
+
+    def test_errors_are_encoded_with_status(self):
+        frame = binary.encode_error(7, froeling_lib.NoResponseError())
+        self.assertEqual([(7, 5, b"")], binary.FrameReader().feed(frame))
+        self.assertEqual("NoResponseError", binary.status_name(5))
+        self.assertEqual("InvalidRequest", binary.status_name(binary.encode_error(1, ValueError())[6]))
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.catalog = Catalog([
+            CatalogEntry("temperature", "Temperature", b"\x00\x00", 0.5, True, "°C"),
+            CatalogEntry("counter", "Counter", [0x01, 0x02], 1, False),
+            ("exhaust", None, b"\x00\x01", 1.0, True, "°C"),
+        ])
+        self.response = b"\xff\xf6\xff\xf6\x00\x96"
+
+    def test_request(self):
+        self.assertEqual(b"\x00\x00\x01\x02\x00\x01", self.catalog.parameters)
+
+    def test_decode(self):
+        self.assertEqual((-10, 65526, 150), self.catalog.decode_raw(self.response))
+        self.assertEqual([-5.0, 65526, 150.0], self.catalog.decode(self.response))
+        self.assertEqual(["-5.0°C", "65526", "150.0°C"], self.catalog.format(self.catalog.decode(self.response)))
+        with self.assertRaises(ValueError):
+            self.catalog.decode(self.response[:-1])
+
+    @unittest.skipIf(not froeling_proxy.catalog.numpy_available, "NumPy is not installed")
+    def test_decode_array(self):
+        self.assertEqual([-5.0, 65526.0, 150.0], self.catalog.decode_array(self.response).tolist())
+
+    def test_select(self):
+        selected = self.catalog.select(["exhaust", "fff0"])
+        self.assertEqual(["exhaust", "fff0"], selected.names)
+        self.assertEqual([150.0, -16], selected.decode(b"\x00\x96\xff\xf0"))
+        with self.assertRaises(KeyError):
+            self.catalog.select(["unknown"])
+        self.assertEqual(["counter", "0005"], self.catalog.select(["counter", "0005", "counter", "0005"]).names)
+
+    def test_default_catalog_matches_format_temperature(self):
+        response = bytes(range(2 * len(DEFAULT_CATALOG)))
+        self.assertEqual([froeling_proxy.format_temperature(response[i:i + 2], multiplied_by_2=entry.scale == 0.5)
+                          for i, entry in zip(range(0, len(response), 2), DEFAULT_CATALOG)],
+                         DEFAULT_CATALOG.format(DEFAULT_CATALOG.decode(response)))
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "catalog.json")
+            self.catalog.save(path)
+            loaded = Catalog.load(path)
+        self.assertEqual(self.catalog.entries, loaded.entries)
+        self.assertEqual(["-5.0°C", "65526", "150.0°C"], loaded.format(loaded.decode(self.response)))
+
+
+class AddressScannerTest(unittest.TestCase):
+    UNREADABLE = {0x05, 0x0c, 0x0d, 0x2e}
+
+    def setUp(self):
+        def handler(message):
+            # Like a boiler that stops answering at the first unsupported address
+            values = b""
+            for i in range(1, len(message), 2):
+                address = int.from_bytes(message[i:i + 2], "big")
+                if address in self.UNREADABLE:
+                    break
+                values += (-address).to_bytes(2, "big", signed=True)
+            return values
+
+        self.tty = FakeBoilerTty(handler=handler)
+        self.froeling = froeling_lib.Froeling(self.tty)
+
+    def test_scan(self):
+        scanner = AddressScanner(self.froeling, 0x00, 0x3f, batch_size=8, max_batch_size=32, target_latency=10)
+        readable = scanner.scan()
+        self.assertEqual({address: -address for address in range(0x40) if address not in self.UNREADABLE}, readable)
+        self.assertEqual(32, scanner.batch_size)
+        self.assertLess(scanner.requests, 40)
+        catalog = scanner.catalog()
+        self.assertEqual(60, len(catalog))
+        self.assertEqual(("value_0004", b"\x00\x04"), (catalog.entries[4].name, catalog.entries[4].address))
+
+    def test_resume_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "scan.json")
+            scanner = AddressScanner(self.froeling, 0x00, 0x3f, batch_size=16, checkpoint=checkpoint)
+            for _ in range(3):
+                scanner.step()
+            self.tty.requests.clear()
+            resumed = AddressScanner(self.froeling, 0x00, 0x3f, batch_size=16, checkpoint=checkpoint)
+            resumed.scan()
+        self.assertEqual(set(range(0x40)) - self.UNREADABLE, set(resumed.readable))
+        self.assertNotIn(b"\x30\x00\x00", [request[:3] for request in self.tty.requests])
+
+    def test_batches_fit_in_a_frame(self):
+        self.assertEqual(256, AddressScanner(self.froeling, max_batch_size=1024).max_batch_size)
+        scanner = AddressScanner(self.froeling, 0x00, 0x7ff, batch_size=1000, max_batch_size=1000)
+        self.assertEqual(256, scanner.batch_size)
+        scanner.step()
+        self.assertEqual([1 + 2 * 256], [len(request) for request in self.tty.requests])
+
+    def test_checkpoint_of_another_range_is_rejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "scan.json")
+            AddressScanner(self.froeling, 0x00, 0x3f, checkpoint=checkpoint).step()
+            for start, end in [(0x10, 0x3f), (0x00, 0x7f)]:
+                with self.assertRaises(ValueError):
+                    AddressScanner(self.froeling, start, end, checkpoint=checkpoint)
+
+
+class SerialWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty(delay=0.1)
+        self.worker = SerialWorker(froeling_lib.Froeling(self.tty))
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_commands_are_executed_in_order(self):
+        futures = self.worker.submit_batch([(0x30, b"\x00\x01"), (0x30, b"\x00\x02"), (0x51, b"")])
+        self.assertEqual([b"\x00\x01", b"\x00\x02", b""], [future.result(5) for future in futures])
+        self.assertEqual([b"\x30\x00\x01", b"\x30\x00\x02", b"\x51"], self.tty.requests)
+
+    def test_identical_requests_are_coalesced(self):
+        first = self.worker.submit(0x51)
+        time.sleep(0.05)
+        futures = [self.worker.submit(0x30, b"\x00\x01") for _ in range(3)] + [self.worker.submit(0x51)]
+        self.assertEqual(b"", first.result(5))
+        self.assertEqual([b"\x00\x01"] * 3 + [b""], [future.result(5) for future in futures])
+        self.assertEqual([b"\x51", b"\x30\x00\x01"], self.tty.requests)
+        self.assertEqual(3, self.worker.coalesced)
+
+    def test_coalesced_requests_share_errors(self):
+        self.tty.respond = False
+        futures = [self.worker.submit(0x51) for _ in range(2)]
+        for future in futures:
+            with self.assertRaises(froeling_lib.NoResponseError):
+                future.result(5)
+        self.assertEqual([b"\x51"], self.tty.requests)
+
+
+    def test_read_after_write_is_not_coalesced_with_earlier_read(self):
+        value = [b"\x00\x01"]
+
+        def handler(message):
+            if message[0] == 0x40:
+                value[0] = message[1:]
+                return b""
+            return value[0]
+
+        worker = SerialWorker(froeling_lib.Froeling(FakeBoilerTty(handler=handler)))
+        self.addCleanup(worker.stop)
+        earlier = worker.submit(0x30, b"\x00\x30", "ui", "interactive")
+        write, read = worker.submit_batch([(0x40, b"\x00\x02"), (0x30, b"\x00\x30")], "a")
+        worker.start()
+        self.assertEqual(b"\x00\x01", earlier.result(5))
+        self.assertEqual(b"", write.result(5))
+        self.assertEqual(b"\x00\x02", read.result(5))
+        self.assertEqual(0, worker.coalesced)
+
+    def test_identical_writes_are_not_coalesced(self):
+        futures = [self.worker.submit(0x5a, b"\x01", flow) for flow in ["a", "b"]]
+        self.assertEqual([b"\x01", b"\x01"], [future.result(5) for future in futures])
+        self.assertEqual([b"\x5a\x01", b"\x5a\x01"], self.tty.requests)
+        self.assertEqual(0, self.worker.coalesced)
+
+class FairQueueTest(unittest.TestCase):
+    def test_flows_are_served_in_turns(self):
+        queue = FairQueue()
+        for i in range(3):
+            queue.push(("a", i), "a")
+        queue.push(("b", 0), "b")
+        queue.push(("b", 1), "b")
+        self.assertEqual([("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2)], [queue.pop() for _ in range(5)])
+        self.assertEqual(0, len(queue))
+
+    def test_flows_share_by_weight(self):
+        queue = FairQueue({"high": 3.0, "low": 1.0})
+        for i in range(8):
+            queue.push(("low", i), "export", "low")
+            queue.push(("high", i), "ui", "high")
+        served = [queue.pop()[0] for _ in range(8)]
+        self.assertEqual((6, 2), (served.count("high"), served.count("low")))
+        self.assertEqual({"high": 2, "low": 6}, queue.depths())
+
+    def test_interactive_item_is_served_next(self):
+        queue = FairQueue()
+        for i in range(100):
+            queue.push(i, "export", "background")
+        self.assertEqual(0, queue.pop())
+        queue.push("state", "ui", "interactive")
+        self.assertEqual("state", queue.pop())
+        self.assertEqual(1, queue.pop())
+        with self.assertRaises(ValueError):
+            queue.push(0, "ui", "urgent")
+
+    def test_items_in_order_and_removal(self):
+        queue = FairQueue()
+        items = [["a", 0], ["a", 1], ["b", 0]]
+        for item in items:
+            queue.push(item, item[0])
+        self.assertEqual([items[0], items[2], items[1]], queue.items())
+        queue.remove([items[2]])
+        self.assertEqual([items[0], items[1]], queue.items())
+        self.assertEqual(2, len(queue))
+        self.assertEqual([items[0], items[1]], queue.clear())
+        self.assertEqual(0, len(queue))
+
+
+class SerialWorkerSchedulingTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty(delay=0.02)
+        self.worker = SerialWorker(froeling_lib.Froeling(self.tty), command_priorities={0x52: "background"})
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_interactive_request_overtakes_background_backlog(self):
+        backlog = self.worker.submit_batch([(0x30, bytes([0, i])) for i in range(20)], "export", "background")
+        time.sleep(0.05)
+        self.assertEqual(0, self.worker.queue_depths["interactive"])
+        self.assertGreater(self.worker.queue_depths["background"], 10)
+        started = time.monotonic()
+        self.assertEqual(b"", self.worker.submit(0x51, flow="ui", priority="interactive").result(5))
+        self.assertLess(time.monotonic() - started, 0.2)
+        self.assertFalse(backlog[-1].done())
+        self.assertEqual(bytes([0, 19]), backlog[-1].result(5))
+
+    def test_command_priorities(self):
+        self.worker.submit(0x60)
+        time.sleep(0.01)
+        futures = self.worker.submit_batch([(0x52, b""), (0x51, b"")], "client")
+        self.assertEqual([b"", b""], [future.result(5) for future in futures])
+        self.assertEqual([b"\x60", b"\x51", b"\x52"], self.tty.requests)
+
+
+class SerialWorkerMergingTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty(delay=0.05)
+        self.worker = SerialWorker(froeling_lib.Froeling(self.tty), max_merged_addresses=4)
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_waiting_reads_are_merged(self):
+        self.worker.submit(0x60)
+        time.sleep(0.02)
+        futures = self.worker.submit_batch([
+            (0x30, b"\x00\x02\x00\x01"), (0x51, b""), (0x30, b"\x00\x01\x00\x03"), (0x30, b"\x00\x04"),
+            (0x30, b"\x00\x05"), (0x52, b""), (0x30, b"\x00\x06")])
+        self.assertEqual([b"\x00\x02\x00\x01", b"", b"\x00\x01\x00\x03", b"\x00\x04", b"\x00\x05", b"",
+                          b"\x00\x06"], [future.result(5) for future in futures])
+        self.assertEqual([b"\x60", b"\x30\x00\x02\x00\x01\x00\x03\x00\x04", b"\x51", b"\x30\x00\x05", b"\x52",
+                          b"\x30\x00\x06"], self.tty.requests)
+        self.assertEqual(3, self.worker.merged)
+
+    def test_failed_merged_read_is_retried_one_by_one(self):
+        self.tty.handler = lambda message: message[1:3]
+        self.worker.submit(0x51)
+        time.sleep(0.02)
+        futures = self.worker.submit_batch([(0x30, b"\x00\x01"), (0x30, b"\x00\x02")])
+        self.assertEqual([b"\x00\x01", b"\x00\x02"], [future.result(5) for future in futures])
+        self.assertEqual([b"\x51", b"\x30\x00\x01\x00\x02", b"\x30\x00\x01", b"\x30\x00\x02"], self.tty.requests)
+        self.assertEqual(0, self.worker.merged)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counters_and_histograms_are_rendered(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.declare("requests_total", "counter", "Requests")
+        metrics.inc("requests_total", command="30")
+        metrics.inc("requests_total", 2, command="30")
+        metrics.observe("latency_seconds", 0.05)
+        metrics.observe("latency_seconds", 0.5)
+        metrics.register_function("connections", "gauge", "Connections", lambda: 3)
+        self.assertEqual("\n".join([
+            "# HELP connections Connections",
+            "# TYPE connections gauge",
+            "connections 3",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 2',
+            'latency_seconds_bucket{le="+Inf"} 2',
+            "latency_seconds_sum 0.55",
+            "latency_seconds_count 2",
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{command="30"} 3',
+        ]) + "\n", metrics.render())
+
+    def test_hooks_receive_updates(self):
+        metrics = Metrics()
+        updates = []
+        metrics.add_hook(lambda name, value, labels: updates.append((name, value, labels)))
+        metrics.inc("errors_total", error="NoResponseError")
+        metrics.observe("latency_seconds", 0.2)
+        self.assertEqual([("errors_total", 1, {"error": "NoResponseError"}), ("latency_seconds", 0.2, {})], updates)
+
+    def test_worker_records_queue_wait_serial_time_and_errors(self):
+        tty = FakeBoilerTty()
+        metrics = Metrics()
+        worker = SerialWorker(froeling_lib.Froeling(tty), metrics=metrics)
+        worker.start()
+        self.addCleanup(worker.stop)
+        worker.send_command(0x30, b"\x00\x01")
+        tty.respond = False
+        with self.assertRaises(froeling_lib.NoResponseError):
+            worker.send_command(0x51)
+        snapshot = metrics.snapshot()
+        self.assertEqual(1, snapshot["froeling_serial_seconds"][(("command", "30"),)][0][-1])
+        self.assertEqual(1, snapshot["froeling_queue_wait_seconds"][(("command", "51"),)][0][-1])
+        self.assertEqual({(("command", "51"), ("error", "NoResponseError")): 1}, snapshot["froeling_errors_total"])
+
+
+class HttpApiServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty(handler=lambda message: message[1:] if message[0] == 0x30 else b"\x00\x03Heizen;Ein")
+        self.worker = SerialWorker(froeling_lib.Froeling(self.tty))
+        self.worker.start()
+        self.addCleanup(self.worker.stop)
+        self.server = HttpApiServer(self.worker, 0, Catalog([
+            ("buffer_top_temperature", "Buffer top temperature", [0x00, 0x76], 0.5, True, "°C"),
+            ("exhaust_temperature", "Exhaust temperature", [0x00, 0x01], 1.0, True, "°C"),
+        ]), address="127.0.0.1")
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def _request(self, path, data=None, headers=None):
+        request = urllib.request.Request("http://127.0.0.1:{}{}".format(self.server.port, path), data=data,
+                                         headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, response.headers, json.loads(response.read().decode() or "null")
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, json.loads(e.read().decode() or "null")
+
+    def test_values_are_read_in_one_request(self):
+        status, _, result = self._request("/values?names=exhaust_temperature,buffer_top_temperature,fff0")
+        self.assertEqual(200, status)
+        self.assertEqual([
+            {"name": "exhaust_temperature", "address": "0001", "label": "Exhaust temperature", "raw": 1,
+             "value": 1.0, "unit": "°C"},
+            {"name": "buffer_top_temperature", "address": "0076", "label": "Buffer top temperature", "raw": 118,
+             "value": 59.0, "unit": "°C"},
+            {"name": "fff0", "address": "fff0", "label": None, "raw": -16, "value": -16, "unit": None},
+        ], result["values"])
+        self.assertEqual([b"\x30\x00\x01\x00\x76\xff\xf0"], self.tty.requests)
+
+    def test_free_port_on_all_addresses(self):
+        server = HttpApiServer(self.worker, 0, self.server.catalog)
+        server.start()
+        self.addCleanup(server.stop)
+        self.assertEqual({server.port}, {s.getsockname()[1] for s in server.server.sockets})
+        with urllib.request.urlopen("http://127.0.0.1:{}/state".format(server.port), timeout=5) as response:
+            self.assertEqual(200, response.status)
+
+    def test_duplicate_names_are_read_once(self):
+        status, _, result = self._request("/values?names=exhaust_temperature,0076,exhaust_temperature")
+        self.assertEqual(200, status)
+        self.assertEqual(["exhaust_temperature", "0076"], [value["name"] for value in result["values"]])
+        self.assertEqual([b"\x30\x00\x01\x00\x76"], self.tty.requests)
+
+    def test_post_and_default_values(self):
+        _, _, posted = self._request("/values", json.dumps({"values": ["0076", "exhaust_temperature"]}).encode())
+        self.assertEqual(["0076", "exhaust_temperature"], [value["name"] for value in posted["values"]])
+        _, _, default = self._request("/values")
+        self.assertEqual(["buffer_top_temperature", "exhaust_temperature"],
+                         [value["name"] for value in default["values"]])
+
+    def test_etag(self):
+        status, headers, _ = self._request("/state")
+        self.assertEqual(200, status)
+        status, _, result = self._request("/state", headers={"If-None-Match": headers["ETag"]})
+        self.assertEqual(304, status)
+        self.assertIsNone(result)
+        status, _, result = self._request("/state", headers={"If-None-Match": '"other"'})
+        self.assertEqual({"raw": "00034865697a656e3b45696e", "code": 3, "text": ["Heizen", "Ein"]}, result)
+
+    def test_errors(self):
+        self.assertEqual(400, self._request("/values?names=unknown")[0])
+        self.assertEqual(404, self._request("/other")[0])
+        self.tty.respond = False
+        status, _, result = self._request("/state")
+        self.assertEqual(502, status)
+        self.assertTrue(result["error"].startswith("NoResponseError"))
+
+
+class SubscriptionManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.values = {b"\x00\x01": 100, b"\x00\x02": 200}
+        self.state = b"\x00\x03Heizen"
+
+        def handler(message):
+            if message[0] == 0x51:
+                return self.state
+            return b"".join(self.values[message[i:i + 2]].to_bytes(2, "big", signed=True)
+                            for i in range(1, len(message), 2))
+
+        self.tty = FakeBoilerTty(handler=handler)
+        self.worker = SerialWorker(froeling_lib.Froeling(self.tty))
+        self.worker.start()
+        self.addCleanup(self.worker.stop)
+        self.manager = SubscriptionManager(self.worker, min_interval=0.05)
+        self.manager.start()
+        self.addCleanup(self.manager.stop)
+        self.deliveries = []
+
+    def _deliver(self, subscription, changes, state):
+        self.deliveries.append((subscription.id, dict(changes), state))
+
+    def _wait_for_deliveries(self, count):
+        deadline = time.monotonic() + 5
+        while len(self.deliveries) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(count, len(self.deliveries))
+
+    def test_only_changes_are_delivered(self):
+        subscription = self.manager.subscribe([b"\x00\x01", b"\x00\x02"], 0.05, self._deliver, deadband=5, state=True)
+        self._wait_for_deliveries(1)
+        self.assertEqual((subscription.id, {b"\x00\x01": 100, b"\x00\x02": 200}, self.state), self.deliveries[0])
+        self.values[b"\x00\x01"] = 104
+        time.sleep(0.2)
+        self.assertEqual(1, len(self.deliveries))
+        self.values[b"\x00\x01"] = 106
+        self._wait_for_deliveries(2)
+        self.assertEqual((subscription.id, {b"\x00\x01": 106}, None), self.deliveries[1])
+        self.state = b"\x00\x04Aus"
+        self._wait_for_deliveries(3)
+        self.assertEqual((subscription.id, {}, b"\x00\x04Aus"), self.deliveries[2])
+        self.assertTrue(self.manager.unsubscribe(subscription.id))
+        self.assertFalse(self.manager.unsubscribe(subscription.id))
+        self.assertEqual(0, len(self.manager))
+
+    def test_subscribers_to_the_same_values_share_polls(self):
+        self.manager.subscribe([b"\x00\x01"], 0.2, self._deliver)
+        self.manager.subscribe([b"\x00\x01"], 0.2, self._deliver)
+        self._wait_for_deliveries(2)
+        self.tty.requests.clear()
+        time.sleep(0.5)
+        self.assertLessEqual(len(self.tty.requests), 3)
+        self.assertEqual({b"\x30\x00\x01"}, set(self.tty.requests))
+
+    def test_undelivered_changes_are_offered_again(self):
+        refused = []
+        self.manager.subscribe([b"\x00\x02"], 0.05, lambda *args: refused.append(args) or False)
+        self.manager.subscribe([b"\x00\x02"], 0.05, lambda *args: self._deliver(*args) if refused[1:] else False)
+        self._wait_for_deliveries(1)
+        self.assertEqual({b"\x00\x02": 200}, self.deliveries[0][1])
+
+    def test_invalid_subscriptions(self):
+        with self.assertRaises(ValueError):
+            self.manager.subscribe([], 1, self._deliver)
+        with self.assertRaises(ValueError):
+            self.manager.subscribe([b"\x00\x01"], 0.01, self._deliver)
+
+
+class ValueHistoryTest(unittest.TestCase):
+    def test_oldest_samples_are_overwritten(self):
+        history = ValueHistory(3)
+        self.assertIsNone(history.latest())
+        for i in range(5):
+            history.append(100.0 + i, -i)
+        self.assertEqual(3, len(history))
+        self.assertEqual((104.0, -4), history.latest())
+        self.assertEqual([(102.0, -2), (103.0, -3), (104.0, -4)], history.samples())
+
+    def test_samples_since(self):
+        history = ValueHistory(4)
+        for i in range(6):
+            history.append(100.0 + i, i)
+        self.assertEqual([(103.0, 3), (104.0, 4), (105.0, 5)], history.samples(since=102.5))
+        self.assertEqual([], history.samples(since=106))
+        self.assertEqual(4, len(history.samples(since=0)))
+
+
+class PollerTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty(handler=lambda message: message[1:] if message[0] == 0x30 else b"\x00\x05Winter")
+        self.poller = Poller(froeling_lib.Froeling(self.tty), [b"\x00\x01", [0xff, 0xfe]], history_size=2)
+
+    def test_poll(self):
+        with self.assertRaises(KeyError):
+            self.poller.current_values([b"\x00\x01"])
+        self.poller.poll()
+        self.poller.poll()
+        self.assertEqual(b"\xff\xfe\x00\x01", self.poller.current_values([b"\xff\xfe", b"\x00\x01"]))
+        self.assertEqual([-2, -2], [value for _, value in self.poller.history(b"\xff\xfe")])
+        self.assertEqual(b"\x00\x05Winter", self.poller.state)
+        self.assertEqual([b"\x30\x00\x01\xff\xfe", b"\x51"] * 2, self.tty.requests)
+
+
+class TimeSeriesStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "boiler")
+        self.store = TimeSeriesStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def _fill(self):
+        # Two values every 30 seconds for two hours, starting at 10:00 UTC
+        for i in range(240):
+            self.store.append(36000 + 30 * i, [(0x0000, i), (0x0004, -i)])
+
+    def test_raw_range(self):
+        self._fill()
+        self.assertEqual([(36060.0, 4, -2), (36090.0, 4, -3)], list(self.store.query([4], 36060, 36120)))
+        self.assertEqual(480, len(list(self.store.query())))
+        self.assertEqual([], list(self.store.query(start=50000)))
+
+    def test_rollups(self):
+        self._fill()
+        self.assertEqual([(36060, 0, 2, 3, 2.5, 2), (36060, 4, -3, -2, -2.5, 2)],
+                         list(self.store.query(start=36090, end=36120, resolution="minute")))
+        self.assertEqual([(36000, 0, 0, 119, 59.5, 120), (39600, 0, 120, 239, 179.5, 120)],
+                         list(self.store.query([0], resolution="hour")))
+        with self.assertRaises(ValueError):
+            self.store.query(resolution="day")
+
+    def test_reopen(self):
+        self.store.append(36000, [(1, 10)])
+        self.store.close()
+        self.store = TimeSeriesStore(self.path)
+        self.store.append(36010, [(1, 20)])
+        self.store.append(35000, [(1, 30)])
+        self.assertEqual([(36000.0, 1, 10), (36010.0, 1, 20), (36010.0, 1, 30)], list(self.store.query()))
+        self.assertEqual([(36000, 1, 10, 30, 20.0, 3)], list(self.store.query(resolution="minute")))
+        self.store.close()
+        self.assertEqual([(36000, 1, 10, 30, 20.0, 3)], list(read_range(self.path, resolution="hour")))
+        self.store = TimeSeriesStore(self.path, readonly=True)
+
+    def test_partial_records_are_removed_on_reopen(self):
+        self.store.append(36000, [(1, 10)])
+        self.store.close()
+        for suffix in [".raw", ".minute", ".hour"]:
+            with open(self.path + suffix, "ab") as f:
+                f.write(b"\x01\x02\x03")
+        self.store = TimeSeriesStore(self.path)
+        self.store.append(36010, [(1, 20)])
+        self.assertEqual([(36000.0, 1, 10), (36010.0, 1, 20)], list(self.store.query()))
+        self.store.close()
+        self.assertEqual([(36000, 1, 10, 20, 15.0, 2)], list(read_range(self.path, resolution="minute")))
+        self.store = TimeSeriesStore(self.path, readonly=True)
+
+    def test_record_response(self):
+        self.store.record_response(0x30, b"\x00\x01\x00\x02", b"\xff\xfe\x00\x03", timestamp=100)
+        self.store.record_response(0x51, b"", b"\x00\x05Winter", timestamp=101)
+        self.store.record_response(0x30, b"\x00\x01", b"", timestamp=102)
+        self.store.record_response(0x52, b"", b"\x00\x05", timestamp=103)
+        self.assertEqual([(100.0, 1, -2), (100.0, 2, 3), (101.0, TimeSeriesStore.STATE_ADDRESS, 5)],
+                         list(self.store.query()))
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+
+class FroelingProxyServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty()
+        self.froeling = froeling_lib.Froeling(self.tty)
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+
+    def _start(self, **kwargs):
+        self.port = _free_port()
+        self.server = froeling_proxy.FroelingProxyServer(self.port, self.froeling, **kwargs)
+        self.thread = threading.Thread(target=self.server.start, daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(("localhost", self.port)).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def _connect(self):
+        s = socket.create_connection(("localhost", self.port), timeout=5)
+        return s, s.makefile("rb")
+
+    def test_write_interest_only_while_output_pending(self):
+        self._start()
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"300001\n")
+            self.assertEqual(b"0001\n", f.readline())
+            time.sleep(0.1)
+            client_events = [key.events for key in list(self.server.selector.get_map().values())
+                             if key.data is not None]
+            self.assertEqual([selectors.EVENT_READ], client_events)
+
+    def test_pipelined_requests(self):
+        self._start()
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"".join("30{:04x}\n".format(i).encode() for i in range(50)) + b"3\n51\n")
+            for i in range(50):
+                self.assertEqual("{:04x}\n".format(i).encode(), f.readline())
+            self.assertTrue(f.readline().startswith(b"!ValueError: "))
+            self.assertEqual(b"\n", f.readline())
+
+    def test_connections_are_served_while_command_in_flight(self):
+        self._start()
+        self.tty.delay = 0.5
+        slow, slow_f = self._connect()
+        fast, fast_f = self._connect()
+        with slow, slow_f, fast, fast_f:
+            slow.sendall(b"51\n")
+            time.sleep(0.1)
+            started = time.monotonic()
+            fast.sendall(b"5\n")
+            self.assertTrue(fast_f.readline().startswith(b"!ValueError: "))
+            self.assertLess(time.monotonic() - started, 0.3)
+            self.assertEqual(b"\n", slow_f.readline())
+
+    def test_cached_responses(self):
+        self.froeling.cache = froeling_lib.ResponseCache()
+        self._start()
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"300001\n51\n")
+            self.assertEqual(b"0001\n", f.readline())
+            self.assertEqual(b"\n", f.readline())
+            s.sendall(b"300001\n51\n52\n")
+            self.assertEqual(b"0001\n", f.readline())
+            self.assertEqual(b"\n", f.readline())
+            self.assertEqual(b"\n", f.readline())
+        self.assertEqual([b"\x30\x00\x01", b"\x51", b"\x52"], self.tty.requests)
+
+    def test_proxy_commands(self):
+        self.tty.handler = lambda message: message[1:] if message[0] == 0x30 else b"\x00\x05"
+        worker = SerialWorker(self.froeling)
+        poller = Poller(worker, [b"\x00\x01", b"\x00\x02"], interval=60)
+        self._start(worker=worker, poller=poller)
+        while poller.state is None:
+            time.sleep(0.01)
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"#value 0002 0001\n#state\n#history 0001 60\n#value 0003\n#nothing\n#state 1\n")
+            self.assertEqual(b"00020001\n", f.readline())
+            self.assertEqual(b"0005\n", f.readline())
+            self.assertRegex(f.readline(), rb"^[0-9]+\.[0-9]{3}:0001\n$")
+            self.assertTrue(f.readline().startswith(b"!ProxyCommandError: "))
+            self.assertEqual(b"!ProxyCommandError: Unknown proxy command: #nothing\n", f.readline())
+            self.assertTrue(f.readline().startswith(b"!ProxyCommandError: Wrong number of arguments"))
+
+    def test_errors_of_proxy_commands_are_not_reported_as_wrong_arguments(self):
+        self._start()
+        self.server._proxy_command_broken = lambda connection: len(None)
+        s, f = self._connect()
+        with s, f, contextlib.redirect_stderr(io.StringIO()) as stderr:
+            s.sendall(b"#broken\n#broken 1\n")
+            self.assertTrue(f.readline().startswith(b"!TypeError: "))
+            self.assertEqual(b"!ProxyCommandError: Wrong number of arguments: #broken 1\n", f.readline())
+        self.assertIn("Error in proxy command #broken", stderr.getvalue())
+
+    def test_stored_values(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = TimeSeriesStore(os.path.join(directory.name, "boiler"))
+        self.addCleanup(store.close)
+        self._start(store=store)
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"3000010002\n")
+            self.assertEqual(b"00010002\n", f.readline())
+            s.sendall(b"#range -60 0 raw 0002\n#range -60 0 minute\n")
+            self.assertRegex(f.readline(), rb"^[0-9]+\.[0-9]{3}:0002:2\n$")
+            self.assertRegex(f.readline(), rb"^[0-9]+:0001:1:1:1\.00:1,[0-9]+:0002:2:2:2\.00:1\n$")
+
+    def test_metrics_endpoint(self):
+        metrics = Metrics()
+        self._start(metrics=metrics)
+        metrics_server = MetricsHttpServer(metrics, 0, "localhost")
+        metrics_server.start()
+        self.addCleanup(metrics_server.stop)
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"300001\n")
+            self.assertEqual(b"0001\n", f.readline())
+            with urllib.request.urlopen("http://localhost:{}/metrics".format(metrics_server.port)) as response:
+                body = response.read().decode()
+        self.assertIn("froeling_proxy_connections 1\n", body)
+        self.assertIn("froeling_proxy_received_bytes_total 7\n", body)
+        self.assertIn("froeling_proxy_sent_bytes_total 5\n", body)
+        self.assertIn('froeling_serial_seconds_count{command="30"} 1\n', body)
+        self.assertIn("froeling_serial_sent_bytes_total 8\n", body)
+
+    def test_priorities(self):
+        self.tty.delay = 0.02
+        background_port = _free_port()
+        self._start(port_priorities={background_port: "background"})
+        export = socket.create_connection(("localhost", background_port), timeout=5)
+        s, f = self._connect()
+        with export, s, f:
+            export.sendall(b"".join(b"3000%02x\n" % i for i in range(30)))
+            time.sleep(0.1)
+            s.sendall(b"#queue\n#priority interactive\n51\n#priority urgent\n")
+            self.assertRegex(f.readline(), rb"^interactive:0,normal:0,background:[1-9][0-9]*\n$")
+            self.assertEqual(b"interactive\n", f.readline())
+            started = time.monotonic()
+            self.assertEqual(b"\n", f.readline())
+            self.assertLess(time.monotonic() - started, 0.2)
+            self.assertEqual(b"!ProxyCommandError: Unknown priority: urgent\n", f.readline())
+            self.assertLess(self.tty.requests.index(b"\x51"), 20)
+
+    def test_subscribe(self):
+        self._start()
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"#subscribe 0.5 0 0001 state\n")
+            self.assertEqual(b"1\n", f.readline())
+            self.assertEqual(b"*1 0001:0001 state:\n", f.readline())
+            s.sendall(b"#subscribe 0.1 0 0001\n#unsubscribe 2\n#unsubscribe 1\n")
+            self.assertEqual(b"!ValueError: interval must be at least 0.5 seconds\n", f.readline())
+            self.assertEqual(b"!ProxyCommandError: No such subscription: 2\n", f.readline())
+            self.assertEqual(b"1\n", f.readline())
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"#subscribe 0.5 0 0002\n")
+            self.assertEqual(b"2\n", f.readline())
+            self.assertEqual(b"*2 0002:0002\n", f.readline())
+        deadline = time.monotonic() + 5
+        while len(self.server.subscriptions) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(0, len(self.server.subscriptions))
+
+    def test_several_boilers(self):
+        other_tty = FakeBoilerTty(handler=lambda message: b"\x02" + message[1:])
+        other_worker = SerialWorker(froeling_lib.Froeling(other_tty))
+        boiler_port = _free_port()
+        self._start(boilers={"2": other_worker}, boiler_ports={boiler_port: "2"})
+        s, f = self._connect()
+        other = socket.create_connection(("localhost", boiler_port), timeout=5)
+        other_f = other.makefile("rb")
+        with s, f, other, other_f:
+            s.sendall(b"#boiler\n300001\n#boiler 2\n300001\n#boiler 3\n#boilers\n")
+            self.assertEqual([b"1\n", b"0001\n", b"2\n", b"020001\n", b"!ProxyCommandError: Unknown boiler: 3\n",
+                              b"1:0,2:0\n"], [f.readline() for _ in range(6)])
+            other.sendall(b"#boiler\n51\n")
+            self.assertEqual([b"2\n", b"02\n"], [other_f.readline() for _ in range(2)])
+            self.assertEqual([b"\x30\x00\x01"], self.tty.requests)
+            self.assertEqual([b"\x30\x00\x01", b"\x51"], other_tty.requests)
+
+            self.tty.delay = other_tty.delay = 0.1
+            started = time.monotonic()
+            s.sendall(b"#boiler 1\n300002\n")
+            other.sendall(b"300002\n")
+            self.assertEqual([b"1\n", b"0002\n"], [f.readline() for _ in range(2)])
+            self.assertEqual(b"020002\n", other_f.readline())
+            self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_binary_protocol_responds_out_of_order(self):
+        self.froeling.cache = froeling_lib.ResponseCache()
+        binary_port = _free_port()
+        self._start(binary_port=binary_port)
+        with socket.create_connection(("localhost", binary_port), timeout=5) as s:
+            s.sendall(binary.encode_request(1, 0x30, b"\x00\x01"))
+            self.assertEqual([(1, binary.STATUS_OK, b"\x00\x01")], _read_frames(s, 1))
+            self.tty.delay = 0.2
+            s.sendall(binary.encode_request(2, 0x51) + binary.encode_request(3, 0x30, b"\x00\x01"))
+            self.assertEqual([(3, binary.STATUS_OK, b"\x00\x01"), (2, binary.STATUS_OK, b"")], _read_frames(s, 2))
+            self.tty.respond = False
+            s.sendall(binary.encode_request(4, 0x52))
+            self.assertEqual([(4, binary.STATUS_CODES[froeling_lib.NoResponseError], b"")], _read_frames(s, 1))
+
+    def test_idle_connection_is_closed(self):
+        self._start(idle_timeout=0.2)
+        s, f = self._connect()
+        with s, f:
+            started = time.monotonic()
+            self.assertEqual(b"", f.readline())
+            self.assertLess(time.monotonic() - started, 2)
+
+    def test_too_long_line_is_rejected(self):
+        self._start(max_buffer_size=16)
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"30" + b"00" * 16)
+            self.assertEqual(b"", f.readline())
+
+    def test_max_connections(self):
+        self._start(max_connections=1)
+        first, first_f = self._connect()
+        second = socket.create_connection(("localhost", self.port), timeout=0.3)
+        with second:
+            with first, first_f:
+                first.sendall(b"51\n")
+                second.sendall(b"300001\n")
+                self.assertEqual(b"\n", first_f.readline())
+                with self.assertRaises(socket.timeout):
+                    second.recv(16)
+            second.settimeout(5)
+            self.assertEqual(b"0001\n", second.recv(16))
+
+
+def _start_server(test, froeling, **kwargs):
+    """
+    :return: port of a :py:class:`froeling_proxy.FroelingProxyServer` running in a thread until the test ends
+    """
+    port = _free_port()
+    server = froeling_proxy.FroelingProxyServer(port, froeling, **kwargs)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    test.addCleanup(thread.join)
+    test.addCleanup(server.stop)
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return port
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+class FroelingClientTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty()
+        self.port = _start_server(self, froeling_lib.Froeling(self.tty))
+
+    def test_slow_connect_does_not_block_other_threads(self):
+        connecting = threading.Event()
+
+        class SlowConnection(froeling_client._Connection):
+            def __init__(self, client):
+                if not connecting.is_set():
+                    connecting.set()
+                    time.sleep(1)
+                super(SlowConnection, self).__init__(client)
+
+        self.addCleanup(setattr, froeling_client, "_Connection", froeling_client._Connection)
+        froeling_client._Connection = SlowConnection
+        with FroelingClient("localhost", self.port, connections=2) as client:
+            thread = threading.Thread(target=client.connect)
+            thread.start()
+            connecting.wait(5)
+            started = time.monotonic()
+            self.assertEqual(b"", client.read_state())
+            self.assertLess(time.monotonic() - started, 0.5)
+            thread.join()
+            self.assertEqual(b"", client.read_state())
+
+    def test_requests_are_pipelined(self):
+        with FroelingClient("localhost", self.port, connections=1) as client:
+            self.tty.delay = 0.05
+            futures = client.submit([b"\x30\x00" + bytes([i]) for i in range(10)])
+            self.assertEqual([b"\x00" + bytes([i]) for i in range(10)], [future.result(5) for future in futures])
+            self.assertEqual(b"\x00\x01", client.read_values(b"\x00\x01"))
+            self.assertEqual(b"", client.read_state())
+            self.assertEqual(b"\x00\x02", client.send_command(0x30, [0x00, 0x02]))
+            self.assertEqual(1, len([connection for connection in client._connections if connection is not None]))
+
+    def test_batches_larger_than_the_proxy_buffer_do_not_block(self):
+        port = _start_server(self, froeling_lib.Froeling(self.tty, cache=froeling_lib.ResponseCache()),
+                             max_buffer_size=4096)
+        with FroelingClient("localhost", port, connections=1) as client:
+            futures = client.submit([b"\x51" + bytes(200)] * 20000)
+            self.assertEqual([bytes(200)] * 20000, [future.result(10) for future in futures])
+
+    def test_errors_are_mapped_to_exceptions(self):
+        with FroelingClient("localhost", self.port, priority="background") as client:
+            self.tty.respond = False
+            with self.assertRaises(froeling_lib.NoResponseError):
+                client.read_state()
+        with self.assertRaisesRegex(froeling_lib.WrongResponseCRCError, "^Expected CRC value 01, received 02$"):
+            parse_response(b"!WrongResponseCRCError: Expected CRC value 01, received 02")
+        with self.assertRaisesRegex(ProxyError, "^ValueError: invalid$"):
+            parse_response(b"!ValueError: invalid")
+
+    def test_connection_failures_are_reported(self):
+        with self.assertRaises(froeling_lib.SerialPortIOError):
+            FroelingClient("localhost", _free_port()).read_state()
+
+    def test_connect_reports_missing_proxy(self):
+        FroelingClient("localhost", self.port).connect()
+        with self.assertRaises(froeling_lib.SerialPortIOError):
+            FroelingClient("localhost", _free_port()).connect()
+
+    def test_async_client(self):
+        async def run():
+            async with AsyncFroelingClient("localhost", self.port, priority="background") as client:
+                futures = await client.submit([b"\x30\x00" + bytes([i]) for i in range(10)])
+                responses = await asyncio.gather(*futures)
+                concurrent = await asyncio.gather(client.read_values(b"\x00\x01"), client.read_state())
+                self.tty.respond = False
+                with self.assertRaises(froeling_lib.NoResponseError):
+                    await client.send_command(0x30, [0x00, 0x02])
+            with self.assertRaises(froeling_lib.SerialPortIOError):
+                await AsyncFroelingClient("localhost", _free_port()).read_state()
+            return responses, concurrent
+
+        responses, concurrent = asyncio.run(run())
+        self.assertEqual([b"\x00" + bytes([i]) for i in range(10)], responses)
+        self.assertEqual([b"\x00\x01", b""], concurrent)
+
+
+class UpstreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty()
+        self.upstream_port = _start_server(self, froeling_lib.Froeling(self.tty))
+
+    def test_submitting_does_not_wait_for_the_upstream_connection(self):
+        class SlowPool(UpstreamPool):
+            def submit(self, messages):
+                time.sleep(0.5)
+                return super(SlowPool, self).submit(messages)
+
+        worker = UpstreamWorker(SlowPool("localhost", self.upstream_port))
+        worker.start()
+        self.addCleanup(worker.stop)
+        started = time.monotonic()
+        future = worker.submit(0x30, b"\x00\x01")
+        self.assertLess(time.monotonic() - started, 0.2)
+        self.assertEqual(b"\x00\x01", future.result(5))
+
+    def test_identical_writes_are_sent_upstream_each(self):
+        self.tty.delay = 0.1
+        worker = UpstreamWorker(UpstreamPool("localhost", self.upstream_port))
+        worker.start()
+        self.addCleanup(worker.stop)
+        futures = [worker.submit(0x5a, b"\x01", flow) for flow in ["a", "b"]]
+        self.assertEqual([b"\x01", b"\x01"], [future.result(5) for future in futures])
+        self.assertEqual([b"\x5a\x01", b"\x5a\x01"], self.tty.requests)
+        self.assertEqual(0, worker.coalesced)
+
+    def test_edge_proxy_caches_and_coalesces(self):
+        self.tty.delay = 0.1
+        pool = UpstreamPool("localhost", self.upstream_port, cache=froeling_lib.ResponseCache(ttl=60))
+        edge_port = _start_server(self, pool)
+        clients = [socket.create_connection(("localhost", edge_port), timeout=5) for _ in range(3)]
+        files = [client.makefile("rb") for client in clients]
+        try:
+            for client in clients:
+                client.sendall(b"300001\n51\n")
+            for f in files:
+                self.assertEqual([b"0001\n", b"\n"], [f.readline() for _ in range(2)])
+            clients[0].sendall(b"300001\n")
+            self.assertEqual(b"0001\n", files[0].readline())
+            self.assertEqual([b"\x30\x00\x01", b"\x51"], self.tty.requests)
+            self.tty.respond = False
+            clients[0].sendall(b"300002\n")
+            self.assertTrue(files[0].readline().startswith(b"!NoResponseError: "))
+        finally:
+            for client, f in zip(clients, files):
+                f.close()
+                client.close()
+
+
+class LazyImportTest(unittest.TestCase):
+    def test_heavy_modules_are_imported_when_needed(self):
+        server_modules = ["froeling_client", "froeling_proxy.binary", "froeling_proxy.subscriptions",
+                          "froeling_proxy.upstream", "froeling_proxy.worker", "inspect"]
+        code = "import sys, froeling_proxy; " \
+               "print(sorted(set({}) & set(sys.modules))); " \
+               "import froeling_client; " \
+               "print(sorted({{'asyncio', 'serial', 'http.server'}} & set(sys.modules))); " \
+               "froeling_proxy.AsyncFroelingProxyServer, froeling_client.AsyncFroelingClient; " \
+               "print('asyncio' in sys.modules)".format(server_modules)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual("[]\n[]\nTrue\n", output.stdout)
+
+
+class MainTest(unittest.TestCase):
+    def test_store_is_closed_on_sigterm(self):
+        upstream_port = _start_server(self, froeling_lib.Froeling(FakeBoilerTty()))
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "store")
+            process = subprocess.Popen([sys.executable, "-m", "froeling_proxy", "--upstream",
+                                        "localhost:{}".format(upstream_port), "--port", str(_free_port()),
+                                        "--poll-interval", "0.05", "--store", path], cwd=root)
+            try:
+                deadline = time.monotonic() + 10
+                while not (os.path.exists(path + ".raw") and os.path.getsize(path + ".raw")):
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.05)
+            finally:
+                process.terminate()
+                self.assertEqual(0, process.wait(10))
+            self.assertTrue(list(read_range(path, resolution="minute")))
+
+class AsyncFroelingProxyServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tty = FakeBoilerTty()
+        self.server = froeling_proxy.AsyncFroelingProxyServer(0, froeling_lib.Froeling(self.tty), binary_port=0)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        server = asyncio.run_coroutine_threadsafe(self.server.open(), self.loop).result()
+        self.port = server.sockets[0].getsockname()[1]
+        self.binary_port = self.server.servers[1].sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _shutdown(self):
+        self.server.close()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _connect(self):
+        s = socket.create_connection(("localhost", self.port), timeout=5)
+        return s, s.makefile("rb")
+
+    def test_responses_in_request_order(self):
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"300001\r\n51\n")
+            self.assertEqual(b"0001\n", f.readline())
+            self.assertEqual(b"\n", f.readline())
+            s.sendall(b"XX\n")
+            self.assertEqual(b"", f.readline())
+
+    def test_invalid_hex_is_reported(self):
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"301\n51\n")
+            self.assertTrue(f.readline().startswith(b"!ValueError: "))
+            self.assertEqual(b"\n", f.readline())
+
+    def test_connections_are_served_while_command_in_flight(self):
+        self.tty.delay = 0.5
+        slow, slow_f = self._connect()
+        fast, fast_f = self._connect()
+        with slow, slow_f, fast, fast_f:
+            slow.sendall(b"51\n")
+            time.sleep(0.1)
+            started = time.monotonic()
+            fast.sendall(b"5\n")
+            self.assertTrue(fast_f.readline().startswith(b"!ValueError: "))
+            self.assertLess(time.monotonic() - started, 0.3)
+            self.assertEqual(b"\n", slow_f.readline())
+
+    def test_subscribe(self):
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"#subscribe 0.5 0 0001 0002\n")
+            self.assertEqual(b"1\n", f.readline())
+            self.assertEqual(b"*1 0001:0001 0002:0002\n", f.readline())
+            s.sendall(b"#unsubscribe 1\n")
+            self.assertEqual(b"1\n", f.readline())
+        self.assertEqual(0, len(self.server.subscriptions))
+
+    def test_connection_receiving_notifications_is_not_idle(self):
+        counter = itertools.count(1)
+        self.tty.handler = lambda message: next(counter).to_bytes(2, "big")
+        self.server.subscriptions.min_interval = 0.05
+        self.server.idle_timeout = 0.3
+        s, f = self._connect()
+        with s, f:
+            s.sendall(b"#subscribe 0.1 0 0001\n")
+            self.assertEqual(b"1\n", f.readline())
+            for _ in range(8):
+                self.assertTrue(f.readline().startswith(b"*1 0001:"))
+            s.sendall(b"#unsubscribe 1\n")
+            self.assertEqual(b"1\n", f.readline())
+            started = time.monotonic()
+            self.assertEqual(b"", f.readline())
+            self.assertLess(time.monotonic() - started, 2)
+
+    def test_binary_protocol(self):
+        with socket.create_connection(("localhost", self.binary_port), timeout=5) as s:
+            s.sendall(binary.encode_request(10, 0x30, b"\x00\x01") + binary.encode_request(11, 0x51))
+            self.assertEqual({(10, binary.STATUS_OK, b"\x00\x01"), (11, binary.STATUS_OK, b"")},
+                             set(_read_frames(s, 2)))
+            self.tty.respond = False
+            s.sendall(binary.encode_request(12, 0x52))
+            self.assertEqual([(12, binary.STATUS_CODES[froeling_lib.NoResponseError], b"")], _read_frames(s, 1))
+            s.sendall(b"\x00\x01\x00\x00\x00\x0d\x30")
+            self.assertEqual([], _read_frames(s, 1))